@@ -0,0 +1,469 @@
+#!/usr/bin/env python3
+"""
+🧪 Groovia Offline Benchmark
+Fake JioSaavn API + media CDN + recording Telegram bot - no network needed.
+
+Simulated users run search -> open song -> download -> next page against
+the real on_text / on_callback handlers from final.py and we report
+p50/p95/p99 latency per step and overall updates/sec.
+
+Usage:
+    python bench.py --users 20 --rounds 5 --api-latency 80 --cdn-latency 150
+    python bench.py --compare-downloads --media-kb 8192 --cdn-kbps 1024
+"""
+
+import os, sys, time, asyncio, random, argparse, tempfile, threading, json, hashlib, logging, re
+from io import BytesIO
+from types import SimpleNamespace
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+# ==================== FAKE JIOSAAVN + CDN ====================
+class FakeBackend:
+    """Local stand-in for /result/, /song/, /album/, /playlist/ and the media CDN"""
+
+    def __init__(self, api_latency=0.05, cdn_latency=0.1, media_kb=512, results=30, cdn_kbps=0, ranges=True,
+                 fail_rate=0.0, missing=()):
+        self.api_latency = api_latency
+        self.cdn_latency = cdn_latency
+        self.cdn_kbps = cdn_kbps  # per-connection media bandwidth in KB/s, 0 = unlimited
+        self.ranges = ranges
+        self.fail_rate = fail_rate  # chance a media response is cut off halfway
+        self.missing = set(missing)  # bitrates ('320', '96', ...) the CDN doesn't have
+        self.media = os.urandom(1024) * media_kb
+        self.results = results
+        self.hits: dict = {}
+        self.image = self._make_image()
+        self.server = None
+        self.base = ''
+
+    @staticmethod
+    def _make_image():
+        from PIL import Image
+        out = BytesIO()
+        Image.new('RGB', (500, 500), (200, 40, 90)).save(out, 'JPEG')
+        return out.getvalue()
+
+    def song(self, sid):
+        return {
+            'id': sid, 'song': f"Song {sid}", 'singers': f"Artist {sid[:3]}", 'album': f"Album {sid[:4]}",
+            'duration': str(120 + int(sid, 16) % 180), 'year': '2024', 'language': 'hindi',
+            'image': f"{self.base}/img/{sid}.jpg",
+            'media_url': f"{self.base}/media/{sid}_160.mp4",
+            'perma_url': f"https://www.jiosaavn.com/song/x/{sid}",
+        }
+
+    def songs_for(self, q, n):
+        h = hashlib.md5(q.encode()).hexdigest()
+        return [self.song(hashlib.md5(f"{h}{i}".encode()).hexdigest()[:10]) for i in range(n)]
+
+    def start(self):
+        backend = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *a):
+                pass
+
+            def _send(self, code, body, ctype='application/json', headers=None, kbps=0, cut=False):
+                self.send_response(code)
+                self.send_header('Content-Type', ctype)
+                self.send_header('Content-Length', str(len(body)))
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.end_headers()
+                if self.command == 'HEAD':
+                    return
+                if cut:
+                    # Promise the whole body, deliver half, hang up
+                    body = body[:len(body) // 2]
+                    self.close_connection = True
+                if not kbps:
+                    self.wfile.write(body)
+                    return
+                chunk = 16384
+                for i in range(0, len(body), chunk):
+                    self.wfile.write(body[i:i + chunk])
+                    time.sleep(chunk / (kbps * 1024))
+
+            def _media(self):
+                body = backend.media
+                rng = self.headers.get('Range') if backend.ranges else None
+                cut = self.command == 'GET' and random.random() < backend.fail_rate
+                m = re.fullmatch(r'bytes=(\d+)-(\d*)', rng or '')
+                if not m:
+                    headers = {'Accept-Ranges': 'bytes'} if backend.ranges else None
+                    self._send(200, body, 'audio/mp4', headers, backend.cdn_kbps, cut)
+                    return
+                start = int(m.group(1))
+                end = min(int(m.group(2) or len(body) - 1), len(body) - 1)
+                self._send(206, body[start:end + 1], 'audio/mp4',
+                           {'Accept-Ranges': 'bytes', 'Content-Range': f"bytes {start}-{end}/{len(body)}"},
+                           backend.cdn_kbps, cut)
+
+            def do_HEAD(self):
+                self.do_GET()
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                qs = {k: v[0] for k, v in parse_qs(url.query).items()}
+                route = '/' + url.path.strip('/').split('/')[0] + '/'
+                backend.hits[route] = backend.hits.get(route, 0) + 1
+
+                if route in ('/result/', '/song/', '/album/', '/playlist/'):
+                    time.sleep(backend.api_latency)
+                    q = qs.get('query', '')
+                    if route == '/result/':
+                        data = backend.songs_for(q, backend.results)
+                    elif route == '/song/':
+                        data = backend.song(q.rstrip('/').split('/')[-1][:10].ljust(10, '0'))
+                        if qs.get('lyrics') == 'true':
+                            data['lyrics'] = "la la la\n" * 20
+                    elif route == '/album/':
+                        data = {'title': 'Fake Album', 'year': '2024', 'songs': backend.songs_for(q, 12)}
+                    else:
+                        data = {'listname': 'Fake Playlist', 'songs': backend.songs_for(q, 50)}
+                    self._send(200, json.dumps(data).encode())
+                elif route == '/media/':
+                    time.sleep(backend.cdn_latency)
+                    if any(f"_{q}." in url.path for q in backend.missing):
+                        self._send(404, b'')
+                    else:
+                        self._media()
+                elif route == '/img/':
+                    time.sleep(backend.cdn_latency / 2)
+                    self._send(200, backend.image, 'image/jpeg')
+                else:
+                    self._send(404, b'{}')
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.base = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.base
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+
+# ==================== FAKE TELEGRAM ====================
+class FakeMessage:
+    _ids = 0
+
+    def __init__(self, bot, chat_id, text='', markup=None):
+        FakeMessage._ids += 1
+        self.message_id = FakeMessage._ids
+        self.bot = bot
+        self.chat = SimpleNamespace(id=chat_id)
+        self.chat_id = chat_id
+        self.text = text
+        self.reply_markup = markup
+        self.photo = ()
+
+    async def reply_text(self, text, **kw):
+        return await self.bot.send_message(self.chat.id, text, **kw)
+
+    async def edit_text(self, text, **kw):
+        await self.bot._call('edit_message_text')
+        self.text = text
+        if kw.get('reply_markup') is not None:
+            self.reply_markup = kw['reply_markup']
+        self.bot.last[self.chat.id] = self
+        return self
+
+    async def edit_caption(self, caption=None, **kw):
+        await self.bot._call('edit_message_caption')
+        self.text = caption
+        if kw.get('reply_markup') is not None:
+            self.reply_markup = kw['reply_markup']
+        self.bot.last[self.chat.id] = self
+        return self
+
+    async def edit_reply_markup(self, reply_markup=None, **kw):
+        await self.bot._call('edit_message_reply_markup')
+        self.reply_markup = reply_markup
+        self.bot.last[self.chat.id] = self
+        return self
+
+    async def delete(self):
+        await self.bot._call('delete_message')
+        return True
+
+class FakeBot:
+    """Recording stand-in for telegram.Bot with a configurable round-trip time"""
+
+    def __init__(self, rtt=0.03, upload_mbps=20.0):
+        self.rtt = rtt
+        self.upload_mbps = upload_mbps
+        self.calls: dict = {}
+        self.last: dict = {}  # chat_id -> last message carrying a keyboard
+        self.audio_bytes = 0
+
+    async def _call(self, name, nbytes=0):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        delay = self.rtt + (nbytes * 8 / (self.upload_mbps * 1e6) if nbytes else 0)
+        await asyncio.sleep(delay)
+
+    def _track(self, msg):
+        if msg.reply_markup is not None:
+            self.last[msg.chat.id] = msg
+        return msg
+
+    async def send_message(self, chat_id, text, **kw):
+        await self._call('send_message')
+        return self._track(FakeMessage(self, chat_id, text, kw.get('reply_markup')))
+
+    async def send_photo(self, chat_id, photo, caption='', **kw):
+        await self._call('send_photo')
+        msg = FakeMessage(self, chat_id, caption, kw.get('reply_markup'))
+        msg.photo = (photo,)
+        return self._track(msg)
+
+    @staticmethod
+    def _size(f):
+        if f is None:
+            return 0
+        f = getattr(f, 'input_file_content', f)  # telegram.InputFile
+        if isinstance(f, (bytes, bytearray)):
+            return len(f)
+        try:
+            n = 0
+            while True:
+                chunk = f.read(65536)
+                if not chunk:
+                    return n
+                n += len(chunk)
+        except Exception:
+            return 0
+
+    async def send_audio(self, chat_id, audio, **kw):
+        n = self._size(audio) + self._size(kw.get('thumbnail'))
+        self.audio_bytes += n
+        await self._call('send_audio', n)
+        return FakeMessage(self, chat_id)
+
+    async def send_media_group(self, chat_id, media, **kw):
+        n = sum(self._size(m.media) for m in media)
+        self.audio_bytes += n
+        await self._call('send_media_group', n)
+        return [FakeMessage(self, chat_id) for _ in media]
+
+    async def send_document(self, chat_id, document, **kw):
+        await self._call('send_document', self._size(document))
+        return FakeMessage(self, chat_id)
+
+    async def send_chat_action(self, chat_id, action, **kw):
+        await self._call('send_chat_action')
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kw):
+        await self._call('edit_message_text')
+
+    async def delete_message(self, chat_id, message_id, **kw):
+        await self._call('delete_message')
+
+class FakeCallbackQuery:
+    def __init__(self, data, message):
+        self.data = data
+        self.message = message
+
+    async def answer(self, *a, **kw):
+        await self.message.bot._call('answer_callback_query')
+
+    async def edit_message_text(self, text, **kw):
+        return await self.message.edit_text(text, **kw)
+
+    async def edit_message_reply_markup(self, reply_markup=None, **kw):
+        return await self.message.edit_reply_markup(reply_markup=reply_markup)
+
+def text_update(bot, uid, text):
+    msg = FakeMessage(bot, uid, text)
+    user = SimpleNamespace(id=uid, first_name=f"user{uid}")
+    return SimpleNamespace(message=msg, effective_user=user, callback_query=None,
+                           effective_chat=msg.chat, effective_message=msg)
+
+def callback_update(bot, uid, data, message):
+    user = SimpleNamespace(id=uid, first_name=f"user{uid}")
+    return SimpleNamespace(message=None, effective_user=user, callback_query=FakeCallbackQuery(data, message),
+                           effective_chat=message.chat, effective_message=message)
+
+def buttons(msg, prefix):
+    """callback_data of every button on msg whose (decoded) data starts with prefix"""
+    if msg is None or msg.reply_markup is None:
+        return []
+    out = []
+    for row in msg.reply_markup.inline_keyboard:
+        for b in row:
+            if b.callback_data and b.callback_data.startswith(prefix):
+                out.append(b.callback_data)
+    return out
+
+# ==================== HARNESS ====================
+def load_bot(tmpdir, api_base):
+    """Import final.py pointed at the fake backend and a throwaway cache dir"""
+    os.environ.update({
+        'API_BASE_URL': api_base,
+        'THUMB_DIR': os.path.join(tmpdir, 'thumbs'),
+        'AUDIO_DIR': os.path.join(tmpdir, 'audio'),
+        'PROFILE_DIR': os.path.join(tmpdir, 'profiles'),
+        'RESULTS_DB': os.path.join(tmpdir, 'results.db'),
+        'JOBS_DB': os.path.join(tmpdir, 'jobs.db'),
+        'TRACE_FILE': os.path.join(tmpdir, 'slow_traces.jsonl'),
+        'STATE_URL': '',
+    })
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import final
+    logging.getLogger(final.__name__).setLevel(logging.WARNING)
+    logging.getLogger('urllib3').setLevel(logging.ERROR)
+
+    # YouTube is the one upstream we can't fake over HTTP; stub it with a delay
+    def fake_youtube(query):
+        time.sleep(0.2)
+        return ' '.join(query.split()[:3]).title()
+    final.LyricsDetector._youtube_search = staticmethod(fake_youtube)
+    return final
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+class Recorder:
+    def __init__(self):
+        self.samples: dict = {}
+        self.errors: dict = {}
+        self.updates = 0
+
+    async def run(self, step, coro):
+        self.updates += 1
+        start = time.perf_counter()
+        try:
+            await coro
+        except Exception as e:
+            self.errors[step] = self.errors.get(step, 0) + 1
+            logging.getLogger('bench').debug(f"{step} failed: {e!r}")
+        self.samples.setdefault(step, []).append(time.perf_counter() - start)
+
+    def report(self, elapsed, title="Benchmark"):
+        lines = [f"\n📊 {title}: {self.updates} updates in {elapsed:.2f}s = {self.updates / elapsed:.1f} updates/sec", ""]
+        lines.append(f"{'step':<12}{'n':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}{'errors':>8}")
+        everything = []
+        for step, vals in self.samples.items():
+            everything += vals
+            lines.append(f"{step:<12}{len(vals):>6}{percentile(vals, 50) * 1000:>10.1f}{percentile(vals, 95) * 1000:>10.1f}"
+                         f"{percentile(vals, 99) * 1000:>10.1f}{max(vals) * 1000:>10.1f}{self.errors.get(step, 0):>8}")
+        lines.append(f"{'ALL':<12}{len(everything):>6}{percentile(everything, 50) * 1000:>10.1f}"
+                     f"{percentile(everything, 95) * 1000:>10.1f}{percentile(everything, 99) * 1000:>10.1f}"
+                     f"{max(everything or [0]) * 1000:>10.1f}{sum(self.errors.values()):>8}")
+        return '\n'.join(lines)
+
+def job_report(final):
+    """Queue wait / run time per download job kind, from the worker pool's recent jobs"""
+    by_kind = {}
+    for kind, waited, ran in final.jobs.recent:
+        by_kind.setdefault(kind, ([], []))
+        by_kind[kind][0].append(waited)
+        by_kind[kind][1].append(ran)
+    lines = [f"\n👷 Download jobs ({final.jobs.workers} workers)"]
+    for kind, (waits, runs) in sorted(by_kind.items()):
+        lines.append(f"  {kind:<8}{len(runs):>5} jobs  wait p50 {percentile(waits, 50) * 1000:.0f}ms "
+                     f"p95 {percentile(waits, 95) * 1000:.0f}ms  run p50 {percentile(runs, 50) * 1000:.0f}ms "
+                     f"p95 {percentile(runs, 95) * 1000:.0f}ms")
+    return '\n'.join(lines)
+
+async def user_session(final, bot, ctx, rec, uid, rounds, lock):
+    """search -> open song -> download -> next page, `rounds` times"""
+    async def step(name, update, handler):
+        if lock:
+            async with lock:
+                await rec.run(name, handler(update, ctx))
+        else:
+            await rec.run(name, handler(update, ctx))
+
+    for r in range(rounds):
+        await step('search', text_update(bot, uid, f"song {uid} {r}"), final.on_text)
+        results = bot.last.get(uid)
+        songs = buttons(results, 's_')
+        if not songs:
+            continue
+        await step('open', callback_update(bot, uid, random.choice(songs), results), final.on_callback)
+        detail = bot.last.get(uid)
+        for d in buttons(detail, 'd_')[:1]:
+            await step('download', callback_update(bot, uid, d, detail), final.on_callback)
+        for p in buttons(results, 'p_')[:1]:
+            await step('page', callback_update(bot, uid, p, results), final.on_callback)
+
+async def run_bench(args):
+    backend = FakeBackend(args.api_latency / 1000, args.cdn_latency / 1000, args.media_kb)
+    base = backend.start()
+    tmp = tempfile.mkdtemp(prefix='groovia-bench-')
+    final = load_bot(tmp, base)
+    bot = FakeBot(args.tg_rtt / 1000)
+    ctx = SimpleNamespace(bot=bot, args=[], error=None)
+    rec = Recorder()
+    lock = asyncio.Lock() if args.sequential else None
+
+    start = time.perf_counter()
+    await asyncio.gather(*(user_session(final, bot, ctx, rec, 1000 + i, args.rounds, lock) for i in range(args.users)))
+    await final.jobs.join()  # downloads finish on the worker pool, after their updates return
+    elapsed = time.perf_counter() - start
+
+    print(rec.report(elapsed))
+    print(job_report(final))
+    print(f"\n🌐 Backend hits: {backend.hits}")
+    print(f"🤖 Bot calls: {bot.calls}  (audio uploaded: {bot.audio_bytes / 1024 / 1024:.1f} MB)")
+    backend.stop()
+
+def compare_downloads(args):
+    """Time API.download single-stream vs ranged against the fake CDN"""
+    backend = FakeBackend(0, args.cdn_latency / 1000, args.media_kb, cdn_kbps=args.cdn_kbps,
+                          fail_rate=args.cdn_fail_rate)
+    base = backend.start()
+    final = load_bot(tempfile.mkdtemp(prefix='groovia-bench-'), base)
+    url = f"{base}/media/0123456789_320.mp4"
+    print(f"📦 {args.media_kb}KB file, {args.cdn_kbps or 'unlimited'}KB/s per connection, "
+          f"{args.cdn_latency:.0f}ms to first byte, {args.cdn_fail_rate:.0%} of transfers cut, "
+          f"{args.downloads} downloads each\n")
+    modes = [('stream', 1, True)] + [(f'ranged x{n}', n, True) for n in (2, 4, 8)] + [('ranged, no CDN ranges', 4, False)]
+    for label, conns, ranges in modes:
+        backend.ranges = ranges
+        final.DOWNLOAD_CONNECTIONS = conns
+        final.RANGED_MIN_BYTES = 0
+        times = []
+        kept = final.metrics.download_resumed_bytes.value()
+        for _ in range(args.downloads):
+            t = time.perf_counter()
+            data = final.api.download(url)
+            times.append(time.perf_counter() - t)
+            assert data is not None and bytes(data) == backend.media, f"{label}: corrupt download"
+        mbps = len(backend.media) * 8 / 1e6 / (sum(times) / len(times))
+        kept = final.metrics.download_resumed_bytes.value() - kept
+        print(f"{label:<24} p50 {percentile(times, 50) * 1000:8.1f}ms  max {max(times) * 1000:8.1f}ms  {mbps:7.1f} Mbit/s"
+              f"  resumed {kept / 1024:.0f}KB")
+    backend.stop()
+
+def main():
+    ap = argparse.ArgumentParser(description="Offline benchmark for the Groovia bot handlers")
+    ap.add_argument('--users', type=int, default=10, help="concurrent simulated users")
+    ap.add_argument('--rounds', type=int, default=3, help="search/open/download/page rounds per user")
+    ap.add_argument('--api-latency', type=float, default=50, help="fake API latency (ms)")
+    ap.add_argument('--cdn-latency', type=float, default=100, help="fake CDN time to first byte (ms)")
+    ap.add_argument('--media-kb', type=int, default=512, help="size of each fake audio file (KB)")
+    ap.add_argument('--tg-rtt', type=float, default=30, help="fake Telegram API round trip (ms)")
+    ap.add_argument('--sequential', action='store_true', help="one update at a time, like PTB's default")
+    ap.add_argument('--compare-downloads', action='store_true', help="benchmark single-stream vs ranged downloads instead")
+    ap.add_argument('--cdn-kbps', type=float, default=0, help="per-connection CDN bandwidth in KB/s (0 = unlimited)")
+    ap.add_argument('--downloads', type=int, default=5, help="downloads per mode with --compare-downloads")
+    ap.add_argument('--cdn-fail-rate', type=float, default=0, help="chance a media transfer is cut off halfway")
+    args = ap.parse_args()
+    if args.compare_downloads:
+        compare_downloads(args)
+        return
+    asyncio.run(run_bench(args))
+
+if __name__ == '__main__':
+    main()
@@ -5,23 +5,29 @@ Added: Google-based lyrics detection (Free & Unlimited)
 Render Deployment Ready
 """
 
-import os, sys, time, logging, asyncio, requests, re, random, threading
+import os, sys, time, logging, asyncio, requests, re, random, threading, json, contextvars, signal, socket
 from dotenv import load_dotenv
 from flask import Flask
 from bs4 import BeautifulSoup
 import urllib.parse
+import traceback
+import hashlib, base64, sqlite3, tempfile, functools, copy
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
 
 load_dotenv()
 from datetime import datetime
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Set
 from io import BytesIO
-from collections import defaultdict
+from collections import defaultdict, OrderedDict, deque
 from urllib3.util.retry import Retry
 from requests.adapters import HTTPAdapter
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand, InputFile, InputMediaAudio
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
 from telegram.constants import ParseMode
+from telegram.error import RetryAfter, TimedOut
+from telegram.request import HTTPXRequest
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -37,29 +43,740 @@ def home():
 def health():
     return "OK", 200
 
+@app.route('/metrics')
+def metrics_endpoint():
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
 def run_flask():
     port = int(os.environ.get("PORT", 8080))
     app.run(host="0.0.0.0", port=port, debug=False, use_reloader=False)
 
 BOT_TOKEN = os.getenv("BOT_TOKEN", "8334511601:AAGpaDzTXbZrGKSlWWNBbg7q3Iq1-xfJ_yU")
-API_BASE_URL = "https://jiosaavanapi.onrender.com"
+API_BASE_URL = os.getenv("API_BASE_URL", "https://jiosaavanapi.onrender.com")
 ADMIN_IDS = [int(x) for x in os.getenv("ADMIN_IDS", "7097905601").split(",") if x.strip().isdigit()]
 SONGS_PER_PAGE = 10
 MAX_RETRIES = 5
 
 REQUEST_TIMEOUT = 300
 
+# Prefetch settings
+PREFETCH_WORKERS = int(os.getenv("PREFETCH_WORKERS", 3))
+PREFETCH_MAX_PENDING = 200
+SONG_CACHE_TTL = int(os.getenv("SONG_CACHE_TTL", 1800))
+SONG_CACHE_MAX = 2000
+PREFETCH_THUMBS = os.getenv("PREFETCH_THUMBS", "0") == "1"
+
+# Thumbnail cache (Telegram wants JPEG, max 320x320, under 200KB)
+THUMB_DIR = os.getenv("THUMB_DIR", "cache/thumbs")
+THUMB_CACHE_BYTES = int(os.getenv("THUMB_CACHE_MB", 50)) * 1024 * 1024
+THUMB_SIZE = 320
+THUMB_MAX_BYTES = 200 * 1024
+
+# Audio cache on disk, keyed by (songid, quality)
+AUDIO_DIR = os.getenv("AUDIO_DIR", "cache/audio")
+AUDIO_CACHE_BYTES = int(os.getenv("AUDIO_CACHE_MB", 500)) * 1024 * 1024
+
+# Curated shelves (trending / moods / artists)
+SHELVES_FILE = os.getenv("SHELVES_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "shelves.json"))
+SHELF_REFRESH_INTERVAL = int(os.getenv("SHELF_REFRESH_MINUTES", 30)) * 60
+
+# Result sessions (last search/album/playlist per user)
+SESSION_TTL = int(os.getenv("SESSION_TTL_MINUTES", 60)) * 60
+SESSION_BUDGET = int(os.getenv("SESSION_BUDGET_MB", 64)) * 1024 * 1024
+SESSION_MAX_EXPIRED = 20000
+
+# Result sets addressed from callback_data (shared between workers / restarts)
+RESULTS_DB = os.getenv("RESULTS_DB", "cache/results.db")
+RESULTS_TTL = int(os.getenv("RESULTS_TTL_DAYS", 7)) * 86400
+RESULTS_NOTE_TTL = RESULTS_TTL * 4  # an expired set's query is kept this long so its buttons can re-run it
+RESULTS_MEM_MAX = 500
+CB_VERSION = '1'
+
+# Shared state: empty = single process, redis://host:port/db = shared between workers
+STATE_URL = os.getenv("STATE_URL", "")
+STATE_PREFIX = os.getenv("STATE_PREFIX", "groovia:")
+STATE_IO_THREADS = int(os.getenv("STATE_IO_THREADS", 8))
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8443))
+
+# Memory budgets for DataStore structures: "evict" trims disposable data, "warn" only logs
+MEM_TABLE_BUDGET = int(os.getenv("MEM_TABLE_BUDGET_MB", 64)) * 1024 * 1024
+MEM_USER_BUDGET = int(os.getenv("MEM_USER_BUDGET_KB", 1024)) * 1024
+MEM_BUDGET_ACTION = os.getenv("MEM_BUDGET_ACTION", "warn")  # or "evict"
+MEM_ENFORCE_INTERVAL = 30
+MEM_WARN_INTERVAL = 300
+HISTORY_KEEP_ON_EVICT = 10
+
+# Compaction of user records that hold nothing but defaults
+COMPACT_INTERVAL = int(os.getenv("COMPACT_INTERVAL_HOURS", 6)) * 3600
+COMPACT_INACTIVE_DAYS = int(os.getenv("COMPACT_INACTIVE_DAYS", 30))
+
+# Audio downloads: files above RANGED_MIN_KB are fetched as parallel byte ranges
+DOWNLOAD_CONNECTIONS = int(os.getenv("DOWNLOAD_CONNECTIONS", 4))
+RANGED_MIN_BYTES = int(os.getenv("RANGED_MIN_KB", 1024)) * 1024
+DOWNLOAD_HEADERS = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+                    'Accept-Encoding': 'identity'}
+# A stalled transfer resumes from its last byte, so it can give up on a read much sooner
+DOWNLOAD_TIMEOUT = (15, int(os.getenv("DOWNLOAD_READ_TIMEOUT", 60)))
+DOWNLOAD_GONE = (403, 404, 410)  # the file isn't there; retrying won't change that
+
+# Download All: tracks go out as Telegram media groups (max 10 audios per call)
+MEDIA_GROUP_SIZE = 10
+BATCH_DOWNLOAD_PARALLEL = int(os.getenv("BATCH_DOWNLOAD_PARALLEL", 4))
+BATCH_GROUPS_AHEAD = 1  # groups of one batch that may download while an earlier group is still being sent
+
+# Download jobs: persisted in SQLite, run by a fixed worker pool, lower priority first
+JOBS_DB = os.getenv("JOBS_DB", "cache/jobs.db")
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", 4))
+JOB_MAX_ATTEMPTS = 3
+# Workers sharing JOBS_DB hold running jobs on a lease they keep renewing; a lapsed lease means the
+# worker died and the job is queued again. Set JOB_WORKER_ID to a stable name per process to have a
+# restarted worker requeue its own jobs at once instead of after the lease runs out.
+JOB_WORKER_ID = os.getenv("JOB_WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+JOB_LEASE = 60
+# Fairness: jobs are handed out round-robin across users; ADMIN_IDS are exempt from both limits
+USER_DOWNLOAD_CONCURRENCY = int(os.getenv("USER_DOWNLOAD_CONCURRENCY", 2))  # running jobs per user
+USER_HOURLY_MB = int(os.getenv("USER_HOURLY_MB", 500))  # delivered audio per user per hour, 0 = unlimited
+JOB_KEEP_DAYS = 2
+PRIORITY_SINGLE = 0
+PRIORITY_BATCH = 10
+# A second tap on the same song button within this window is treated as a double tap
+TAP_WINDOW = 5
+
+# Load shedding: cosmetic edits and animations are dropped while any signal is over its limit
+SHED_LAG_MS = int(os.getenv("SHED_LAG_MS", 300))  # p95 event-loop lag over the last 10s
+SHED_QUEUE_DEPTH = int(os.getenv("SHED_QUEUE_DEPTH", 30))  # queued download jobs
+SHED_429_PER_MIN = int(os.getenv("SHED_429_PER_MIN", 5))  # Telegram flood-control responses
+SHED_COOLDOWN = 60  # seconds every signal must stay below half its limit before full UX returns
+SHED_INTERVAL = 2
+
 # Session with retry logic
 def create_session():
     session = requests.Session()
     retry = Retry(total=MAX_RETRIES, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504, 429])
-    adapter = HTTPAdapter(max_retries=retry)
+    # Ranged downloads open several connections per track to the same CDN host
+    adapter = HTTPAdapter(max_retries=retry, pool_maxsize=max(10, DOWNLOAD_CONNECTIONS * 8))
     session.mount('http://', adapter)
     session.mount('https://', adapter)
     return session
 
 SESSION = create_session()
 
+# ==================== METRICS ====================
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+BYTES_BUCKETS = (64 * 1024, 256 * 1024, 1024 ** 2, 2 * 1024 ** 2, 4 * 1024 ** 2, 8 * 1024 ** 2, 16 * 1024 ** 2, 32 * 1024 ** 2)
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{n}="{str(v)}"' for n, v in zip(names, values)) + '}'
+
+def _num(v):
+    """Exact sample text: whole numbers as integers, anything else at full float precision"""
+    v = float(v)
+    return str(int(v)) if v.is_integer() else repr(v)
+
+class Counter:
+    def __init__(self, name, doc, labels=()):
+        self.name, self.doc, self.labels = name, doc, tuple(labels)
+        self._values: Dict[tuple, float] = defaultdict(float)
+        self._lock = threading.Lock()
+    
+    def inc(self, *labels, n=1):
+        with self._lock:
+            self._values[labels] += n
+    
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+    
+    def render(self):
+        out = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} counter"]
+        for lv, v in sorted(self._values.items()):
+            out.append(f"{self.name}{_labels(self.labels, lv)} {_num(v)}")
+        return out
+
+class Gauge:
+    """Gauge whose value is read from a callback at scrape time"""
+    
+    kind = 'gauge'
+    
+    def __init__(self, name, doc, fn, labels=()):
+        self.name, self.doc, self.fn, self.labels = name, doc, fn, tuple(labels)
+    
+    def render(self):
+        out = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}"]
+        try:
+            values = self.fn()
+        except Exception as e:
+            logger.warning(f"Gauge {self.name} failed: {e}")
+            return out
+        if not isinstance(values, dict):
+            values = {(): values}
+        for lv, v in sorted(values.items()):
+            lv = lv if isinstance(lv, tuple) else (lv,)
+            out.append(f"{self.name}{_labels(self.labels, lv)} {_num(v)}")
+        return out
+
+class CounterFunc(Gauge):
+    """Counter kept by some other object (e.g. a cache's hit count) and read at scrape time"""
+    
+    kind = 'counter'
+
+class Histogram:
+    def __init__(self, name, doc, labels=(), buckets=LATENCY_BUCKETS):
+        self.name, self.doc, self.labels, self.buckets = name, doc, tuple(labels), tuple(buckets)
+        self._series: Dict[tuple, List] = {}  # labels -> [bucket counts, sum, count]
+        self._lock = threading.Lock()
+    
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            for i, b in enumerate(self.buckets):
+                if value <= b:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+    
+    def time(self, *labels, outcome=False):
+        """Context manager observing elapsed seconds; outcome=True adds an 'ok' or 'error' label"""
+        hist = self
+        class _Timer:
+            def __enter__(self):
+                self.start = time.perf_counter()
+                return self
+            def __exit__(self, exc_type, *exc):
+                extra = ('error' if exc_type else 'ok',) if outcome else ()
+                hist.observe(time.perf_counter() - self.start, *labels, *extra)
+        return _Timer()
+    
+    def render(self):
+        out = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((lv, [list(s[0]), s[1], s[2]]) for lv, s in self._series.items())
+        for lv, (counts, total, count) in items:
+            for b, n in zip(self.buckets, counts):
+                out.append(f"{self.name}_bucket{_labels(self.labels + ('le',), lv + (_num(b),))} {n}")
+            out.append(f"{self.name}_bucket{_labels(self.labels + ('le',), lv + ('+Inf',))} {count}")
+            out.append(f"{self.name}_sum{_labels(self.labels, lv)} {_num(total)}")
+            out.append(f"{self.name}_count{_labels(self.labels, lv)} {count}")
+        return out
+
+class Metrics:
+    """Tiny Prometheus registry served on /metrics"""
+    
+    def __init__(self):
+        self._all = []
+        self.api_latency = self.histogram('groovia_api_request_seconds', 'JioSaavn API latency per endpoint', ['endpoint'])
+        self.api_errors = self.counter('groovia_api_errors_total', 'JioSaavn API failures per endpoint', ['endpoint', 'reason'])
+        self.download_seconds = self.histogram('groovia_download_seconds', 'Audio download duration')
+        self.download_bytes = self.histogram('groovia_download_bytes', 'Audio download size', buckets=BYTES_BUCKETS)
+        self.upload_seconds = self.histogram('groovia_upload_seconds', 'Telegram audio upload time', ['outcome'])
+        self.batch_sends = self.counter('groovia_batch_sends_total', 'Download All deliveries by method', ['method'])
+        self.download_mode = self.counter('groovia_download_mode_total', 'Audio downloads per transfer mode', ['mode'])
+        self.download_attempts = self.counter('groovia_download_attempts_total', 'Audio download attempts by kind and outcome', ['kind', 'outcome'])
+        self.download_resumed_bytes = self.counter('groovia_download_resumed_bytes_total', 'Bytes kept instead of re-downloaded after a dropped transfer')
+        self.duplicate_taps = self.counter('groovia_duplicate_taps_total', 'Repeated button taps answered without redoing the work', ['button'])
+        self.callback_seconds = self.histogram('groovia_callback_seconds', 'Callback handling time per route', ['route'])
+        self.lyrics_outcomes = self.counter('groovia_lyrics_detection_total', 'Lyrics detection outcomes', ['outcome'])
+    
+    def counter(self, name, doc, labels=()):
+        m = Counter(name, doc, labels)
+        self._all.append(m)
+        return m
+    
+    def histogram(self, name, doc, labels=(), buckets=LATENCY_BUCKETS):
+        m = Histogram(name, doc, labels, buckets)
+        self._all.append(m)
+        return m
+    
+    def gauge(self, name, doc, fn, labels=()):
+        m = Gauge(name, doc, fn, labels)
+        self._all.append(m)
+        return m
+    
+    def counter_fn(self, name, doc, fn, labels=()):
+        m = CounterFunc(name, doc, fn, labels)
+        self._all.append(m)
+        return m
+    
+    def render(self):
+        lines = []
+        for m in self._all:
+            lines.extend(m.render())
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+# ==================== TRACING ====================
+TRACE_SLOW_MS = int(os.getenv("TRACE_SLOW_MS", 3000))
+TRACE_FILE = os.getenv("TRACE_FILE", "cache/slow_traces.jsonl")
+
+_current_trace = contextvars.ContextVar('trace', default=None)
+
+def background(coro):
+    """Start a long-lived task in a fresh context.
+    
+    Tasks copy the caller's context, so a worker first started while an
+    update is being traced would otherwise add its spans to that trace
+    for the rest of the process's life.
+    """
+    return asyncio.get_running_loop().create_task(coro, context=contextvars.Context())
+
+class Trace:
+    def __init__(self, kind, uid, what):
+        self.id = f"{random.getrandbits(48):012x}"
+        self.kind = kind
+        self.uid = uid
+        self.what = what
+        self.started = datetime.now().isoformat()
+        self.t0 = time.perf_counter()
+        self.spans: List[Dict] = []
+    
+    def to_dict(self, total_ms):
+        return {'id': self.id, 'kind': self.kind, 'uid': self.uid, 'what': self.what,
+                'start': self.started, 'total_ms': round(total_ms, 1), 'spans': self.spans}
+
+class Tracer:
+    """Per-update traces with named spans; slow ones are appended to TRACE_FILE.
+    
+    The current trace lives in a ContextVar, so spans opened in code that
+    runs via asyncio.to_thread still land in the right trace.
+    """
+    
+    def __init__(self, slow_ms=TRACE_SLOW_MS, path=TRACE_FILE):
+        self.slow_ms = slow_ms
+        self.path = path
+        self._lock = threading.Lock()
+        self.slow_count = metrics.counter('groovia_slow_traces_total', 'Traces slower than TRACE_SLOW_MS', ['kind'])
+    
+    def trace(self, kind, u, uid=None, what=''):
+        """Context manager opening a trace for one incoming Update (or a background job when u is None)"""
+        tracer = self
+        if u and u.effective_user:
+            uid = u.effective_user.id
+        if u and u.callback_query:
+            what = u.callback_query.data
+        elif u and u.message and u.message.text:
+            what = u.message.text[:80]
+        class _Ctx:
+            def __enter__(self):
+                self.t = Trace(kind, uid, what)
+                self.token = _current_trace.set(self.t)
+                return self.t
+            def __exit__(self, exc_type, exc, tb):
+                _current_trace.reset(self.token)
+                if exc_type:
+                    self.t.spans.append({'name': 'error', 'at_ms': round((time.perf_counter() - self.t.t0) * 1000, 1),
+                                         'ms': 0, 'error': repr(exc)[:200]})
+                tracer.finish(self.t)
+        return _Ctx()
+    
+    def span(self, name):
+        """Context manager timing one stage of the current trace (no-op outside a trace)"""
+        class _Span:
+            def __enter__(self):
+                self.t = _current_trace.get()
+                self.start = time.perf_counter()
+                return self
+            def __exit__(self, *exc):
+                if self.t is not None:
+                    end = time.perf_counter()
+                    self.t.spans.append({'name': name, 'at_ms': round((self.start - self.t.t0) * 1000, 1),
+                                         'ms': round((end - self.start) * 1000, 1)})
+        return _Span()
+    
+    def current_id(self):
+        t = _current_trace.get()
+        return t.id if t else None
+    
+    def finish(self, t):
+        total_ms = (time.perf_counter() - t.t0) * 1000
+        if total_ms < self.slow_ms:
+            return
+        self.slow_count.inc(t.kind)
+        logger.warning(f"🐢 Slow {t.kind} trace {t.id}: {total_ms:.0f}ms ({t.what[:40]})")
+        line = json.dumps(t.to_dict(total_ms), ensure_ascii=False)
+        try:
+            with self._lock:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(line + '\n')
+        except OSError as e:
+            logger.warning(f"Could not write trace: {e}")
+
+tracer = Tracer()
+
+# ==================== LOOP WATCHDOG ====================
+LOOP_LAG_INTERVAL = 0.1
+LOOP_LAG_THRESHOLD_MS = int(os.getenv("LOOP_LAG_THRESHOLD_MS", 250))
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round((len(values) - 1) * p / 100)))]
+
+class LoopWatchdog:
+    """Measures event-loop lag and catches whatever is blocking the loop.
+    
+    A heartbeat coroutine records how late each tick fires. A watcher thread
+    checks the heartbeat and, once the loop has been stuck for longer than
+    LOOP_LAG_THRESHOLD_MS, logs the loop thread's stack while the blocking
+    call is still running and counts the innermost frame of our own code.
+    """
+    
+    def __init__(self, interval=LOOP_LAG_INTERVAL, threshold_ms=LOOP_LAG_THRESHOLD_MS, window=3000):
+        self.interval = interval
+        self.threshold = threshold_ms / 1000
+        self.samples = deque(maxlen=window)
+        self._samples_lock = threading.Lock()  # appended on the loop, copied from the /metrics thread
+        self.stalls = 0
+        self._beat = time.monotonic()
+        self._loop_thread = None
+        self._task: Optional[asyncio.Task] = None
+        self.lag = metrics.histogram('groovia_loop_lag_seconds', 'Event loop scheduling delay')
+        self.blocked = metrics.counter('groovia_loop_blocked_total', 'Loop stalls over threshold by code location', ['site'])
+        metrics.gauge('groovia_loop_lag_ms', 'Recent event loop lag percentiles',
+                      lambda: {f"p{p}": v for p, v in self.percentiles().items()}, ['quantile'])
+    
+    def start(self):
+        if self._task is None:
+            self._loop_thread = threading.get_ident()
+            self._beat = time.monotonic()
+            self._task = background(self._heartbeat())
+            threading.Thread(target=self._watch, daemon=True, name="loop-watchdog").start()
+    
+    async def _heartbeat(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            t = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - t - self.interval)
+            with self._samples_lock:
+                self.samples.append(lag)
+            self.lag.observe(lag)
+            self._beat = time.monotonic()
+    
+    def _watch(self):
+        reported = None
+        while True:
+            time.sleep(self.interval / 2)
+            beat = self._beat
+            stuck = time.monotonic() - beat - self.interval
+            if stuck < self.threshold or reported == beat:
+                continue
+            reported = beat
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame)
+            site = self._site(stack)
+            self.stalls += 1
+            self.blocked.inc(site)
+            logger.warning(f"🧊 Event loop blocked {stuck * 1000:.0f}ms+ at {site}\n" +
+                           ''.join(traceback.format_list(stack[-10:])))
+    
+    @staticmethod
+    def _site(stack):
+        """Innermost frame in this file, else the innermost frame overall"""
+        here = os.path.abspath(__file__)
+        for fs in reversed(stack):
+            if os.path.abspath(fs.filename) == here:
+                return f"{fs.name}:{fs.lineno}"
+        fs = stack[-1]
+        return f"{os.path.basename(fs.filename)}:{fs.name}:{fs.lineno}"
+    
+    def recent(self):
+        with self._samples_lock:
+            return list(self.samples)
+    
+    def percentiles(self):
+        vals = self.recent()
+        return {p: percentile(vals, p) * 1000 for p in (50, 95, 99)}
+
+watchdog = LoopWatchdog()
+
+# ==================== PROFILER ====================
+PROFILE_DIR = os.getenv("PROFILE_DIR", "cache/profiles")
+PROFILE_MAX_SECONDS = 300
+
+# Leaf frames of threads that are parked, not working; kept in the file, left out of the summary
+IDLE_FRAMES = {'threading.py:wait', 'threading.py:_wait_for_tstate_lock', 'selectors.py:select',
+               'thread.py:_worker', 'queue.py:get'}
+
+class SamplingProfiler:
+    """Timed sampling profiler that admins can start from chat.
+    
+    cpu:  SIGPROF fires every `interval` of process CPU time and samples the
+          main (event loop) thread where it was interrupted.
+    wall: a sampler thread snapshots every thread's stack every `interval`
+          of wall-clock time, so waits and to_thread workers show up too.
+    
+    Stacks are written in collapsed format (`frame;frame;frame count`), which
+    flamegraph.pl, speedscope and inferno read directly.
+    """
+    
+    def __init__(self, interval=0.005, out_dir=PROFILE_DIR):
+        self.interval = interval
+        self.out_dir = out_dir
+        self.stacks: Dict[str, int] = defaultdict(int)
+        self.mode = None
+        self.samples = 0
+        self.started = 0.0
+        self._stop = threading.Event()
+        self._prev_handler = None
+        self._task: Optional[asyncio.Task] = None
+    
+    @property
+    def running(self):
+        return self.mode is not None
+    
+    @staticmethod
+    def _label(code):
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+    
+    def _add(self, thread, frame):
+        names = []
+        while frame is not None:
+            names.append(self._label(frame.f_code))
+            frame = frame.f_back
+        names.append(thread)
+        self.stacks[';'.join(reversed(names))] += 1
+        self.samples += 1
+    
+    def _on_sigprof(self, signum, frame):
+        if frame is not None:
+            self._add(threading.main_thread().name, frame)
+    
+    def _sample_threads(self):
+        me = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident != me:
+                    self._add(names.get(ident) or f"thread-{ident}", frame)
+    
+    def start(self, mode):
+        if self.running:
+            raise RuntimeError(f"A {self.mode} profile is already running")
+        self.stacks = defaultdict(int)
+        self.samples = 0
+        self._stop.clear()
+        if mode == 'cpu' and (not hasattr(signal, 'setitimer') or threading.current_thread() is not threading.main_thread()):
+            logger.warning("CPU profiling needs SIGPROF on the main thread; falling back to wall mode")
+            mode = 'wall'
+        if mode == 'cpu':
+            self._prev_handler = signal.signal(signal.SIGPROF, self._on_sigprof)
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        else:
+            threading.Thread(target=self._sample_threads, daemon=True, name="profiler").start()
+        self.mode = mode
+        self.started = time.monotonic()
+        logger.info(f"🔬 {mode} profile started")
+        return mode
+    
+    def stop(self):
+        """Stop sampling and write the collapsed stacks; returns the file path"""
+        if self.mode == 'cpu':
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            signal.signal(signal.SIGPROF, self._prev_handler or signal.SIG_DFL)
+        self._stop.set()
+        mode, self.mode = self.mode, None
+        os.makedirs(self.out_dir, exist_ok=True)
+        path = os.path.join(self.out_dir, f"profile-{mode}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.collapsed")
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, n in sorted(self.stacks.items(), key=lambda kv: -kv[1]):
+                f.write(f"{stack} {n}\n")
+        logger.info(f"🔬 {mode} profile stopped: {self.samples} samples -> {path}")
+        return path
+    
+    def top(self, n=15):
+        """Hottest functions by self and inclusive samples, ignoring parked threads"""
+        own: Dict[str, int] = defaultdict(int)
+        total: Dict[str, int] = defaultdict(int)
+        busy = 0
+        for stack, count in list(self.stacks.items()):
+            frames = stack.split(';')[1:]
+            if not frames:
+                continue
+            leaf = frames[-1]
+            name, _, loc = leaf.partition(' (')
+            if f"{loc.split(':')[0]}:{name}" in IDLE_FRAMES:
+                continue
+            busy += count
+            own[leaf] += count
+            for fr in set(frames):
+                total[fr] += count
+        by = lambda d: sorted(d.items(), key=lambda kv: -kv[1])[:n]
+        return busy, by(own), by(total)
+    
+    async def run(self, mode, seconds):
+        mode = self.start(mode)
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            path = self.stop()
+        return mode, path
+
+profiler = SamplingProfiler()
+
+# ==================== LIVE STATS ====================
+LIVE_WINDOW = 300
+LIVE_STEP = 5
+
+def rss_mb():
+    """Resident set size of this process in MB"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    except ImportError:
+        return 0.0
+
+class RollingCounter:
+    """Sum over the last `window` seconds kept in `step`-second buckets.
+    
+    Expired buckets are subtracted from a running total as time moves on,
+    so both add() and sum() are O(1) amortised.
+    """
+    
+    def __init__(self, window=LIVE_WINDOW, step=LIVE_STEP):
+        self.window = window
+        self.step = step
+        self.n = max(1, window // step)
+        self.buckets = [0.0] * self.n
+        self.total = 0.0
+        self._tick = int(time.monotonic() // step)
+        self._lock = threading.Lock()
+    
+    def _advance(self):
+        now = int(time.monotonic() // self.step)
+        gap = now - self._tick
+        if gap <= 0:
+            return
+        if gap >= self.n:
+            self.buckets = [0.0] * self.n
+            self.total = 0.0
+        else:
+            for i in range(1, gap + 1):
+                j = (self._tick + i) % self.n
+                self.total -= self.buckets[j]
+                self.buckets[j] = 0.0
+        self._tick = now
+    
+    def add(self, v=1):
+        with self._lock:
+            self._advance()
+            self.buckets[self._tick % self.n] += v
+            self.total += v
+    
+    def sum(self):
+        with self._lock:
+            self._advance()
+            return max(0.0, self.total)
+
+class ActiveUsers:
+    """Distinct users seen in the last `window` seconds (insertion-ordered by last activity)"""
+    
+    def __init__(self, window):
+        self.window = window
+        self._seen: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def touch(self, uid, now):
+        with self._lock:
+            self._seen.pop(uid, None)
+            self._seen[uid] = now
+            self._expire(now)
+    
+    def _expire(self, now):
+        while self._seen:
+            uid, ts = next(iter(self._seen.items()))
+            if now - ts <= self.window:
+                break
+            self._seen.popitem(last=False)
+    
+    def count(self):
+        with self._lock:
+            self._expire(time.monotonic())
+            return len(self._seen)
+
+class LiveStats:
+    """Rolling-window numbers behind /sysstats.
+    
+    Handlers feed the counters as work happens and a background task
+    snapshots the cumulative cache counters every LIVE_STEP seconds, so
+    rendering the dashboard never walks any data.
+    """
+    
+    def __init__(self, window=LIVE_WINDOW):
+        self.window = window
+        self.started = time.monotonic()
+        self.updates = RollingCounter(window)
+        self.active = {5: ActiveUsers(300), 60: ActiveUsers(3600)}
+        self.api_calls = RollingCounter(window)
+        self.api_errors = RollingCounter(window)
+        self.downloads = RollingCounter(window)
+        self.download_bytes = RollingCounter(window)
+        self.download_seconds = RollingCounter(window)
+        self.cache_snaps = deque(maxlen=window // LIVE_STEP + 1)
+        self._task: Optional[asyncio.Task] = None
+    
+    def request(self, uid):
+        self.updates.add()
+        if uid is not None:
+            now = time.monotonic()
+            for a in self.active.values():
+                a.touch(uid, now)
+    
+    def upstream(self, ok):
+        self.api_calls.add()
+        if not ok:
+            self.api_errors.add()
+    
+    def download(self, size, seconds):
+        self.downloads.add()
+        self.download_bytes.add(size)
+        self.download_seconds.add(seconds)
+    
+    def span(self):
+        """Seconds the windows actually cover (less than `window` right after start)"""
+        return max(1.0, min(self.window, time.monotonic() - self.started))
+    
+    def cache_rates(self):
+        """Hit ratio per cache over the window, from the oldest and newest snapshots"""
+        if len(self.cache_snaps) < 2:
+            return {}
+        old, new = self.cache_snaps[0][1], self.cache_snaps[-1][1]
+        out = {}
+        for name, (h, m) in new.items():
+            h0, m0 = old.get(name, (0, 0))
+            dh, dm = h - h0, m - m0
+            out[name] = (dh / (dh + dm) if dh + dm else None, dh + dm)
+        return out
+    
+    def start(self):
+        if self._task is None:
+            self._task = background(self._loop())
+    
+    async def _loop(self):
+        while True:
+            try:
+                self.cache_snaps.append((time.monotonic(), _cache_stats()))
+            except Exception as e:
+                logger.warning(f"Live stats refresh failed: {e}")
+            await asyncio.sleep(LIVE_STEP)
+
+live = LiveStats()
+
 # ==================== NEW: LYRICS SEARCH ====================
 class LyricsDetector:
     """Detect song name from lyrics using YouTube Search (Most Reliable!)"""
@@ -77,15 +794,18 @@ class LyricsDetector:
             song_name = LyricsDetector._youtube_search(clean_query)
             if song_name:
                 logger.info(f"✅ Found via YouTube: {song_name}")
+                metrics.lyrics_outcomes.inc('youtube')
                 return song_name
             
             # Method 2: Fallback - first few words
             keywords = ' '.join(clean_query.split()[:6])
             logger.info(f"🔄 Fallback search: {keywords}")
+            metrics.lyrics_outcomes.inc('fallback')
             return keywords  # Always return something!
             
         except Exception as e:
             logger.error(f"Search error: {e}")
+            metrics.lyrics_outcomes.inc('error')
             # Always return fallback
             return ' '.join(lyrics_query.split()[:6])
     
@@ -242,67 +962,858 @@ class LyricsDetector:
         # Need at least 2 matches
         if match_count >= 2:
             logger.info(f"✅ Lyrics detected ({match_count} matches): {text[:50]}...")
+            metrics.lyrics_outcomes.inc('detected')
             return True
         
         logger.info(f"❌ Not lyrics ({match_count} matches): {text[:50]}...")
+        metrics.lyrics_outcomes.inc('not_lyrics')
         return False
 
 lyrics_detector = LyricsDetector()
 # ==================== END NEW CODE ====================
 
-class DataStore:
+# ==================== SHARED STATE ====================
+class LocalState:
+    """In-process state for a single worker.
+    
+    Values are kept as live objects, counters are plain ints and locks are
+    per-name RLocks. Handlers run on the one event-loop thread and their
+    read-modify-write never awaits, so the locks don't order handlers
+    against each other; they keep the threaded ledger evictions and
+    compaction from interleaving with a handler's update. publish() is a
+    no-op since there is nobody to tell.
+    """
+    
+    shared = False
+    
     def __init__(self):
-        self.user_searches: Dict[int, Dict] = {}
-        self.user_favorites: Dict[int, List] = defaultdict(list)
-        self.user_history: Dict[int, List] = defaultdict(list)
-        self.user_playlists: Dict[int, Dict[str, List]] = defaultdict(dict)
-        self.global_downloads = 0
-        self.global_searches = 0
-        self.user_stats: Dict[int, Dict] = defaultdict(lambda: {
-            'searches': 0, 'downloads': 0, 'favorites': 0,
-            'first_seen': datetime.now().isoformat(), 'last_active': datetime.now().isoformat(),
-            'awaiting_playlist': False
-        })
-        self.user_settings: Dict[int, Dict] = defaultdict(lambda: {
-            'quality': '160kbps', 'language': 'hindi', 'notifications': True
-        })
+        self._kv: Dict[str, object] = {}
+        self._expiry: Dict[str, float] = {}
+        self._counters: Dict[str, int] = defaultdict(int)
+        self._locks: Dict[str, threading.RLock] = defaultdict(threading.RLock)
+        self._guard = threading.Lock()
+    
+    def get(self, key, default=None):
+        exp = self._expiry.get(key)
+        if exp is not None and exp < time.time():
+            self.delete(key)
+            return default
+        return self._kv.get(key, default)
+    
+    def set(self, key, value, ttl=None):
+        self._kv[key] = value
+        if ttl:
+            self._expiry[key] = time.time() + ttl
+        else:
+            self._expiry.pop(key, None)
+    
+    def delete(self, key):
+        self._kv.pop(key, None)
+        self._expiry.pop(key, None)
+    
+    def keys(self, prefix):
+        return [k for k in list(self._kv) if k.startswith(prefix)]
+    
+    def incr(self, key, n=1):
+        with self._guard:
+            self._counters[key] += n
+            return self._counters[key]
+    
+    def counter(self, key):
+        return self._counters.get(key, 0)
+    
+    def lock(self, name, timeout=10):
+        with self._guard:
+            return self._locks[name]
+    
+    def claim(self, name, ttl):
+        """Run-once lease; always granted in a single process"""
+        return True
+    
+    def publish(self, channel, msg):
+        pass
+    
+    def subscribe(self, callback):
+        pass
+
+class RedisLock:
+    """SET NX PX lock released with WATCH/MULTI, so it needs no Lua scripting"""
+    
+    def __init__(self, r, key, timeout):
+        self.r = r
+        self.key = key
+        self.timeout = timeout
+        self.token = None
+    
+    def __enter__(self):
+        token = f"{os.getpid()}-{random.getrandbits(64):016x}"
+        deadline = time.time() + self.timeout
+        while not self.r.set(self.key, token, nx=True, px=int(self.timeout * 1000)):
+            if time.time() > deadline:
+                raise TimeoutError(f"Lock {self.key} busy")
+            time.sleep(0.01)
+        self.token = token.encode()
+        return self
+    
+    def __exit__(self, *exc):
+        with self.r.pipeline() as p:
+            try:
+                p.watch(self.key)
+                if p.get(self.key) == self.token:
+                    p.multi()
+                    p.delete(self.key)
+                    p.execute()
+                else:
+                    p.unwatch()
+            except Exception as e:
+                logger.warning(f"Lock release failed for {self.key}: {e}")
+
+class RedisState:
+    """State shared by every worker through Redis.
+    
+    Values are stored as JSON, so callers must write back anything they
+    mutate. Cache invalidations are broadcast on a pub/sub channel and
+    delivered to subscribers on every other worker. Pass client= to run
+    against a stand-in such as fakeredis.
+    """
+    
+    shared = True
+    
+    def __init__(self, url=STATE_URL, prefix=STATE_PREFIX, client=None):
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url)
+        self.r = client
+        self.prefix = prefix
+        self.worker_id = f"{os.getpid()}-{random.getrandbits(32):08x}"
+        self._subs = []
+        self._listener: Optional[threading.Thread] = None
+    
+    def _k(self, key):
+        return self.prefix + key
+    
+    def get(self, key, default=None):
+        raw = self.r.get(self._k(key))
+        return json.loads(raw) if raw is not None else default
+    
+    def set(self, key, value, ttl=None):
+        self.r.set(self._k(key), json.dumps(value, ensure_ascii=False), ex=ttl)
+    
+    def delete(self, key):
+        self.r.delete(self._k(key))
+    
+    def keys(self, prefix):
+        n = len(self.prefix)
+        return [k.decode()[n:] for k in self.r.scan_iter(match=self._k(prefix) + '*', count=500)]
+    
+    def incr(self, key, n=1):
+        return self.r.incrby(self._k('n:' + key), n)
+    
+    def counter(self, key):
+        return int(self.r.get(self._k('n:' + key)) or 0)
+    
+    def lock(self, name, timeout=10):
+        return RedisLock(self.r, self._k('lock:' + name), timeout)
+    
+    def claim(self, name, ttl):
+        """Run-once lease across workers (SET NX EX)"""
+        return bool(self.r.set(self._k('claim:' + name), self.worker_id, nx=True, ex=ttl))
+    
+    def publish(self, channel, msg):
+        self.r.publish(self._k(channel), json.dumps({'from': self.worker_id, 'msg': msg}))
+    
+    def subscribe(self, callback):
+        """callback(channel, msg) for messages published by other workers"""
+        self._subs.append(callback)
+        if self._listener is None:
+            self._listener = threading.Thread(target=self._listen, daemon=True)
+            self._listener.start()
+    
+    def _listen(self):
+        n = len(self.prefix)
+        while True:
+            try:
+                ps = self.r.pubsub(ignore_subscribe_messages=True)
+                ps.psubscribe(self._k('*'))
+                for m in ps.listen():
+                    data = json.loads(m['data'])
+                    if data.get('from') == self.worker_id:
+                        continue
+                    channel = m['channel'].decode()[n:]
+                    for cb in self._subs:
+                        try: cb(channel, data.get('msg'))
+                        except Exception as e: logger.warning(f"Invalidation handler error: {e}")
+            except Exception as e:
+                logger.error(f"State subscription lost: {e}")
+                time.sleep(2)
+
+def create_state():
+    if STATE_URL:
+        logger.info(f"🔗 Shared state: {STATE_URL.split('@')[-1]}")
+        return RedisState(STATE_URL)
+    return LocalState()
+
+state = create_state()
+
+_state_pool = ThreadPoolExecutor(STATE_IO_THREADS, thread_name_prefix='state')
+
+async def off_loop(fn, *args):
+    """Run fn(*args) on the state pool, whichever state is configured"""
+    return await asyncio.get_running_loop().run_in_executor(_state_pool, functools.partial(fn, *args))
+
+async def state_io(fn, *args):
+    """Call fn(*args) without blocking the loop on a shared-state round trip.
+    
+    With Redis every read, write and lock wait is network I/O, so it runs on
+    a small pool of its own rather than queueing behind downloads in the
+    default executor. The local state is a dict lookup and runs inline.
+    """
+    if not state.shared:
+        return fn(*args)
+    return await off_loop(fn, *args)
+
+def approx_size(obj):
+    """Rough byte size of a JSON-like object (dicts, lists, strings, numbers)"""
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(approx_size(k) + approx_size(v) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return sys.getsizeof(obj) + sum(approx_size(v) for v in obj)
+    return sys.getsizeof(obj)
+
+class MemoryLedger:
+    """Approximate bytes held per DataStore structure and per user.
+    
+    Structures report each record's size (or the change in it) as they
+    write it, so totals are kept up to date incrementally instead of by
+    walking the data. Going over a budget logs a (rate-limited) warning
+    straight away; with MEM_BUDGET_ACTION=evict, a periodic pass then calls
+    the evictors registered for disposable structures (sessions, history),
+    oldest writes first. A user is only trimmed when those structures are
+    what put them over: if favorites and playlists alone exceed the budget,
+    eviction can't help and the overrun is just reported. With a shared
+    state the figures cover the records this worker has written.
+    """
+    
+    def __init__(self, table_budget=MEM_TABLE_BUDGET, user_budget=MEM_USER_BUDGET, action=MEM_BUDGET_ACTION):
+        self.table_budget = table_budget
+        self.user_budget = user_budget
+        self.action = action
+        self._entries: Dict[str, OrderedDict] = defaultdict(OrderedDict)  # structure -> uid -> bytes, oldest write first
+        self.bytes: Dict[str, int] = defaultdict(int)
+        self.user_bytes: Dict[int, int] = defaultdict(int)
+        self._evictors: List[tuple] = []  # (structure, evict(uid) -> bool, runs_in_thread)
+        self._over_tables = set()
+        self._over_users = set()
+        self._warned: Dict[str, float] = {}
+        self._lock = threading.RLock()
+        self._task: Optional[asyncio.Task] = None
+        self.evictions = metrics.counter('groovia_datastore_evictions_total', 'Records trimmed to stay within memory budgets', ['structure', 'budget'])
+        self.warnings = metrics.counter('groovia_datastore_budget_warnings_total', 'Memory budget overruns reported', ['budget'])
+        metrics.gauge('groovia_datastore_bytes', 'Approximate bytes per DataStore structure', self.sizes, ['structure'])
+        metrics.gauge('groovia_datastore_records', 'Records per DataStore structure', self.records, ['structure'])
+    
+    def register(self, name, evict, threaded=True):
+        """evict(uid) frees what it can of one user's record and returns True if anything went"""
+        self._evictors.append((name, evict, threaded))
+    
+    def adjust(self, name, uid, delta):
+        """Apply a size change to a record already on the books; False if it isn't"""
+        with self._lock:
+            old = self._entries[name].get(uid)
+            if old is None:
+                return False
+            self.update(name, uid, max(0, old + delta))
+        return True
+    
+    def update(self, name, uid, size):
+        with self._lock:
+            entries = self._entries[name]
+            old = entries.pop(uid, 0)
+            entries[uid] = size
+            self.bytes[name] += size - old
+            self.user_bytes[uid] += size - old
+            over_table = self.bytes[name] > self.table_budget
+            over_user = self.user_bytes[uid] > self.user_budget
+            if over_table:
+                self._over_tables.add(name)
+            if over_user:
+                self._over_users.add(uid)
+        if over_table:
+            self._warn(f"table:{name}", 'table', f"{name} holds {self.bytes[name] / 1024 ** 2:.1f}MB "
+                                                 f"(budget {self.table_budget / 1024 ** 2:.0f}MB)")
+        if over_user:
+            self._warn(f"user:{uid}", 'user', f"user {uid} holds {self.user_bytes[uid] / 1024:.0f}KB "
+                                              f"(budget {self.user_budget / 1024:.0f}KB)")
+    
+    def forget(self, name, uid):
+        with self._lock:
+            old = self._entries[name].pop(uid, None)
+            if old is None:
+                return
+            self.bytes[name] -= old
+            left = self.user_bytes[uid] - old
+            if left > 0:
+                self.user_bytes[uid] = left
+            else:
+                self.user_bytes.pop(uid, None)
+    
+    # Read from the /metrics thread while handlers write, so each takes its snapshot under the lock
+    def sizes(self):
+        with self._lock:
+            return dict(self.bytes)
+    
+    def records(self):
+        with self._lock:
+            return {name: len(entries) for name, entries in self._entries.items()}
+    
+    def total(self):
+        with self._lock:
+            return sum(self.bytes.values())
+    
+    def _warn(self, key, budget, text):
+        now = time.monotonic()
+        if now - self._warned.get(key, -MEM_WARN_INTERVAL) < MEM_WARN_INTERVAL:
+            return
+        self._warned[key] = now
+        self.warnings.inc(budget)
+        logger.warning(f"🧠 Memory budget exceeded: {text}")
+    
+    def start(self):
+        if self._task is None and self.action == 'evict':
+            self._task = background(self._loop())
+    
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(MEM_ENFORCE_INTERVAL)
+            try:
+                await self.enforce()
+            except Exception as e:
+                logger.warning(f"Memory enforcement failed: {e}")
+    
+    async def _evict(self, name, evict, threaded, uid, budget):
+        done = await asyncio.to_thread(evict, uid) if threaded else evict(uid)
+        if done:
+            self.evictions.inc(name, budget)
+        return done
+    
+    async def enforce(self):
+        """Trim disposable data until over-budget users and structures fit again"""
+        with self._lock:
+            users, self._over_users = self._over_users, set()
+            tables, self._over_tables = self._over_tables, set()
+        disposable = [name for name, _, _ in self._evictors]
+        for uid in users:
+            with self._lock:
+                kept = self.user_bytes.get(uid, 0) - sum(self._entries[n].get(uid, 0) for n in disposable)
+            if kept > self.user_budget:
+                continue  # over on favorites/playlists alone; trimming history would lose data and fix nothing
+            for name, evict, threaded in self._evictors:
+                if self.user_bytes.get(uid, 0) <= self.user_budget:
+                    break
+                await self._evict(name, evict, threaded, uid, 'user')
+        for table in tables:
+            for name, evict, threaded in self._evictors:
+                if name != table:
+                    continue
+                for uid in list(self._entries[name]):
+                    if self.bytes[name] <= self.table_budget:
+                        break
+                    await self._evict(name, evict, threaded, uid, 'table')
+            if self.bytes[table] > self.table_budget:
+                logger.warning(f"🧠 {table} still over budget after eviction ({self.bytes[table] / 1024 ** 2:.1f}MB)")
+
+ledger = MemoryLedger()
+
+def song_ids(songs):
+    return [s.get('songid') or s.get('id', '') for s in songs or []]
+
+def order_key(songs):
+    """Short fingerprint of which songs a list holds and in what order"""
+    return hashlib.sha1('\x1f'.join(song_ids(songs)).encode()).hexdigest()[:12]
+
+def restore_order(songs, ids):
+    """songs with every id back at its old index and new songs after them, or None if one is gone"""
+    by_id = {sid: s for sid, s in zip(song_ids(songs), songs)}
+    if any(sid not in by_id for sid in ids):
+        return None
+    old = set(ids)
+    return [by_id[sid] for sid in ids] + [s for sid, s in zip(song_ids(songs), songs) if sid not in old]
+
+class SessionStore:
+    """Per-user result sessions with idle TTL and a global memory budget.
+    
+    Sessions are kept in LRU order; idle ones expire after SESSION_TTL and the
+    least recently used are evicted once SESSION_BUDGET bytes are exceeded.
+    Dropped sessions leave a small note ('q', 'shelf' and an order
+    fingerprint) so the query can be re-run when the user taps an old button.
+    Stored sessions are snapshots, so their measured size stays true.
+    """
+    
+    def __init__(self, ttl=SESSION_TTL, max_bytes=SESSION_BUDGET, max_expired=SESSION_MAX_EXPIRED):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_expired = max_expired
+        self._data: OrderedDict = OrderedDict()     # uid -> [last_used, size, session]
+        self._expired: OrderedDict = OrderedDict()  # uid -> {'q': ..., 'shelf': ...}
+        self.total_bytes = 0
+        self.expirations = 0
+        self.evictions = 0
+    
+    def _drop(self, uid):
+        _, size, sess = self._data.pop(uid)
+        self.total_bytes -= size
+        ledger.forget('user_searches', uid)
+        self._expired[uid] = {k: sess[k] for k in ('q', 'shelf') if k in sess}
+        self._expired[uid]['order'] = order_key(sess.get('songs'))
+        self._expired.move_to_end(uid)
+        while len(self._expired) > self.max_expired:
+            self._expired.popitem(last=False)
+    
+    def _sweep(self):
+        cutoff = time.time() - self.ttl
+        while self._data:
+            uid, item = next(iter(self._data.items()))
+            if item[0] >= cutoff:
+                break
+            self._drop(uid)
+            self.expirations += 1
+    
+    def __len__(self):
+        return len(self._data)
+    
+    def __contains__(self, uid):
+        self._sweep()
+        return uid in self._data
+    
+    def get(self, uid, default=None):
+        self._sweep()
+        item = self._data.get(uid)
+        if item is None:
+            return default
+        item[0] = time.time()
+        self._data.move_to_end(uid)
+        return item[2]
+    
+    def __getitem__(self, uid):
+        sess = self.get(uid)
+        if sess is None:
+            raise KeyError(uid)
+        return sess
+    
+    def __setitem__(self, uid, sess):
+        if uid in self._data:
+            self.total_bytes -= self._data.pop(uid)[1]
+        sess = copy.deepcopy(sess)  # a caller changing its copy later can't grow it past its measured size
+        size = approx_size(sess)
+        self._data[uid] = [time.time(), size, sess]
+        self.total_bytes += size
+        ledger.update('user_searches', uid, size)
+        self._expired.pop(uid, None)
+        while self.total_bytes > self.max_bytes and len(self._data) > 1:
+            self._drop(next(iter(self._data)))
+            self.evictions += 1
+    
+    def expired(self, uid):
+        """Re-run info for a user whose session was dropped, if any"""
+        return self._expired.get(uid)
+    
+    def discard(self, uid):
+        """Drop one user's session early (it can still be re-run from the note)"""
+        if uid not in self._data:
+            return False
+        self._drop(uid)
+        self.evictions += 1
+        return True
+
+class ResultCache:
+    """Result sets addressed by a short key carried in callback_data.
+    
+    Recent sets stay in memory; every set is written through to SQLite (or
+    to the shared state when one is configured) so a restarted worker, or
+    any other worker, can still serve old buttons.
+    """
+    
+    def __init__(self, path=RESULTS_DB, ttl=RESULTS_TTL, mem_max=RESULTS_MEM_MAX, shared=None):
+        self.ttl = ttl
+        self.mem_max = mem_max
+        self._mem: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self.shared = shared
+        if shared is not None:
+            shared.subscribe(self._on_invalidate)
+    
+    def _ensure(self):
+        """Open (and prune) the SQLite file on first use rather than at import"""
+        with self._lock:
+            if self._conn is None:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                self._conn = sqlite3.connect(self.path, check_same_thread=False)
+                self._conn.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, data TEXT, ts REAL)")
+                self._prune()
+                self._conn.commit()
+    
+    @staticmethod
+    def make_key(*parts):
+        """8-char url-safe key hashed from the given parts"""
+        h = hashlib.sha1('\x1f'.join(str(p) for p in parts).encode()).digest()
+        return base64.urlsafe_b64encode(h[:6]).decode()
+    
+    @staticmethod
+    def _note(sess):
+        """What it takes to re-run a set: the query, where it came from and its song order"""
+        note = {k: sess[k] for k in ('q', 'shelf', 'type') if k in sess}
+        note['ids'] = sess['ids'] if 'ids' in sess else song_ids(sess.get('songs'))
+        return note
+    
+    def _prune(self):
+        """Shrink expired sets to their note, and drop notes past RESULTS_NOTE_TTL"""
+        now = time.time()
+        self._conn.execute("DELETE FROM results WHERE ts < ?", (now - RESULTS_NOTE_TTL,))
+        self._conn.execute("""UPDATE results SET data = json_object('q', json_extract(data, '$.q'),
+            'shelf', json_extract(data, '$.shelf'), 'type', json_extract(data, '$.type'),
+            'ids', (SELECT json_group_array(COALESCE(NULLIF(json_extract(value, '$.songid'), ''),
+                                                     json_extract(value, '$.id'), ''))
+                    FROM json_each(data, '$.songs')), 'expired', 1)
+            WHERE ts < ? AND json_extract(data, '$.expired') IS NULL""", (now - self.ttl,))
+    
+    def _remember(self, key, sess):
+        self._mem[key] = sess
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.mem_max:
+            self._mem.popitem(last=False)
+    
+    def _on_invalidate(self, channel, msg):
+        if channel == 'invalidate' and msg.get('ns') == 'res':
+            with self._lock:
+                self._mem.pop(msg.get('key'), None)
+    
+    def put(self, key, sess):
+        """Store a snapshot of sess; later in-place changes by the caller don't reach it"""
+        sess = copy.deepcopy(sess)
+        stored = dict(sess)
+        if isinstance(stored.get('col'), dict):
+            stored['col'] = {k: v for k, v in stored['col'].items() if k != 'songs'}
+        if self.shared is not None:
+            with self._lock:
+                self._remember(key, sess)
+            self.shared.set(f"res:{key}", stored, ttl=self.ttl)
+            self.shared.set(f"resq:{key}", self._note(sess), ttl=RESULTS_NOTE_TTL)
+            self.shared.publish('invalidate', {'ns': 'res', 'key': key})
+            return
+        self._ensure()
+        with self._lock:
+            self._remember(key, sess)
+            self._conn.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?)",
+                               (key, json.dumps(stored, ensure_ascii=False), time.time()))
+            self._writes += 1
+            if self._writes % 500 == 0:  # every set has its own row now, so expire them as we go
+                self._prune()
+            self._conn.commit()
+    
+    def get(self, key):
+        if self.shared is None:
+            self._ensure()
+        with self._lock:
+            sess = self._mem.get(key)
+            if sess is not None:
+                self._mem.move_to_end(key)
+                self.hits += 1
+                return sess
+            if self.shared is not None:
+                sess = self.shared.get(f"res:{key}")
+                if sess is None:
+                    self.misses += 1
+                    return None
+                self._remember(key, sess)
+                self.hits += 1
+                return sess
+            row = self._conn.execute("SELECT data, ts FROM results WHERE key = ?", (key,)).fetchone()
+            if not row or time.time() - row[1] > self.ttl:
+                self.misses += 1
+                return None
+            sess = json.loads(row[0])
+            self._remember(key, sess)
+            self.hits += 1
+            return sess
+    
+    def expired(self, key):
+        """Note ({'q', 'shelf', 'type', 'ids'}) of a set that has expired, or None"""
+        if self.shared is not None:
+            note = self.shared.get(f"resq:{key}")
+        else:
+            self._ensure()
+            with self._lock:
+                row = self._conn.execute("SELECT data FROM results WHERE key = ?", (key,)).fetchone()
+            note = self._note(json.loads(row[0])) if row else None
+        return {k: v for k, v in note.items() if v is not None} if note else None
+
+results = ResultCache(shared=state if state.shared else None)
+
+def cb_encode(data, key=None):
+    """callback_data for a result-set button: '<data>~<version><key>'"""
+    if not key:
+        return data
+    out = f"{data}~{CB_VERSION}{key}"
+    if len(out.encode()) > 64:
+        # Buttons must stay short enough for their key; falling back to the current session is the old bug
+        logger.warning(f"callback_data too long for a result key: {data[:40]}")
+        return data
+    return out
+
+def cb_decode(data):
+    """Split callback_data into (legacy-style data, result key or None)"""
+    head, sep, tail = data.rpartition('~')
+    if sep and len(tail) == 9 and tail[0] == CB_VERSION and re.fullmatch(r'[A-Za-z0-9_-]{8}', tail[1:]):
+        return head, tail[1:]
+    return data, None
+
+class UserTable:
+    """One per-user DataStore structure, kept in the state under '<name>:<uid>'.
+    
+    Reading a missing user returns a fresh default without storing it;
+    records only come into being when written with table[uid] = value.
+    With a shared state the value returned is a copy, so anything changed
+    must be written back the same way. `empty(value)` says whether a record
+    carries nothing worth keeping, for compaction.
+    """
+    
+    def __init__(self, state, name, factory, label=None, empty=None):
+        self.state = state
+        self.name = name
+        self.factory = factory
+        self.label = label or name
+        self.empty = empty or (lambda v: v == factory())
+    
+    def _key(self, uid):
+        return f"{self.name}:{uid}"
+    
+    def get(self, uid, default=None):
+        """Stored record or `default`; never builds the factory default"""
+        v = self.state.get(self._key(uid))
+        return default if v is None else v
+    
+    def __getitem__(self, uid):
+        v = self.state.get(self._key(uid))
+        return self.factory() if v is None else v
+    
+    def __setitem__(self, uid, value):
+        self.put(uid, value)
+    
+    def put(self, uid, value, delta=None):
+        """Write a record; a caller that knows how many bytes it added (or
+        removed, negative) passes `delta` so the whole record isn't re-measured"""
+        self.state.set(self._key(uid), value)
+        if delta is None or not ledger.adjust(self.label, uid, delta):
+            ledger.update(self.label, uid, approx_size(value))
+    
+    def __delitem__(self, uid):
+        self.state.delete(self._key(uid))
+        ledger.forget(self.label, uid)
+    
+    def __contains__(self, uid):
+        return self.state.get(self._key(uid)) is not None
+    
+    def __len__(self):
+        return len(self.state.keys(self.name + ':'))
+    
+    async def load(self, uid):
+        """table[uid] from a handler"""
+        return await state_io(self.__getitem__, uid)
+    
+    async def aget(self, uid, default=None):
+        """table.get(uid, default) from a handler"""
+        return await state_io(self.get, uid, default)
+    
+    async def adelete(self, uid):
+        await state_io(self.__delitem__, uid)
+    
+    def uids(self):
+        n = len(self.name) + 1
+        return [int(k[n:]) if k[n:].lstrip('-').isdigit() else k[n:] for k in self.state.keys(self.name + ':')]
+
+def new_stats():
+    return {
+        'searches': 0, 'downloads': 0, 'favorites': 0,
+        'first_seen': datetime.now().isoformat(), 'last_active': datetime.now().isoformat(),
+        'awaiting_playlist': False
+    }
+
+def new_settings():
+    return {'quality': '160kbps', 'language': 'hindi', 'notifications': True}
+
+def stats_empty(st, cutoff=None):
+    """Stats worth dropping: no activity counted and not seen since `cutoff` (ISO time)"""
+    if st.get('searches') or st.get('downloads') or st.get('favorites') or st.get('awaiting_playlist'):
+        return False
+    return cutoff is None or st.get('last_active', '') < cutoff
+
+class DataStore:
+    def __init__(self, state):
+        self.state = state
+        self.user_searches = SessionStore()
+        self.user_favorites = UserTable(state, 'fav', list, 'user_favorites')
+        self.user_history = UserTable(state, 'hist', list, 'user_history')
+        self.user_playlists = UserTable(state, 'pl', dict, 'user_playlists')
+        self.user_stats = UserTable(state, 'stats', new_stats, 'user_stats', empty=stats_empty)
+        self.user_settings = UserTable(state, 'set', new_settings, 'user_settings')
+        # Only disposable data is evicted; favorites, playlists and settings are just reported
+        ledger.register('user_searches', self.user_searches.discard, threaded=False)
+        ledger.register('user_history', self.shed_history)
+        self.compacted = metrics.counter('groovia_datastore_compacted_total', 'Empty user records dropped by compaction', ['structure'])
+        self._task: Optional[asyncio.Task] = None
+    
+    @property
+    def global_downloads(self):
+        return self.state.counter('downloads')
+    
+    @property
+    def global_searches(self):
+        return self.state.counter('searches')
+    
+    def global_counts(self):
+        return self.global_downloads, self.global_searches
+    
+    def user_lock(self, uid):
+        """Serialises read-modify-write of one user's records across workers"""
+        return self.state.lock(f"user:{uid}")
+    
+    def _bump(self, uid, field):
+        with self.user_lock(uid):
+            st = self.user_stats[uid]
+            st[field] += 1
+            st['last_active'] = datetime.now().isoformat()
+            self.user_stats[uid] = st
+    
+    def record_search(self, uid):
+        self._bump(uid, 'searches')
+        self.state.incr('searches')
+    
+    def record_download(self, uid):
+        self._bump(uid, 'downloads')
+        self.state.incr('downloads')
+    
+    def set_stat(self, uid, field, value):
+        with self.user_lock(uid):
+            st = self.user_stats[uid]
+            st[field] = value
+            self.user_stats[uid] = st
+    
+    def set_setting(self, uid, field, value):
+        with self.user_lock(uid):
+            st = self.user_settings[uid]
+            st[field] = value
+            self.user_settings[uid] = st
     
     def add_to_history(self, uid, song):
         sid = song.get('songid') or song.get('id', '')
-        self.user_history[uid] = [s for s in self.user_history[uid] if (s.get('songid') or s.get('id', '')) != sid]
-        self.user_history[uid].insert(0, song)
-        self.user_history[uid] = self.user_history[uid][:100]
-        self.user_stats[uid]['last_active'] = datetime.now().isoformat()
+        with self.user_lock(uid):
+            old = self.user_history[uid]
+            hist = [s for s in old if (s.get('songid') or s.get('id', '')) != sid]
+            gone = [s for s in old if (s.get('songid') or s.get('id', '')) == sid]
+            hist.insert(0, song)
+            gone += hist[100:]
+            self.user_history.put(uid, hist[:100], approx_size(song) - sum(map(approx_size, gone)))
+            st = self.user_stats[uid]
+            st['last_active'] = datetime.now().isoformat()
+            self.user_stats[uid] = st
+    
+    def compact(self, inactive_days=COMPACT_INACTIVE_DAYS):
+        """Drop records that only hold defaults; stats also need to be inactive"""
+        cutoff = datetime.fromtimestamp(time.time() - inactive_days * 86400).isoformat()
+        dropped = 0
+        for table in (self.user_favorites, self.user_history, self.user_playlists, self.user_settings, self.user_stats):
+            for uid in table.uids():
+                with self.user_lock(uid):
+                    v = table.get(uid)
+                    if v is None:
+                        continue
+                    if table is self.user_stats:
+                        if not stats_empty(v, cutoff) or any(uid in t for t in (self.user_favorites, self.user_history, self.user_playlists)):
+                            continue
+                    elif not table.empty(v):
+                        continue
+                    del table[uid]
+                self.compacted.inc(table.label)
+                dropped += 1
+        if dropped:
+            logger.info(f"🧹 Compacted {dropped} empty user records")
+        return dropped
+    
+    def start(self):
+        if self._task is None:
+            self._task = background(self._compact_loop())
+    
+    async def _compact_loop(self):
+        while True:
+            await asyncio.sleep(COMPACT_INTERVAL)
+            # With several workers only one of them walks the keys each round
+            if not await state_io(self.state.claim, 'compact', COMPACT_INTERVAL // 2):
+                continue
+            try:
+                await asyncio.to_thread(self.compact)
+            except Exception as e:
+                logger.warning(f"Compaction failed: {e}")
+    
+    def shed_history(self, uid, keep=HISTORY_KEEP_ON_EVICT):
+        """Budget eviction: keep only the most recent history entries"""
+        with self.user_lock(uid):
+            if uid not in self.user_history:
+                return False
+            hist = self.user_history[uid]
+            if len(hist) <= keep:
+                return False
+            self.user_history.put(uid, hist[:keep], -sum(map(approx_size, hist[keep:])))
+            return True
     
     def add_to_favorites(self, uid, song):
         sid = song.get('songid') or song.get('id', '')
-        if any((s.get('songid') or s.get('id', '')) == sid for s in self.user_favorites[uid]):
-            return False
-        self.user_favorites[uid].append(song)
-        self.user_stats[uid]['favorites'] += 1
+        with self.user_lock(uid):
+            favs = self.user_favorites[uid]
+            if any((s.get('songid') or s.get('id', '')) == sid for s in favs):
+                return False
+            favs.append(song)
+            self.user_favorites.put(uid, favs, approx_size(song))
+            st = self.user_stats[uid]
+            st['favorites'] += 1
+            self.user_stats[uid] = st
         return True
     
     def remove_from_favorites(self, uid, sid):
-        orig = len(self.user_favorites[uid])
-        self.user_favorites[uid] = [s for s in self.user_favorites[uid] if (s.get('songid') or s.get('id', '')) != sid]
-        return len(self.user_favorites[uid]) < orig
+        with self.user_lock(uid):
+            favs = self.user_favorites[uid]
+            kept = [s for s in favs if (s.get('songid') or s.get('id', '')) != sid]
+            if len(kept) < len(favs):
+                gone = [s for s in favs if (s.get('songid') or s.get('id', '')) == sid]
+                self.user_favorites.put(uid, kept, -sum(map(approx_size, gone)))
+        return len(kept) < len(favs)
     
     def create_playlist(self, uid, name):
-        if name in self.user_playlists[uid]:
-            return False
-        self.user_playlists[uid][name] = []
+        with self.user_lock(uid):
+            pls = self.user_playlists[uid]
+            if name in pls:
+                return False
+            pls[name] = []
+            self.user_playlists.put(uid, pls, approx_size(name) + approx_size([]))
         return True
     
     def add_to_playlist(self, uid, name, song):
-        if name not in self.user_playlists[uid]:
-            return False
         sid = song.get('songid') or song.get('id', '')
-        if any((s.get('songid') or s.get('id', '')) == sid for s in self.user_playlists[uid][name]):
-            return False
-        self.user_playlists[uid][name].append(song)
+        with self.user_lock(uid):
+            pls = self.user_playlists[uid]
+            if name not in pls:
+                return False
+            if any((s.get('songid') or s.get('id', '')) == sid for s in pls[name]):
+                return False
+            pls[name].append(song)
+            self.user_playlists.put(uid, pls, approx_size(song))
         return True
 
-db = DataStore()
+db = DataStore(state)
 
 def fmt_dur(s):
     try: sec = int(s); return f"{sec//60}:{sec%60:02d}"
@@ -349,18 +1860,25 @@ class API:
     def _request(endpoint, params, retries=MAX_RETRIES):
         for attempt in range(retries):
             try:
-                r = SESSION.get(f"{API_BASE_URL}{endpoint}", params=params, timeout=REQUEST_TIMEOUT)
+                with metrics.api_latency.time(endpoint), tracer.span(f"api{endpoint}"):
+                    r = SESSION.get(f"{API_BASE_URL}{endpoint}", params=params, timeout=REQUEST_TIMEOUT)
+                live.upstream(r.status_code == 200)
                 if r.status_code == 200:
                     return r.json()
-                elif r.status_code == 429:
+                metrics.api_errors.inc(endpoint, str(r.status_code))
+                if r.status_code == 429:
                     time.sleep(2 ** attempt)
                     continue
             except requests.exceptions.Timeout:
+                metrics.api_errors.inc(endpoint, 'timeout')
+                live.upstream(False)
                 logger.warning(f"Timeout attempt {attempt+1}/{retries}")
                 if attempt < retries - 1:
                     time.sleep(1)
                     continue
             except Exception as e:
+                metrics.api_errors.inc(endpoint, 'error')
+                live.upstream(False)
                 logger.error(f"Request error: {e}")
                 if attempt < retries - 1:
                     time.sleep(1)
@@ -394,27 +1912,795 @@ class API:
         return data
     
     @staticmethod
-    def download(url, retries=MAX_RETRIES):
-        for attempt in range(retries):
+    def probe(url):
+        """HEAD the file: (size, whether byte ranges are accepted).
+        
+        size is 0 when the server says the file isn't there and None when
+        the probe itself failed or the size wasn't given.
+        """
+        try:
+            r = SESSION.head(url, headers=DOWNLOAD_HEADERS, timeout=15, allow_redirects=True)
+        except Exception as e:
+            logger.warning(f"Probe failed: {e}")
+            return None, False
+        if r.status_code != 200:
+            return (0 if r.status_code in DOWNLOAD_GONE else None), False
+        size = int(r.headers.get('Content-Length') or 0) or None
+        return size, r.headers.get('Accept-Ranges', '').lower() == 'bytes'
+    
+    @staticmethod
+    def download_to(url, path, retries=MAX_RETRIES, probe=None):
+        """Write the audio at url to path; returns its size or None.
+        
+        `probe` is a known (size, ranges) result that saves the HEAD. The
+        file is written in place, so callers should pass a temporary name.
+        """
+        start = time.perf_counter()
+        size = None
+        if DOWNLOAD_CONNECTIONS > 1:
+            total, ranges = probe or API.probe(url)
+            if total and ranges and total >= RANGED_MIN_BYTES:
+                size = API._download_ranged(url, path, total, DOWNLOAD_CONNECTIONS, retries)
+                if size is None:
+                    metrics.download_mode.inc('ranged_fallback')
+        if size is None:
+            size = API._download_stream(url, path, retries)
+            if size:
+                metrics.download_mode.inc('stream')
+        else:
+            metrics.download_mode.inc('ranged')
+        if size:
+            elapsed = time.perf_counter() - start
+            metrics.download_seconds.observe(elapsed)
+            metrics.download_bytes.observe(size)
+            live.download(size, elapsed)
+        return size
+    
+    @staticmethod
+    def download(url, retries=MAX_RETRIES, probe=None):
+        """Audio bytes for url (tools and scripts; the bot itself streams from disk)"""
+        fd, path = tempfile.mkstemp(suffix='.tmp')
+        os.close(fd)
+        try:
+            if not API.download_to(url, path, retries, probe):
+                return None
+            with open(path, 'rb') as f:
+                return f.read()
+        finally:
+            os.remove(path)
+    
+    @staticmethod
+    def _content_total(r):
+        """Full file size from Content-Range ('bytes a-b/total') or Content-Length"""
+        total = r.headers.get('Content-Range', '').rpartition('/')[2]
+        if total.isdigit():
+            return int(total)
+        length = r.headers.get('Content-Length', '')
+        return int(length) if length.isdigit() else None
+    
+    @staticmethod
+    def _download_stream(url, path, retries):
+        """Single stream that resumes from the last received byte when the connection drops"""
+        expected = None
+        with open(path, 'wb') as f:
+            for attempt in range(retries):
+                pos = f.tell()
+                kind = 'resume' if pos else 'fresh'
+                headers = {**DOWNLOAD_HEADERS, 'Range': f'bytes={pos}-'} if pos else DOWNLOAD_HEADERS
+                try:
+                    r = SESSION.get(url, headers=headers, timeout=DOWNLOAD_TIMEOUT, stream=True)
+                    if r.status_code == 206 and pos and r.headers.get('Content-Range', '').startswith(f'bytes {pos}-'):
+                        metrics.download_resumed_bytes.inc(n=pos)
+                        logger.info(f"↪️ Resuming download at {pos} bytes")
+                    elif r.status_code == 200:
+                        if pos:
+                            # Range ignored: the body starts from zero again
+                            kind = 'restart'
+                            f.seek(0)
+                            f.truncate()
+                    else:
+                        r.close()
+                        metrics.api_errors.inc('download', str(r.status_code))
+                        metrics.download_attempts.inc(kind, 'status')
+                        if r.status_code in DOWNLOAD_GONE:
+                            logger.warning(f"Download gave {r.status_code}; not retrying")
+                            return None
+                        live.upstream(False)
+                        if attempt < retries - 1:
+                            time.sleep(1)
+                        continue
+                    expected = API._content_total(r) or expected
+                    for c in r.iter_content(65536):
+                        f.write(c)
+                    got = f.tell()
+                    if expected is not None and got != expected:
+                        if got > expected:
+                            f.seek(0)
+                            f.truncate()
+                        raise IOError(f"length mismatch: got {got} of {expected} bytes")
+                    metrics.download_attempts.inc(kind, 'ok')
+                    live.upstream(True)
+                    return got
+                except Exception as e:
+                    metrics.api_errors.inc('download', 'error')
+                    metrics.download_attempts.inc(kind, 'error')
+                    live.upstream(False)
+                    logger.error(f"Download attempt {attempt+1} ({kind}, {f.tell()} bytes kept): {e}")
+                    if attempt < retries - 1:
+                        time.sleep(1)
+        return None
+    
+    @staticmethod
+    def _download_ranged(url, path, size, connections, retries):
+        """Fetch `size` bytes as parallel ranges into a preallocated file; None if ranges fail"""
+        with open(path, 'wb') as f:
+            f.truncate(size)
+        step = -(-size // connections)
+        parts = [(a, min(a + step, size) - 1) for a in range(0, size, step)]
+        with ThreadPoolExecutor(max_workers=len(parts), thread_name_prefix='range') as ex:
+            ok = list(ex.map(lambda p: API._fetch_range(url, path, p[0], p[1], retries), parts))
+        return size if all(ok) else None
+    
+    @staticmethod
+    def _fetch_range(url, path, start, end, retries):
+        """One part of a ranged download; a dropped part continues from where it stopped"""
+        pos = start
+        with open(path, 'r+b') as f:
+            for attempt in range(retries):
+                kind = 'range_resume' if pos > start else 'range'
+                try:
+                    r = SESSION.get(url, headers={**DOWNLOAD_HEADERS, 'Range': f'bytes={pos}-{end}'},
+                                    timeout=DOWNLOAD_TIMEOUT, stream=True)
+                    if r.status_code != 206 or not r.headers.get('Content-Range', '').startswith(f'bytes {pos}-'):
+                        # The CDN ignored the range; no point retrying, let the caller stream instead
+                        r.close()
+                        metrics.download_attempts.inc(kind, 'no_range')
+                        logger.warning(f"Range {pos}-{end} not honoured ({r.status_code})")
+                        return False
+                    if pos > start:
+                        metrics.download_resumed_bytes.inc(n=pos - start)
+                    f.seek(pos)
+                    for c in r.iter_content(65536):
+                        n = min(len(c), end + 1 - pos)
+                        f.write(c[:n] if n < len(c) else c)
+                        pos += n
+                    if pos != end + 1:
+                        raise IOError(f"length mismatch: got {pos - start} of {end + 1 - start} bytes")
+                    metrics.download_attempts.inc(kind, 'ok')
+                    live.upstream(True)
+                    return True
+                except Exception as e:
+                    metrics.api_errors.inc('download', 'error')
+                    metrics.download_attempts.inc(kind, 'error')
+                    live.upstream(False)
+                    logger.error(f"Range {start}-{end} attempt {attempt+1} (at {pos}): {e}")
+                    if attempt < retries - 1:
+                        time.sleep(1)
+        return False
+
+api = API()
+
+# ==================== QUALITY ====================
+QUALITY_TTL = 6 * 3600
+QUALITY_MAX_SONGS = 5000
+QUALITY_ORDER = ('320kbps', '160kbps', '96kbps')
+
+class QualityResolver:
+    """Finds a bitrate that actually exists before downloading it.
+    
+    The CDN URL of each variant is derived with get_quality_url and checked
+    with a HEAD. What exists (and its size) is remembered per song, so the
+    next request goes straight to a working URL, and the download reuses
+    the probe instead of sending its own HEAD.
+    """
+    
+    def __init__(self, ttl=QUALITY_TTL, max_songs=QUALITY_MAX_SONGS):
+        self.ttl = ttl
+        self.max_songs = max_songs
+        self._known: OrderedDict = OrderedDict()  # sid -> (checked_at, {quality: (size, ranges) or None})
+        self._lock = threading.Lock()
+        self.outcomes = metrics.counter('groovia_quality_resolve_total', 'Quality resolution outcomes', ['outcome'])
+    
+    def _variants(self, sid):
+        with self._lock:
+            item = self._known.get(sid)
+            if item is None or time.time() - item[0] > self.ttl:
+                self._known.pop(sid, None)
+                item = self._known[sid] = (time.time(), {})
+                while len(self._known) > self.max_songs:
+                    self._known.popitem(last=False)
+            self._known.move_to_end(sid)
+            return item[1]
+    
+    def available(self, sid):
+        """Qualities seen to exist for sid (only those probed so far)"""
+        with self._lock:
+            item = self._known.get(sid)
+            return [q for q, p in (item[1].items() if item else ()) if p is not None]
+    
+    def _record(self, seen, quality, probe):
+        with self._lock:
+            seen[quality] = probe
+    
+    def resolve(self, sid, url, quality):
+        """Blocking: (url, quality, probe) for the requested quality or the best one that exists.
+        
+        url is None when every variant is known to be missing.
+        """
+        if not re.search(r'_(320|160|96)\.', url):
+            return url, quality, None  # no bitrate in the URL, nothing to choose from
+        seen = self._variants(sid or url)
+        order = [quality] + [q for q in QUALITY_ORDER if q != quality]
+        probed = False
+        for q in order:
+            if q in seen and seen[q] is None:
+                continue
+            candidate = get_quality_url({'media_url': url}, q)
+            probe = seen.get(q)
+            if probe is None:
+                probed = True
+                size, ranges = API.probe(candidate)
+                if size == 0:
+                    self._record(seen, q, None)
+                    continue
+                if size is None:
+                    # Couldn't tell; try the download itself rather than guess
+                    self.outcomes.inc('unknown')
+                    return candidate, q, None
+                probe = (size, ranges)
+                self._record(seen, q, probe)
+            if q != quality:
+                self.outcomes.inc('fallback')
+                logger.info(f"🎚 {sid}: {quality} unavailable, using {q}")
+            else:
+                self.outcomes.inc('probed' if probed else 'cached')
+            return candidate, q, probe
+        self.outcomes.inc('unavailable')
+        return None, quality, None
+
+qualities = QualityResolver()
+
+# ==================== THUMBNAILS ====================
+class ThumbCache:
+    """Cover art fetched, shrunk to Telegram thumbnail limits and cached on disk by URL"""
+    
+    def __init__(self, root=THUMB_DIR, max_bytes=THUMB_CACHE_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._index: OrderedDict = OrderedDict()  # filename -> size, oldest first
+        self._total = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._ready = False
+    
+    def _ensure(self):
+        """Create and index the cache directory on first use rather than at import"""
+        with self._lock:
+            if not self._ready:
+                os.makedirs(self.root, exist_ok=True)
+                self._rebuild()
+                self._ready = True
+    
+    def _rebuild(self):
+        entries = []
+        for e in os.scandir(self.root):
+            if e.is_file() and e.name.endswith('.jpg'):
+                st = e.stat()
+                entries.append((st.st_mtime, e.name, st.st_size))
+        for _, name, size in sorted(entries):
+            self._index[name] = size
+            self._total += size
+    
+    @staticmethod
+    def _name(url):
+        return hashlib.sha1(url.encode()).hexdigest() + '.jpg'
+    
+    @staticmethod
+    def _shrink(raw):
+        """Downsize any image to a JPEG within THUMB_SIZE px and THUMB_MAX_BYTES"""
+        img = Image.open(BytesIO(raw)).convert('RGB')
+        img.thumbnail((THUMB_SIZE, THUMB_SIZE))
+        for quality in (85, 70, 55, 40):
+            out = BytesIO()
+            img.save(out, 'JPEG', quality=quality, optimize=True)
+            if out.tell() <= THUMB_MAX_BYTES:
+                return out.getvalue()
+        return None
+    
+    def _evict(self):
+        while self._total > self.max_bytes and self._index:
+            name, size = self._index.popitem(last=False)
+            self._total -= size
+            try: os.remove(os.path.join(self.root, name))
+            except OSError: pass
+    
+    def fetch(self, url):
+        """Blocking: cached thumbnail bytes for url, downloading on a miss"""
+        self._ensure()
+        name = self._name(url)
+        path = os.path.join(self.root, name)
+        with self._lock:
+            cached = name in self._index
+            if cached:
+                self._index.move_to_end(name)
+        if cached:
             try:
-                r = SESSION.get(url, headers={'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'}, 
-                               timeout=REQUEST_TIMEOUT, stream=True)
-                if r.status_code == 200:
-                    buf = BytesIO()
-                    for c in r.iter_content(16384):
-                        buf.write(c)
-                    buf.seek(0)
-                    return buf.read()
+                with open(path, 'rb') as f:
+                    data = f.read()
+                os.utime(path)
+                self.hits += 1
+                return data
+            except OSError:
+                with self._lock:
+                    self._total -= self._index.pop(name, 0)
+        
+        self.misses += 1
+        try:
+            r = SESSION.get(url, timeout=15)
+            if r.status_code != 200:
+                return None
+            data = self._shrink(r.content)
+        except Exception as e:
+            logger.warning(f"Thumbnail error: {e}")
+            return None
+        if not data:
+            return None
+        
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError as e:
+            logger.warning(f"Thumbnail cache write failed: {e}")
+            return data
+        with self._lock:
+            self._total += len(data) - self._index.pop(name, 0)
+            self._index[name] = len(data)
+            self._evict()
+        return data
+    
+    async def get(self, url):
+        """Thumbnail bytes for url without blocking the event loop"""
+        if not url:
+            return None
+        return await asyncio.to_thread(self.fetch, url)
+
+thumbs = ThumbCache()
+
+# ==================== AUDIO CACHE ====================
+class AudioCache:
+    """Downloaded tracks kept on disk per (songid, quality), least recently used evicted first.
+    
+    Files are downloaded to a temp name and renamed into place, so a crash
+    never leaves a truncated track behind. The index is rebuilt from directory
+    metadata on startup; hits bump the mtime so LRU order survives restarts.
+    Concurrent misses for the same file share one download.
+    """
+    
+    def __init__(self, root=AUDIO_DIR, max_bytes=AUDIO_CACHE_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._index: OrderedDict = OrderedDict()  # filename -> size, oldest first
+        self._total = 0
+        self._lock = threading.Lock()
+        self._inflight: Dict[str, threading.Event] = {}  # filename -> set when its download ends
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.events = metrics.counter('groovia_audio_cache_total', 'Audio cache lookups and evictions', ['result'])
+        metrics.gauge('groovia_audio_cache_bytes', 'Bytes held by the audio cache', lambda: self._total)
+        self._ready = False
+    
+    def _ensure(self):
+        """Create and index the cache directory on first use rather than at import"""
+        with self._lock:
+            if not self._ready:
+                os.makedirs(self.root, exist_ok=True)
+                self._rebuild()
+                self._ready = True
+    
+    def _rebuild(self):
+        entries = []
+        for e in os.scandir(self.root):
+            if not e.is_file():
+                continue
+            if e.name.endswith('.tmp'):
+                try: os.remove(e.path)
+                except OSError: pass
+                continue
+            if e.name.endswith('.mp3'):
+                st = e.stat()
+                entries.append((st.st_mtime, e.name, st.st_size))
+        for _, name, size in sorted(entries):
+            self._index[name] = size
+            self._total += size
+        self._evict()
+    
+    @staticmethod
+    def _name(sid, quality):
+        return hashlib.sha1(f"{sid}\x1f{quality}".encode()).hexdigest()[:24] + '.mp3'
+    
+    def _evict(self):
+        while self._total > self.max_bytes and self._index:
+            name, size = self._index.popitem(last=False)
+            self._total -= size
+            self.evictions += 1
+            self.events.inc('evict')
+            try: os.remove(os.path.join(self.root, name))
+            except OSError: pass
+    
+    def get(self, sid, quality):
+        """Blocking: open file handle for a cached track, or None"""
+        f = self._lookup(sid, quality)
+        self._count(f is not None)
+        return f
+    
+    def _count(self, hit):
+        if hit:
+            self.hits += 1
+            self.events.inc('hit')
+        else:
+            self.misses += 1
+            self.events.inc('miss')
+    
+    def _lookup(self, sid, quality):
+        """get() without counting a hit or miss"""
+        self._ensure()
+        name = self._name(sid, quality)
+        path = os.path.join(self.root, name)
+        with self._lock:
+            cached = name in self._index
+            if cached:
+                self._index.move_to_end(name)
+        if cached:
+            try:
+                # Once open, the handle survives the file being evicted before the upload ends
+                f = open(path, 'rb')
+                os.utime(path)
+                return f
+            except OSError:
+                with self._lock:
+                    self._total -= self._index.pop(name, 0)
+        return None
+    
+    def _add(self, sid, quality, tmp, size):
+        """Move a finished download into the cache and open it"""
+        name = self._name(sid, quality)
+        path = os.path.join(self.root, name)
+        os.replace(tmp, path)
+        f = open(path, 'rb')
+        with self._lock:
+            self._total += size - self._index.pop(name, 0)
+            self._index[name] = size
+            self._evict()
+        return f
+    
+    def open(self, sid, quality, url):
+        """Blocking: open file for (sid, quality) from disk, else the best available variant from the CDN.
+        
+        Downloads go straight to a temp file next to the cache and are renamed
+        into place, so track bytes never sit in memory. The caller closes the
+        handle. Songs without an id are cached under their URL. Each call
+        counts one hit (already on disk) or one miss.
+        """
+        sid = sid or url
+        f = self._lookup(sid, quality)
+        if f is None:
+            url, got, probe = qualities.resolve(sid, url, quality)
+            if url is not None and got != quality:
+                f = self._lookup(sid, got)
+        self._count(f is not None)
+        if f is not None or url is None:
+            return f
+        name = self._name(sid, got)
+        while True:
+            with self._lock:
+                done = self._inflight.get(name)
+                if done is None:
+                    self._inflight[name] = done = threading.Event()
+                    break
+            # Someone else is fetching this file; use theirs, or take over if it failed
+            done.wait()
+            f = self._lookup(sid, got)
+            if f is not None:
+                return f
+        tmp = os.path.join(self.root, f"{name}.{threading.get_ident()}.tmp")
+        try:
+            size = api.download_to(url, tmp, probe=probe)
+            if not size:
+                return None
+            return self._add(sid, got, tmp, size)
+        except OSError as e:
+            logger.warning(f"Audio cache write failed: {e}")
+            return None
+        finally:
+            if os.path.exists(tmp):
+                try: os.remove(tmp)
+                except OSError: pass
+            with self._lock:
+                self._inflight.pop(name, None)
+            done.set()
+
+audio_cache = AudioCache()
+
+# ==================== PREFETCH ====================
+class SongCache:
+    """In-memory cache of /song/ details keyed by perma_url (TTL + LRU)"""
+    
+    def __init__(self, ttl=SONG_CACHE_TTL, max_items=SONG_CACHE_MAX):
+        self.ttl = ttl
+        self.max_items = max_items
+        self._data: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    def peek(self, purl):
+        """Lookup without touching hit/miss counters or LRU order"""
+        item = self._data.get(purl)
+        if item and time.time() - item[0] < self.ttl:
+            return item[1]
+        return None
+    
+    def get(self, purl):
+        item = self._data.get(purl)
+        if item and time.time() - item[0] < self.ttl:
+            self._data.move_to_end(purl)
+            self.hits += 1
+            return item[1]
+        if item:
+            del self._data[purl]
+        self.misses += 1
+        return None
+    
+    def put(self, purl, det):
+        self._data[purl] = (time.time(), det)
+        self._data.move_to_end(purl)
+        while len(self._data) > self.max_items:
+            self._data.popitem(last=False)
+
+class Prefetcher:
+    """Speculatively fetch song details for the visible results page.
+    
+    Pending fetches sit in a bounded deque that workers take from the newest
+    end, so the page the user is looking at right now wins and a full queue
+    forgets its oldest pages. Only PREFETCH_WORKERS fetches run at once. A tap
+    on a song that is still being prefetched waits for that fetch instead of
+    starting another.
+    """
+    
+    def __init__(self, cache, workers=PREFETCH_WORKERS, max_pending=PREFETCH_MAX_PENDING):
+        self.cache = cache
+        self.workers = workers
+        self.pending: deque = deque(maxlen=max_pending)
+        self._ready: Optional[asyncio.Event] = None
+        self._tasks: List[asyncio.Task] = []
+        self._inflight: Dict[str, asyncio.Future] = {}
+    
+    def _ensure_workers(self):
+        if self._ready is None:
+            self._ready = asyncio.Event()
+            self._tasks = [background(self._worker()) for _ in range(self.workers)]
+    
+    def schedule(self, songs, start=0):
+        """Queue background detail fetches for songs[start:start+SONGS_PER_PAGE]"""
+        try:
+            self._ensure_workers()
+        except RuntimeError:
+            return  # No running loop
+        # Pushed bottom-up so the top of the page is fetched first
+        for s in reversed(songs[start:start + SONGS_PER_PAGE]):
+            purl = s.get('perma_url', '')
+            if not purl or purl in self._inflight or self.cache.peek(purl) is not None:
+                continue
+            self.pending.append(purl)  # a full deque drops its oldest entry
+        if self.pending:
+            self._ready.set()
+    
+    async def _worker(self):
+        while True:
+            if not self.pending:
+                self._ready.clear()
+                await self._ready.wait()
+                continue
+            purl = self.pending.pop()
+            try:
+                if purl not in self._inflight and self.cache.peek(purl) is None:
+                    det = await self._fetch(purl)
+                    if det and PREFETCH_THUMBS:
+                        await thumbs.get(det.get('image') or det.get('image_url', ''))
             except Exception as e:
-                logger.error(f"Download attempt {attempt+1}: {e}")
-                if attempt < retries - 1:
-                    time.sleep(1)
+                logger.warning(f"Prefetch error: {e}")
+    
+    async def _fetch(self, purl):
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[purl] = fut
+        det = None
+        try:
+            det = await asyncio.to_thread(api.song, purl)
+            if det:
+                self.cache.put(purl, det)
+        finally:
+            self._inflight.pop(purl, None)
+            fut.set_result(det)
+        return det
+    
+    async def get(self, purl):
+        """Song details from memory, a running prefetch, or a fresh fetch"""
+        det = self.cache.get(purl)
+        if det is not None:
+            return det
+        fut = self._inflight.get(purl)
+        if fut is not None:
+            return await asyncio.shield(fut)
+        return await self._fetch(purl)
+
+song_cache = SongCache()
+prefetcher = Prefetcher(song_cache)
+
+# ==================== SHELVES ====================
+class ShelfService:
+    """Curated song lists (trending, moods, artists) refreshed in the background.
+    
+    Queries live in SHELVES_FILE; every refresh re-reads it, so adding a
+    mood or artist is a data change only. Taps are served from the last
+    snapshot and only fall back to a live search on a cold start.
+    """
+    
+    def __init__(self, path=SHELVES_FILE, interval=SHELF_REFRESH_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.config: Dict[str, Dict] = {}
+        self.snapshots: Dict[str, Dict] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.load()
+    
+    def load(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                self.config = json.load(f)
+        except Exception as e:
+            logger.error(f"Failed to load shelves from {self.path}: {e}")
+    
+    def section(self, name):
+        """[(key, label)] for 'moods' or 'artists', in file order"""
+        return [(k, v.get('label', k)) for k, v in self.config.get(name, {}).items()]
+    
+    def entry(self, key):
+        """Config for a shelf key: 'trending', 'mood_<k>' or 'art_<k>'"""
+        if key == 'trending':
+            return self.config.get('trending')
+        if key.startswith('mood_'):
+            return self.config.get('moods', {}).get(key[5:])
+        if key.startswith('art_'):
+            return self.config.get('artists', {}).get(key[4:])
         return None
+    
+    def keys(self):
+        keys = ['trending'] if 'trending' in self.config else []
+        keys += [f"mood_{k}" for k in self.config.get('moods', {})]
+        keys += [f"art_{k}" for k in self.config.get('artists', {})]
+        return keys
+    
+    async def refresh(self, key):
+        e = self.entry(key)
+        if not e or not e.get('query'):
+            return None
+        songs = await asyncio.to_thread(api.search, e['query'])
+        if songs:
+            snap = {'songs': songs, 'updated': time.time()}
+            self.snapshots[key] = snap
+            if state.shared:
+                await state_io(state.set, f"shelf:{key}", snap, self.interval * 3)
+        return songs
+    
+    async def refresh_all(self):
+        self.load()
+        ok = 0
+        for key in self.keys():
+            try:
+                if await self.refresh(key): ok += 1
+            except Exception as e:
+                logger.warning(f"Shelf {key} refresh failed: {e}")
+            await asyncio.sleep(1)  # Go easy on the API
+        logger.info(f"📚 Shelves refreshed: {ok}/{len(self.keys())}")
+        await state_io(state.publish, 'invalidate', {'ns': 'shelf'})
+    
+    def _on_invalidate(self, channel, msg):
+        if channel == 'invalidate' and msg.get('ns') == 'shelf':
+            self.snapshots.clear()  # Re-read from the shared state on next tap
+    
+    async def _loop(self):
+        state.subscribe(self._on_invalidate)
+        while True:
+            # With several workers only one of them refreshes per interval
+            if await state_io(state.claim, 'shelves', max(self.interval - 30, 30)):
+                await self.refresh_all()
+            await asyncio.sleep(self.interval)
+    
+    def start(self):
+        if self._task is None:
+            self._task = background(self._loop())
+    
+    async def songs(self, key):
+        """Snapshot songs for a shelf, fetching live only if never loaded"""
+        snap = self.snapshots.get(key)
+        if snap is None and state.shared:
+            snap = await state_io(state.get, f"shelf:{key}")
+            if snap:
+                self.snapshots[key] = snap
+        if snap:
+            return list(snap['songs'])
+        songs = await self.refresh(key)
+        return list(songs) if songs else None
+
+shelves = ShelfService()
+
+def _cache_stats():
+    caches = {'song': song_cache, 'thumb': thumbs, 'results': results, 'audio': audio_cache}
+    return {name: (c.hits, c.misses) for name, c in caches.items()}
+
+def _hit_ratio():
+    return {name: (h / (h + m) if h + m else 0) for name, (h, m) in _cache_stats().items()}
+
+metrics.counter_fn('groovia_cache_hits_total', 'Cache hits', lambda: {k: v[0] for k, v in _cache_stats().items()}, ['cache'])
+metrics.counter_fn('groovia_cache_misses_total', 'Cache misses', lambda: {k: v[1] for k, v in _cache_stats().items()}, ['cache'])
+metrics.gauge('groovia_cache_hit_ratio', 'Cache hit ratio since start', _hit_ratio, ['cache'])
+metrics.gauge('groovia_queue_depth', 'Pending work per queue',
+              lambda: {'prefetch': len(prefetcher.pending)}, ['queue'])
+metrics.gauge('groovia_sessions', 'Live result sessions', lambda: len(db.user_searches))
+metrics.gauge('groovia_session_bytes', 'Approximate bytes held by result sessions', lambda: db.user_searches.total_bytes)
+
+# Loading messages - IMPROVED
+LOADING_MSGS = ["⏳ Loading your music…", "🎵 Fetching the beats…", "🔄 Almost there…", "🎧 Preparing your track…", "✨ Magic happening…"]
+
+# Download progress frames
+DL_WAIT = """
+╔══════════════════════════╗
+    ⏳ *Downloading*
+╚══════════════════════════╝
+
+🎵 Fetching your music\\.\\.\\.
+
+⣾⣿⣿⣿⣿⣿⣿⣿⣿⣷
+█░░░░░░░░░░░░░░░░░░░░░░█
+█░░▓▓▓▓▓▓▓░░░░░░░░░░░░░█  
+█░░░░░░░░░░░░░░░░░░░░░░█
+⣿⣿⣿⣿⣿⣿⣿⣿⣿⣿⣿⣿
+
+_Please wait\\.\\.\\._
+"""
+DL_FETCH = """
+╔══════════════════════════╗
+    ⏳ *Downloading*
+╚══════════════════════════╝
 
-api = API()
+🎵 Fetching your music\\.\\.\\.
 
-# Loading messages - IMPROVED
-LOADING_MSGS = ["⏳ Loading your music…", "🎵 Fetching the beats…", "🔄 Almost there…", "🎧 Preparing your track…", "✨ Magic happening…"]
+⣾⣿⣿⣿⣿⣿⣿⣿⣿⣷
+█░░░░░░░░░░░░░░░░░░░░░░█
+█░░▓▓▓▓▓▓▓▓▓▓▓▓▓░░░░░░░█  
+█░░░░░░░░░░░░░░░░░░░░░░█
+⣿⣿⣿⣿⣿⣿⣿⣿⣿⣿⣿⣿
+
+_Almost there\\.\\.\\._
+"""
+DL_UPLOAD = """
+╔══════════════════════════╗
+    📤 *Uploading*
+╚══════════════════════════╝
+
+🎵 Sending to you\\.\\.\\.
+
+⣾⣿⣿⣿⣿⣿⣿⣿⣿⣷
+█░░░░░░░░░░░░░░░░░░░░░░█
+█░░▓▓▓▓▓▓▓▓▓▓▓▓▓▓▓▓▓▓░░█  
+█░░░░░░░░░░░░░░░░░░░░░░█
+⣿⣿⣿⣿⣿⣿⣿⣿⣿⣿⣿⣿
+
+_Uploading\\.\\.\\._
+"""
 SEARCH_MSGS = ["🔍 Searching the universe…", "🎵 Finding your vibe…", "🔎 Hunting for tracks…"]
 LYRICS_MSGS = ["🎼 Detecting song from lyrics…", "🔍 Analyzing your lyrics…", "🎵 Finding the perfect match…"]
 
@@ -436,7 +2722,7 @@ class KB:
         ])
     
     @staticmethod
-    def songs(songs, start, total, source='search'):
+    def songs(songs, start, total, source='search', key=None):
         kb = []
         end = min(start + SONGS_PER_PAGE, len(songs))
         for i in range(start, end):
@@ -444,61 +2730,61 @@ class KB:
             t = trunc(s.get('title') or s.get('song','?'), 22)
             a = trunc(s.get('singers','?'), 12)
             d = fmt_dur(s.get('duration','0'))
-            kb.append([InlineKeyboardButton(f"🎵 {t} • {a} [{d}]", callback_data=f"s_{i}")])
+            kb.append([InlineKeyboardButton(f"🎵 {t} • {a} [{d}]", callback_data=cb_encode(f"s_{i}", key))])
         
         nav = []
-        if start > 0: nav.append(InlineKeyboardButton("◀️ Prev", callback_data=f"p_{start-SONGS_PER_PAGE}"))
+        if start > 0: nav.append(InlineKeyboardButton("◀️ Prev", callback_data=cb_encode(f"p_{start-SONGS_PER_PAGE}", key)))
         pg = (start//SONGS_PER_PAGE)+1
         tot = (total+SONGS_PER_PAGE-1)//SONGS_PER_PAGE
         nav.append(InlineKeyboardButton(f"📄 {pg}/{tot}", callback_data="x"))
-        if end < total: nav.append(InlineKeyboardButton("Next ▶️", callback_data=f"p_{end}"))
+        if end < total: nav.append(InlineKeyboardButton("Next ▶️", callback_data=cb_encode(f"p_{end}", key)))
         if nav: kb.append(nav)
         
         kb.append([
-            InlineKeyboardButton("⬇️ Download All", callback_data="dall"),
-            InlineKeyboardButton("🔀 Shuffle", callback_data="shuffle")
+            InlineKeyboardButton("⬇️ Download All", callback_data=cb_encode("dall", key)),
+            InlineKeyboardButton("🔀 Shuffle", callback_data=cb_encode("shuffle", key))
         ])
         kb.append([InlineKeyboardButton("🏠 Home", callback_data="menu"), InlineKeyboardButton("❌ Close", callback_data="close")])
         return InlineKeyboardMarkup(kb)
     
     @staticmethod
-    def detail(idx, fav, pg):
+    def detail(idx, fav, pg, key=None):
         f = "💔 Remove" if fav else "💖 Favorite"
         fc = f"uf_{idx}" if fav else f"f_{idx}"
         return InlineKeyboardMarkup([
-            [InlineKeyboardButton("⬇️ Download Now", callback_data=f"d_{idx}")],
-            [InlineKeyboardButton("📝 Lyrics", callback_data=f"l_{idx}"),
-             InlineKeyboardButton("📤 Share", callback_data=f"sh_{idx}")],
-            [InlineKeyboardButton(f, callback_data=fc),
-             InlineKeyboardButton("➕ Playlist", callback_data=f"addpl_{idx}")],
-            [InlineKeyboardButton("🔙 Back", callback_data=f"b_{pg}"),
+            [InlineKeyboardButton("⬇️ Download Now", callback_data=cb_encode(f"d_{idx}", key))],
+            [InlineKeyboardButton("📝 Lyrics", callback_data=cb_encode(f"l_{idx}", key)),
+             InlineKeyboardButton("📤 Share", callback_data=cb_encode(f"sh_{idx}", key))],
+            [InlineKeyboardButton(f, callback_data=cb_encode(fc, key)),
+             InlineKeyboardButton("➕ Playlist", callback_data=cb_encode(f"addpl_{idx}", key))],
+            [InlineKeyboardButton("🔙 Back", callback_data=cb_encode(f"b_{pg}", key)),
              InlineKeyboardButton("🏠 Home", callback_data="menu")]
         ])
     
     @staticmethod
-    def collection(songs, start=0, col_type='album'):
+    def collection(songs, start=0, col_type='album', key=None):
         kb = []
         end = min(start + SONGS_PER_PAGE, len(songs))
         for i in range(start, end):
             s = songs[i]
             t = trunc(s.get('title') or s.get('song','?'), 28)
             d = fmt_dur(s.get('duration','0'))
-            kb.append([InlineKeyboardButton(f"🎵 {t} [{d}]", callback_data=f"c_{i}")])
+            kb.append([InlineKeyboardButton(f"🎵 {t} [{d}]", callback_data=cb_encode(f"c_{i}", key))])
         
         nav = []
         if start > 0:
-            nav.append(InlineKeyboardButton("◀️ Prev", callback_data=f"cp_{start-SONGS_PER_PAGE}"))
+            nav.append(InlineKeyboardButton("◀️ Prev", callback_data=cb_encode(f"cp_{start-SONGS_PER_PAGE}", key)))
         pg = (start//SONGS_PER_PAGE)+1
         tot = (len(songs)+SONGS_PER_PAGE-1)//SONGS_PER_PAGE
         nav.append(InlineKeyboardButton(f"📄 {pg}/{tot}", callback_data="x"))
         if end < len(songs):
-            nav.append(InlineKeyboardButton("Next ▶️", callback_data=f"cp_{end}"))
+            nav.append(InlineKeyboardButton("Next ▶️", callback_data=cb_encode(f"cp_{end}", key)))
         if nav:
             kb.append(nav)
         
         kb.append([
-            InlineKeyboardButton("⬇️ Download All", callback_data="dall"),
-            InlineKeyboardButton("💖 Save All", callback_data="savall")
+            InlineKeyboardButton("⬇️ Download All", callback_data=cb_encode("dall", key)),
+            InlineKeyboardButton("💖 Save All", callback_data=cb_encode("savall", key))
         ])
         kb.append([InlineKeyboardButton("🏠 Home", callback_data="menu"), InlineKeyboardButton("❌ Close", callback_data="close")])
         return InlineKeyboardMarkup(kb)
@@ -535,38 +2821,28 @@ class KB:
         kb.append([InlineKeyboardButton("🏠 Home", callback_data="menu")])
         return InlineKeyboardMarkup(kb)
     
+    @staticmethod
+    def _shelf_grid(prefix, items):
+        rows = []
+        for i in range(0, len(items), 2):
+            rows.append([InlineKeyboardButton(label, callback_data=f"{prefix}{key}") for key, label in items[i:i+2]])
+        return rows
+    
     @staticmethod
     def moods():
-        return InlineKeyboardMarkup([
-            [InlineKeyboardButton("😊 Happy", callback_data="mood_happy"),
-             InlineKeyboardButton("😢 Sad", callback_data="mood_sad")],
-            [InlineKeyboardButton("💪 Workout", callback_data="mood_workout"),
-             InlineKeyboardButton("😴 Sleep", callback_data="mood_sleep")],
-            [InlineKeyboardButton("🎉 Party", callback_data="mood_party"),
-             InlineKeyboardButton("💕 Romance", callback_data="mood_romance")],
-            [InlineKeyboardButton("🧘 Chill", callback_data="mood_chill"),
-             InlineKeyboardButton("🔥 Energy", callback_data="mood_energy")],
-            [InlineKeyboardButton("🏠 Home", callback_data="menu")]
-        ])
+        rows = KB._shelf_grid("mood_", shelves.section('moods'))
+        rows.append([InlineKeyboardButton("🏠 Home", callback_data="menu")])
+        return InlineKeyboardMarkup(rows)
     
     @staticmethod
     def artists():
-        return InlineKeyboardMarkup([
-            [InlineKeyboardButton("Arijit Singh", callback_data="art_arijit"),
-             InlineKeyboardButton("Shreya Ghoshal", callback_data="art_shreya")],
-            [InlineKeyboardButton("Atif Aslam", callback_data="art_atif"),
-             InlineKeyboardButton("Neha Kakkar", callback_data="art_neha")],
-            [InlineKeyboardButton("AP Dhillon", callback_data="art_apdhillon"),
-             InlineKeyboardButton("Jubin Nautiyal", callback_data="art_jubin")],
-            [InlineKeyboardButton("KK", callback_data="art_kk"),
-             InlineKeyboardButton("Sonu Nigam", callback_data="art_sonu")],
-            [InlineKeyboardButton("🔍 Search Artist", callback_data="art_search")],
-            [InlineKeyboardButton("🏠 Home", callback_data="menu")]
-        ])
+        rows = KB._shelf_grid("art_", shelves.section('artists'))
+        rows.append([InlineKeyboardButton("🔍 Search Artist", callback_data="art_search")])
+        rows.append([InlineKeyboardButton("🏠 Home", callback_data="menu")])
+        return InlineKeyboardMarkup(rows)
     
     @staticmethod
-    def settings(uid):
-        s = db.user_settings[uid]
+    def settings(s):
         q = s.get('quality', '160kbps')
         return InlineKeyboardMarkup([
             [InlineKeyboardButton(f"📶 Quality: {q}", callback_data="set_quality")],
@@ -586,8 +2862,7 @@ class KB:
         ])
     
     @staticmethod
-    def playlists(uid):
-        pls = db.user_playlists[uid]
+    def playlists(pls):
         kb = []
         for name, songs in list(pls.items())[:8]:
             kb.append([InlineKeyboardButton(f"📁 {name} ({len(songs)})", callback_data=f"pl_{name}")])
@@ -665,7 +2940,7 @@ async def cmd_menu(u: Update, c):
 
 async def cmd_fav(u: Update, c):
     uid = u.effective_user.id
-    favs = db.user_favorites[uid]
+    favs = await db.user_favorites.load(uid)
     if not favs:
         await u.message.reply_text("💔 *No favorites yet\\!*\n\nSearch songs and tap 💖 to save", parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.main())
         return
@@ -673,7 +2948,7 @@ async def cmd_fav(u: Update, c):
 
 async def cmd_hist(u: Update, c):
     uid = u.effective_user.id
-    hist = db.user_history[uid]
+    hist = await db.user_history.load(uid)
     if not hist:
         await u.message.reply_text("📜 *No history yet\\!*\n\nStart exploring music\\!", parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.main())
         return
@@ -681,10 +2956,11 @@ async def cmd_hist(u: Update, c):
 
 async def cmd_stats(u: Update, c):
     uid = u.effective_user.id
-    st = db.user_stats[uid]
-    favs = len(db.user_favorites[uid])
-    hist = len(db.user_history[uid])
-    pls = len(db.user_playlists[uid])
+    st = await db.user_stats.load(uid)
+    favs = len(await db.user_favorites.load(uid))
+    hist = len(await db.user_history.load(uid))
+    pls = len(await db.user_playlists.load(uid))
+    downloads, searches = await state_io(db.global_counts)
     
     stats_text = f"""
 ╔══════════════════════════╗
@@ -702,40 +2978,127 @@ async def cmd_stats(u: Update, c):
 
 ━━━━━━━━━━━━━━━━━━━━━
 🌍 *Global Stats*
-📥 Total Downloads: {db.global_downloads}
-🔍 Total Searches: {db.global_searches}
+📥 Total Downloads: {downloads}
+🔍 Total Searches: {searches}
 """
     await u.message.reply_text(stats_text, parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.main())
 
 async def cmd_settings(u: Update, c):
     uid = u.effective_user.id
-    await u.message.reply_text("⚙️ *Settings*\n\nCustomize your experience:", parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.settings(uid))
+    await u.message.reply_text("⚙️ *Settings*\n\nCustomize your experience:", parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.settings(await db.user_settings.aget(uid, {})))
+
+async def cmd_sysstats(u: Update, c):
+    """Admin dashboard built from LiveStats rolling windows"""
+    if u.effective_user.id not in ADMIN_IDS:
+        return
+    span = live.span()
+    calls, errs = live.api_calls.sum(), live.api_errors.sum()
+    n_dl = live.downloads.sum()
+    avg_mb = live.download_bytes.sum() / n_dl / 1024 ** 2 if n_dl else 0
+    avg_s = live.download_seconds.sum() / n_dl if n_dl else 0
+    depth = await asyncio.to_thread(jobs.depth)
+    shed = 'off'
+    if shedder.active:
+        shed = esc(f"on since {time.strftime('%H:%M:%S', time.localtime(shedder.since))} ({shedder.reason})")
+    lines = [
+        f"🖥 *System Stats* \\(last {int(span // 60)}m{int(span % 60):02d}s\\)",
+        "",
+        f"⚡ Requests: {esc(f'{live.updates.sum() / span:.2f}')}/s",
+        f"👥 Active users: {live.active[5].count()} \\(5m\\) · {live.active[60].count()} \\(60m\\)",
+        f"🌐 Upstream: {int(calls)} calls, {esc(f'{errs * 100 / calls:.1f}' if calls else '0')}% errors",
+        f"⬇️ Downloads: {int(n_dl)}, avg {esc(f'{avg_mb:.2f}')}MB in {esc(f'{avg_s:.1f}')}s",
+        f"🧠 RSS: {esc(f'{rss_mb():.1f}')}MB · loop p99 {esc(f'{watchdog.percentiles()[99]:.1f}')}ms",
+        f"👷 Jobs: {sum(n for (_, st), n in depth.items() if st == 'queued')} queued · "
+        f"{sum(n for (_, st), n in depth.items() if st == 'running')} running",
+        f"🪶 Load shedding: {shed}",
+        "",
+        "🎯 *Cache hit rate*",
+    ]
+    rates = live.cache_rates()
+    for name in sorted(rates):
+        ratio, n = rates[name]
+        lines.append(f"• {esc(name)}: {esc(f'{ratio * 100:.0f}%') if ratio is not None else 'n/a'} of {n}")
+    if not rates:
+        lines.append("• warming up")
+    lines += ["", f"🗂 *DataStore* \\({esc(f'{ledger.total() / 1024 ** 2:.2f}')}MB\\)"]
+    records, sizes = ledger.records(), ledger.sizes()
+    for name in sorted(records):
+        lines.append(f"• {esc(name)}: {records[name]} · {esc(f'{sizes.get(name, 0) / 1024:.0f}')}KB")
+    await u.message.reply_text('\n'.join(lines), parse_mode=ParseMode.MARKDOWN_V2)
+
+async def cmd_profile(u: Update, c):
+    """/profile [cpu|wall] [seconds] [top] - admin only"""
+    if u.effective_user.id not in ADMIN_IDS:
+        return
+    args = c.args or []
+    mode = args[0].lower() if args else 'wall'
+    if mode not in ('cpu', 'wall'):
+        await u.message.reply_text("Usage: /profile [cpu|wall] [seconds] [top]")
+        return
+    seconds = min(PROFILE_MAX_SECONDS, max(1, int(args[1]))) if len(args) > 1 and args[1].isdigit() else 30
+    top_n = min(40, max(1, int(args[2]))) if len(args) > 2 and args[2].isdigit() else 15
+    if profiler.running:
+        await u.message.reply_text(f"⏳ A {profiler.mode} profile is already running")
+        return
+    await u.message.reply_text(f"🔬 Profiling ({mode}) for {seconds}s...")
+    # Updates are handled one at a time, so the profile must not hold up this handler
+    profiler._task = background(send_profile(c.bot, u.effective_chat.id, mode, seconds, top_n))
+
+async def send_profile(bot, chat_id, mode, seconds, top_n):
+    try:
+        mode, path = await profiler.run(mode, seconds)
+    except Exception as e:
+        logger.error(f"Profile failed: {e}")
+        await bot.send_message(chat_id, f"❌ Profile failed: {e}")
+        return
+    busy, own, total = profiler.top(top_n)
+    pct = lambda n: f"{n * 100 / busy:5.1f}%" if busy else "  0.0%"
+    table = ["Self"] + [f"{pct(n)}  {name}" for name, n in own]
+    table += ["", "Inclusive"] + [f"{pct(n)}  {name}" for name, n in total]
+    body = '\n'.join(table).replace('\\', '\\\\').replace('`', "'")
+    text = (f"🔬 *{mode.upper()} profile* · {seconds}s · {profiler.samples} samples \\({busy} busy\\)\n"
+            f"```\n{body[:3500]}\n```")
+    try:
+        await bot.send_message(chat_id, text, parse_mode=ParseMode.MARKDOWN_V2)
+        with open(path, 'rb') as f:
+            await bot.send_document(chat_id, f, filename=os.path.basename(path),
+                                    caption="Collapsed stacks for flamegraph.pl / speedscope")
+    except Exception as e:
+        logger.error(f"Profile report failed: {e}")
 
 # === MESSAGE HANDLER ===
 async def on_text(u: Update, c):
+    live.request(u.effective_user.id if u.effective_user else None)
+    with tracer.trace('text', u):
+        await handle_text(u, c)
+
+async def handle_text(u: Update, c):
     txt = u.message.text.strip()
     uid = u.effective_user.id
     
     # Check if awaiting playlist name
-    if db.user_stats[uid].get('awaiting_playlist', False):
-        db.user_stats[uid]['awaiting_playlist'] = False
+    if (await db.user_stats.aget(uid, {})).get('awaiting_playlist', False):
+        await state_io(db.set_stat, uid, 'awaiting_playlist', False)
         if len(txt) > 50:
             await u.message.reply_text("❌ *Playlist name too long\\!*\n\nMax 50 characters", parse_mode=ParseMode.MARKDOWN_V2)
             return
-        if db.create_playlist(uid, txt):
-            await u.message.reply_text(f"✅ *Playlist created\\!*\n\n📁 {esc(txt)}", parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.playlists(uid))
+        if await state_io(db.create_playlist, uid, txt):
+            await u.message.reply_text(f"✅ *Playlist created\\!*\n\n📁 {esc(txt)}", parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.playlists(await db.user_playlists.load(uid)))
         else:
-            await u.message.reply_text("❌ *Playlist already exists\\!*", parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.playlists(uid))
+            await u.message.reply_text("❌ *Playlist already exists\\!*", parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.playlists(await db.user_playlists.load(uid)))
         return
     
     if len(txt) < 2:
         await u.message.reply_text("❌ Query too short\\!", parse_mode=ParseMode.MARKDOWN_V2)
         return
     
+    with tracer.span('is_lyrics_query'):
+        lyrics = not is_url(txt) and lyrics_detector.is_lyrics_query(txt)
+    
     if is_url(txt):
         await handle_url(u, c, txt, uid)
     # NEW: Check if it's lyrics query
-    elif lyrics_detector.is_lyrics_query(txt):
+    elif lyrics:
         await handle_lyrics_search(u, c, txt, uid)
     else:
         await handle_search(u, c, txt, uid)
@@ -770,11 +3133,16 @@ async def handle_lyrics_search(u, c, lyrics, uid):
             except:
                 break
     
-    # Run animation and detection in parallel
-    animation_task = asyncio.create_task(animate_loader())
+    # Run animation and detection in parallel; under load the first frame stays put
+    if shedder.active:
+        shedder.skipped.inc('animation')
+        animation_task = asyncio.create_task(asyncio.sleep(0))
+    else:
+        animation_task = asyncio.create_task(animate_loader())
     
     # Detect song name from lyrics
-    song_name = await asyncio.to_thread(lyrics_detector.search_song_by_lyrics, lyrics)
+    with tracer.span('youtube_lookup'):
+        song_name = await asyncio.to_thread(lyrics_detector.search_song_by_lyrics, lyrics)
     
     # Stop animation
     animation_task.cancel()
@@ -797,10 +3165,10 @@ async def handle_lyrics_search(u, c, lyrics, uid):
 
 async def handle_search_internal(msg, c, q, uid, is_lyrics=False):
     """Internal search function used by both regular and lyrics search"""
-    db.user_stats[uid]['searches'] += 1
-    db.global_searches += 1
+    await state_io(db.record_search, uid)
     
-    songs = api.search(q)
+    with tracer.span('search'):
+        songs = await asyncio.to_thread(api.search, q)
     if not songs:
         await msg.edit_text(
             "😕 *No results found\\!*\n\n💡 Try different keywords",
@@ -808,7 +3176,7 @@ async def handle_search_internal(msg, c, q, uid, is_lyrics=False):
         )
         return
     
-    db.user_searches[uid] = {'q': q, 'songs': songs}
+    key = await open_session(uid, {'q': q, 'songs': songs})
     
     prefix = "🎼 *From Lyrics*" if is_lyrics else "🔍 *Search Results*"
     result_text = f"""
@@ -821,17 +3189,19 @@ async def handle_search_internal(msg, c, q, uid, is_lyrics=False):
 
 ━━━━━━━━━━━━━━━━━━━━━
 """
-    await msg.edit_text(result_text, parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.songs(songs, 0, len(songs)))
+    with tracer.span('reply'):
+        await msg.edit_text(result_text, parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.songs(songs, 0, len(songs), key=key))
+    prefetcher.schedule(songs, 0)
 # ==================== END NEW CODE ====================
 
 async def handle_search(u, c, q, uid):
-    db.user_stats[uid]['searches'] += 1
-    db.global_searches += 1
+    await state_io(db.record_search, uid)
     
     loading_msg = random.choice(SEARCH_MSGS)
     msg = await u.message.reply_text(f"{loading_msg}", parse_mode=ParseMode.MARKDOWN_V2)
     
-    songs = api.search(q)
+    with tracer.span('search'):
+        songs = await asyncio.to_thread(api.search, q)
     if not songs:
         await msg.edit_text(
             "😕 *No results found\\!*\n\n💡 Try different keywords",
@@ -839,7 +3209,7 @@ async def handle_search(u, c, q, uid):
         )
         return
     
-    db.user_searches[uid] = {'q': q, 'songs': songs}
+    key = await open_session(uid, {'q': q, 'songs': songs})
     
     result_text = f"""
 ╔══════════════════════════╗
@@ -851,7 +3221,9 @@ async def handle_search(u, c, q, uid):
 
 ━━━━━━━━━━━━━━━━━━━━━
 """
-    await msg.edit_text(result_text, parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.songs(songs, 0, len(songs)))
+    with tracer.span('reply'):
+        await msg.edit_text(result_text, parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.songs(songs, 0, len(songs), key=key))
+    prefetcher.schedule(songs, 0)
 
 async def handle_url(u, c, url, uid):
     msg = await u.message.reply_text("🔗 *Processing link\\.\\.\\.*", parse_mode=ParseMode.MARKDOWN_V2)
@@ -859,18 +3231,21 @@ async def handle_url(u, c, url, uid):
     t = url_type(url)
     
     if t == 'song':
-        song = api.song(url)
+        with tracer.span('fetch_song'):
+            song = await asyncio.to_thread(api.song, url)
         if song:
-            db.user_searches[uid] = {'q': url, 'songs': [song]}
-            db.add_to_history(uid, song)
-            await send_song_detail(msg, c, uid, song, 0, 0)
+            key = await open_session(uid, {'q': url, 'songs': [song]})
+            await state_io(db.add_to_history, uid, song)
+            with tracer.span('reply'):
+                await send_song_detail(msg, c, uid, song, 0, 0, key)
         else:
             await msg.edit_text("❌ *Could not fetch song\\!*\n\nTry again later", parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.main())
     
     elif t == 'album':
-        album = api.album(url)
+        with tracer.span('fetch_album'):
+            album = await asyncio.to_thread(api.album, url)
         if album and album.get('songs'):
-            db.user_searches[uid] = {'q': url, 'songs': album['songs'], 'col': album, 'type': 'album'}
+            key = await open_session(uid, {'q': url, 'songs': album['songs'], 'col': album, 'type': 'album'})
             name = album.get('title') or album.get('name', 'Album')
             year = album.get('year', '')
             
@@ -885,14 +3260,17 @@ async def handle_url(u, c, url, uid):
 
 ━━━━━━━━━━━━━━━━━━━━━
 """
-            await msg.edit_text(album_text, parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.collection(album['songs'], 0, 'album'))
+            with tracer.span('reply'):
+                await msg.edit_text(album_text, parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.collection(album['songs'], 0, 'album', key))
+            prefetcher.schedule(album['songs'], 0)
         else:
             await msg.edit_text("❌ *Could not fetch album\\!*", parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.main())
     
     elif t == 'playlist':
-        pl = api.playlist(url)
+        with tracer.span('fetch_playlist'):
+            pl = await asyncio.to_thread(api.playlist, url)
         if pl and pl.get('songs'):
-            db.user_searches[uid] = {'q': url, 'songs': pl['songs'], 'col': pl, 'type': 'playlist'}
+            key = await open_session(uid, {'q': url, 'songs': pl['songs'], 'col': pl, 'type': 'playlist'})
             name = pl.get('listname') or pl.get('title', 'Playlist')
             
             pl_text = f"""
@@ -905,13 +3283,15 @@ async def handle_url(u, c, url, uid):
 
 ━━━━━━━━━━━━━━━━━━━━━
 """
-            await msg.edit_text(pl_text, parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.collection(pl['songs'], 0, 'playlist'))
+            with tracer.span('reply'):
+                await msg.edit_text(pl_text, parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.collection(pl['songs'], 0, 'playlist', key))
+            prefetcher.schedule(pl['songs'], 0)
         else:
             await msg.edit_text("❌ *Could not fetch playlist\\!*", parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.main())
     else:
         await msg.edit_text("❌ *Invalid URL\\!*\n\nSupported: song/album/playlist", parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.main())
 
-async def send_song_detail(msg, c, uid, song, idx, pg):
+async def send_song_detail(msg, c, uid, song, idx, pg, key=None):
     title = song.get('title') or song.get('song', 'Unknown')
     singers = song.get('singers', 'Unknown')
     album = song.get('album', 'Unknown')
@@ -920,7 +3300,7 @@ async def send_song_detail(msg, c, uid, song, idx, pg):
     lang = str(song.get('language', 'N/A')).title()
     
     sid = song.get('songid') or song.get('id', '')
-    fav = any((s.get('songid') or s.get('id', '')) == sid for s in db.user_favorites[uid])
+    fav = any((s.get('songid') or s.get('id', '')) == sid for s in await db.user_favorites.aget(uid, []))
     
     info = f"""
 ╔══════════════════════════╗
@@ -939,25 +3319,753 @@ async def send_song_detail(msg, c, uid, song, idx, pg):
 """
     img = song.get('image') or song.get('image_url', '')
     
+    # Under load, one edit of the message that was tapped instead of delete + new photo
+    if shedder.active:
+        try:
+            if getattr(msg, 'photo', None):
+                await msg.edit_caption(caption=info, parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.detail(idx, fav, pg, key))
+            else:
+                await msg.edit_text(info, parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.detail(idx, fav, pg, key))
+            shedder.skipped.inc('detail_resend')
+            return
+        except Exception as e:
+            logger.warning(f"In-place detail edit failed, resending: {e}")
+    
     try: await msg.delete()
     except: pass
     
     if img:
         try:
             await c.bot.send_photo(chat_id=msg.chat.id, photo=img, caption=info,
-                parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.detail(idx, fav, pg))
+                parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.detail(idx, fav, pg, key))
             return
         except: pass
     
     await c.bot.send_message(chat_id=msg.chat.id, text=info,
-        parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.detail(idx, fav, pg))
+        parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.detail(idx, fav, pg, key))
+
+async def open_session(uid, sess, key=None):
+    """Make sess the user's current result set and return its callback key.
+    
+    Every set gets a key of its own (uid plus a random nonce), so two users
+    running the same query, or one user running it twice, never share a
+    stored list that buttons index into. A re-run of an expired set passes
+    its old key, so the buttons that asked for it work again.
+    """
+    key = key or ResultCache.make_key(uid, sess.get('q'), random.getrandbits(48))
+    sess['key'] = key
+    db.user_searches[uid] = sess
+    await off_loop(results.put, key, sess)  # SQLite or Redis either way
+    if state.shared:
+        # Buttons without a key may land on another worker; it finds the current set through this
+        await state_io(state.set, f"cur:{uid}", key, RESULTS_TTL)
+    return key
+
+async def load_session(uid, rkey=None):
+    """Result set for a button press, transparently re-running the query if it expired"""
+    if rkey:
+        sess = await off_loop(results.get, rkey)
+        if sess is not None:
+            cur = db.user_searches.get(uid)
+            if cur is None or cur.get('key') != rkey:
+                db.user_searches[uid] = sess
+            return sess
+        cur = db.user_searches.get(uid)
+        if cur is not None and cur.get('key') == rkey:
+            return cur
+        info = await off_loop(results.expired, rkey)
+    else:
+        sess = db.user_searches.get(uid)
+        if sess is not None:
+            return sess
+        if state.shared:
+            cur = await state_io(state.get, f"cur:{uid}")
+            sess = await off_loop(results.get, cur) if cur else None
+            if sess is not None:
+                db.user_searches[uid] = sess
+                return sess
+        info = db.user_searches.expired(uid)
+    if not info or not info.get('q'):
+        return None
+    
+    q = info['q']
+    shelf = info.get('shelf')
+    logger.info(f"♻️ Restoring expired session for {uid}: {q}")
+    if shelf:
+        songs = await shelves.songs(shelf)
+        sess = {'q': q, 'songs': songs, 'shelf': shelf} if songs else None
+    elif q == 'Favorites':
+        sess = {'q': q, 'songs': await db.user_favorites.load(uid)}
+    elif q == 'History':
+        sess = {'q': q, 'songs': await db.user_history.load(uid)}
+    elif q.startswith('Playlist: '):
+        songs = (await db.user_playlists.load(uid)).get(q[10:])
+        sess = {'q': q, 'songs': songs, 'type': 'playlist'} if songs else None
+    elif is_url(q):
+        t = url_type(q)
+        if t == 'song':
+            song = await asyncio.to_thread(api.song, q)
+            sess = {'q': q, 'songs': [song]} if song else None
+        elif t in ('album', 'playlist'):
+            col = await asyncio.to_thread(api.album if t == 'album' else api.playlist, q)
+            sess = {'q': q, 'songs': col['songs'], 'col': col, 'type': t} if col and col.get('songs') else None
+        else:
+            sess = None
+    else:
+        songs = await asyncio.to_thread(api.search, q)
+        sess = {'q': q, 'songs': songs} if songs else None
+    
+    # Old buttons carry indices into the old list, so the re-run has to come back in that order
+    if sess and 'ids' in info:
+        sess['songs'] = restore_order(sess['songs'], info['ids'])
+    elif sess and 'order' in info and order_key(sess['songs']) != info['order']:
+        sess['songs'] = None
+    if sess and sess['songs'] is None:
+        logger.info(f"♻️ Results for {q} changed since {uid} saw them; not restoring")
+        return None
+    if sess:
+        await open_session(uid, sess, rkey)
+    return sess
+
+# === DELIVERY ===
+async def song_media_url(song):
+    """CDN URL for a song, looking up the song page when the result lacks one"""
+    url = song.get('media_url') or song.get('url', '')
+    if not url:
+        purl = song.get('perma_url', '')
+        if purl:
+            with tracer.span('resolve_url'):
+                det = await prefetcher.get(purl)
+            if det:
+                url = det.get('media_url') or det.get('url', '')
+                song.update(det)
+    return url
+
+def audio_meta(song):
+    title = song.get('title') or song.get('song', 'Song')
+    dur = str(song.get('duration', ''))
+    return title, re.sub(r'[<>:"/\\|?*]', '', title)[:50] + '.mp3', int(dur) if dur.isdigit() else None
+
+async def fetch_group(songs, quality, sem):
+    """Open the audio files for one media group, a few downloads at a time"""
+    async def one(song):
+        async with sem:
+            url = await song_media_url(song)
+            if not url:
+                return None
+            f = await asyncio.to_thread(audio_cache.open, song.get('songid') or song.get('id'), quality, url)
+            return (song, f) if f else None
+    got = await asyncio.gather(*(one(s) for s in songs), return_exceptions=True)
+    for g in got:
+        if isinstance(g, BaseException):
+            logger.error(f"Batch download error: {g}")
+    return [g for g in got if g and not isinstance(g, BaseException)]
+
+async def send_group(bot, chat_id, items):
+    """One send_media_group call for the group, else one send_audio per track; returns tracks delivered"""
+    if len(items) > 1:
+        for attempt in range(2):
+            media = []
+            for song, f in items:
+                f.seek(0)
+                title, fname, dur = audio_meta(song)
+                media.append(InputMediaAudio(InputFile(f, filename=fname, attach=True, read_file_handle=False),
+                                             title=title, performer=song.get('singers'), duration=dur, filename=fname))
+            try:
+                with metrics.upload_seconds.time(outcome=True), tracer.span('upload_group'):
+                    await bot.send_media_group(chat_id, media)
+                metrics.batch_sends.inc('group')
+                return len(items)
+            except RetryAfter as e:
+                if attempt:
+                    break
+                await asyncio.sleep(e.retry_after if isinstance(e.retry_after, (int, float)) else e.retry_after.total_seconds())
+            except TimedOut:
+                # Telegram may well have taken the group; resending track by track could deliver it twice
+                logger.warning(f"Media group of {len(items)} timed out; not resending")
+                metrics.batch_sends.inc('group_timeout')
+                return len(items)
+            except Exception as e:
+                logger.warning(f"Media group of {len(items)} failed, sending one by one: {e}")
+                break
+        metrics.batch_sends.inc('group_failed')
+    sent = 0
+    for song, f in items:
+        title, fname, dur = audio_meta(song)
+        try:
+            f.seek(0)
+            with metrics.upload_seconds.time(outcome=True), tracer.span('upload'):
+                await bot.send_audio(chat_id=chat_id, title=title, filename=fname, duration=dur,
+                                     audio=InputFile(f, filename=fname, read_file_handle=False))
+            metrics.batch_sends.inc('single')
+            sent += 1
+        except Exception as e:
+            logger.error(f"Batch download error: {e}")
+    return sent
+
+# ==================== JOB QUEUE ====================
+class JobQueue:
+    """Download jobs persisted in SQLite and run by a fixed pool of workers.
+    
+    Jobs are claimed by priority, so single downloads overtake Download
+    All groups; within a priority the next job goes to the user served
+    longest ago, and each user gets at most USER_DOWNLOAD_CONCURRENCY
+    workers, so one huge batch can't starve everyone else. Users past
+    their hourly byte quota are only served when nobody else is waiting.
+    Several processes may share the database: a claim is one IMMEDIATE
+    transaction, so limits hold across all of them, and running jobs carry
+    their owner and a lease. A worker's own jobs are queued again when it
+    restarts, and anyone's are once their lease lapses, so a crash costs
+    at most a resend of the tracks in flight.
+    """
+    
+    def __init__(self, path=JOBS_DB, workers=DOWNLOAD_WORKERS, owner=JOB_WORKER_ID):
+        self.workers = workers
+        self.owner = owner
+        self.handlers = {}
+        self.bot = None
+        self.recent: deque = deque(maxlen=500)  # (kind, wait seconds, run seconds)
+        self._tasks: List[asyncio.Task] = []
+        self._wake: Optional[asyncio.Event] = None
+        self._finished: Optional[asyncio.Condition] = None
+        self._lock = threading.Lock()
+        self._turn = 0
+        self._served: Dict[int, int] = {}  # uid -> turn it was last handed a job
+        self._held: Set[int] = set()  # queued job ids already counted as deferred
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self.wait_seconds = metrics.histogram('groovia_job_wait_seconds', 'Time download jobs spend queued', ['kind'])
+        self.run_seconds = metrics.histogram('groovia_job_run_seconds', 'Download job run time', ['kind'])
+        self.outcomes = metrics.counter('groovia_jobs_total', 'Finished download jobs', ['kind', 'outcome'])
+        metrics.gauge('groovia_job_queue_depth', 'Download jobs waiting or running', self.depth, ['kind', 'state'])
+        self.deferred = metrics.counter('groovia_job_deferred_total', 'Queued jobs passed over because their user was at a limit', ['limit'])
+    
+    def _ensure(self):
+        """Open the database and recover interrupted jobs on first use rather than at import"""
+        with self._lock:
+            if self._conn is None:
+                self._open()
+    
+    def _open(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT, priority INTEGER, uid INTEGER, batch TEXT,
+            payload TEXT, state TEXT DEFAULT 'queued', attempts INTEGER DEFAULT 0, delivered INTEGER DEFAULT 0,
+            bytes INTEGER DEFAULT 0, dedupe TEXT, owner TEXT, lease REAL, created REAL, started REAL, finished REAL)""")
+        cols = [r[1] for r in self._conn.execute("PRAGMA table_info(jobs)")]
+        for col, decl in (('bytes', 'INTEGER DEFAULT 0'), ('dedupe', 'TEXT'), ('owner', 'TEXT'), ('lease', 'REAL')):
+            if col not in cols:
+                self._conn.execute(f"ALTER TABLE jobs ADD COLUMN {col} {decl}")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (state, priority, id)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_batch ON jobs (batch, state)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_usage ON jobs (finished, uid)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_dedupe ON jobs (dedupe, state)")
+        requeued = self._conn.execute("UPDATE jobs SET state = 'queued', owner = NULL WHERE state = 'running' "
+                                      "AND (owner = ? OR owner IS NULL OR lease < ?)",
+                                      (self.owner, time.time())).rowcount
+        self._conn.execute("DELETE FROM jobs WHERE state IN ('done', 'failed') AND finished < ?",
+                           (time.time() - JOB_KEEP_DAYS * 86400,))
+        self._conn.commit()
+        if requeued:
+            logger.info(f"♻️ Requeued {requeued} interrupted download jobs")
+    
+    def register(self, kind, handler):
+        """handler(bot, job) -> (tracks delivered, bytes delivered); raising retries the job (single jobs only)"""
+        self.handlers[kind] = handler
+    
+    def depth(self):
+        self._ensure()
+        with self._lock:
+            rows = self._conn.execute("SELECT kind, state, COUNT(*) FROM jobs WHERE state IN ('queued', 'running') "
+                                      "GROUP BY kind, state").fetchall()
+        return {(k, st): n for k, st, n in rows}
+    
+    def start(self, bot):
+        if self._tasks:
+            return
+        self.bot = bot
+        self._wake = asyncio.Event()
+        self._finished = asyncio.Condition()
+        self._tasks = [background(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(background(self._renew()))
+        logger.info(f"👷 {self.workers} download workers started ({self.owner})")
+    
+    def _pending(self, key):
+        return self._conn.execute("SELECT 1 FROM jobs WHERE dedupe = ? AND state IN ('queued', 'running') LIMIT 1",
+                                  (key,)).fetchone() is not None
+    
+    def pending(self, key):
+        """True while a job submitted with this dedupe key is queued or running"""
+        self._ensure()
+        with self._lock:
+            return self._pending(key)
+    
+    def _insert(self, kind, uid, payloads, priority, batch, key):
+        now = time.time()
+        self._ensure()
+        with self._lock:
+            if key and self._pending(key):
+                return []
+            ids = [self._conn.execute("INSERT INTO jobs (kind, priority, uid, batch, payload, dedupe, created) "
+                                      "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                      (kind, priority, uid, batch, json.dumps(p, ensure_ascii=False), key, now)).lastrowid
+                   for p in payloads]
+            self._conn.commit()
+        return ids
+    
+    async def submit(self, bot, kind, uid, payloads, priority, batch=None, key=None):
+        """Queue one job per payload; starts the workers on first use.
+        
+        With a dedupe key nothing is queued (and [] is returned) while an
+        earlier job with the same key is still queued or running.
+        """
+        ids = await asyncio.to_thread(self._insert, kind, uid, payloads, priority, batch, key)
+        self.start(bot)
+        if ids:
+            self._wake.set()
+        return ids
+    
+    def _usage(self):
+        """uid -> bytes delivered in the last hour (caller holds the lock)"""
+        return dict(self._conn.execute("SELECT uid, SUM(bytes) FROM jobs WHERE finished > ? GROUP BY uid",
+                                       (time.time() - 3600,)).fetchall())
+    
+    def quota_left(self, uid):
+        """Bytes the user may still download this hour, None when unlimited"""
+        if not USER_HOURLY_MB or uid in ADMIN_IDS:
+            return None
+        self._ensure()
+        with self._lock:
+            used = self._usage().get(uid, 0)
+        return max(0, USER_HOURLY_MB * 1024 ** 2 - used)
+    
+    def _claim(self):
+        self._ensure()
+        with self._lock:
+            # The write lock is taken up front, so no other process claims between our reads and the update
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                job = self._claim_locked()
+            except BaseException:
+                self._conn.rollback()
+                raise
+            self._conn.commit()
+        return job
+    
+    def _claim_locked(self):
+        """Pick and take the next job; runs inside _claim's transaction"""
+        now = time.time()
+        lapsed = self._conn.execute("UPDATE jobs SET state = 'queued', owner = NULL WHERE state = 'running' "
+                                    "AND lease < ?", (now,)).rowcount
+        if lapsed:
+            logger.warning(f"♻️ Requeued {lapsed} download jobs whose worker stopped renewing them")
+        heads = self._conn.execute("SELECT uid, priority, MIN(id), batch FROM jobs WHERE state = 'queued' "
+                                   "GROUP BY uid, priority").fetchall()
+        if not heads:
+            return None
+        running = dict(self._conn.execute("SELECT uid, COUNT(*) FROM jobs WHERE state = 'running' "
+                                          "GROUP BY uid").fetchall())
+        # A group that finished downloading waits for the groups before it, holding its worker
+        # and open files, so a batch only gets to run so far ahead of what has been sent
+        batch_running = dict(self._conn.execute("SELECT batch, COUNT(*) FROM jobs WHERE state = 'running' "
+                                                "AND batch IS NOT NULL GROUP BY batch").fetchall())
+        usage = self._usage() if USER_HOURLY_MB else {}
+        picks, held = [], {}
+        for uid, priority, job_id, batch in heads:
+            if batch and batch_running.get(batch, 0) > BATCH_GROUPS_AHEAD:
+                continue
+            admin = uid in ADMIN_IDS
+            if not admin and running.get(uid, 0) >= USER_DOWNLOAD_CONCURRENCY:
+                held[job_id] = 'concurrency'
+                continue
+            over = not admin and USER_HOURLY_MB and usage.get(uid, 0) >= USER_HOURLY_MB * 1024 ** 2
+            if over:
+                held[job_id] = 'quota'
+            # Over-quota users only get workers nobody else wants, whatever their priority
+            picks.append((bool(over), priority, self._served.get(uid, 0), job_id))
+        if not picks:
+            return None
+        job_id = min(picks)[3]
+        # A job counts as deferred once, the first time another job is claimed ahead of it
+        held.pop(job_id, None)
+        for held_id, limit in held.items():
+            if held_id not in self._held:
+                self._held.add(held_id)
+                self.deferred.inc(limit)
+        self._held.discard(job_id)
+        if len(self._held) > 10000:
+            self._held &= {h[2] for h in heads}
+        row = self._conn.execute("SELECT id, kind, uid, batch, payload, attempts, created, delivered FROM jobs "
+                                 "WHERE id = ?", (job_id,)).fetchone()
+        taken = self._conn.execute("UPDATE jobs SET state = 'running', owner = ?, lease = ?, started = ?, "
+                                   "attempts = attempts + 1 WHERE id = ? AND state = 'queued'",
+                                   (self.owner, now + JOB_LEASE, now, job_id)).rowcount
+        if not taken:
+            return None  # can't happen inside the transaction, but never run a job someone else holds
+        self._turn += 1
+        self._served[row[2]] = self._turn
+        if len(self._served) > 10000:
+            waiting = {h[0] for h in heads}
+            self._served = {u: t for u, t in self._served.items() if u in waiting}
+        return {'id': row[0], 'kind': row[1], 'uid': row[2], 'batch': row[3], 'payload': json.loads(row[4]),
+                'attempts': row[5] + 1, 'created': row[6], 'started': now, 'delivered': row[7]}
+    
+    def mark_delivered(self, job):
+        """Record that the job's audio reached Telegram, so a retry won't send it again"""
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET delivered = MAX(delivered, 1) WHERE id = ?", (job['id'],))
+            self._conn.commit()
+    
+    def _finish(self, job, delivered, nbytes, ok):
+        # Batch groups are never retried: a requeued group would sit behind later groups waiting on it
+        retry = not ok and job['kind'] != 'batch' and job['attempts'] < JOB_MAX_ATTEMPTS
+        state = 'queued' if retry else ('done' if ok else 'failed')
+        with self._lock:
+            # Only while we still hold it: after a lapsed lease the job belongs to whoever requeued it
+            self._conn.execute("UPDATE jobs SET state = ?, owner = NULL, delivered = MAX(delivered, ?), bytes = bytes + ?, "
+                               "finished = ? WHERE id = ? AND owner = ?",
+                               (state, delivered, nbytes, time.time(), job['id'], self.owner))
+            self._conn.commit()
+        return 'retry' if retry else state
+    
+    def _extend(self):
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET lease = ? WHERE owner = ? AND state = 'running'",
+                               (time.time() + JOB_LEASE, self.owner))
+            self._conn.commit()
+    
+    async def _renew(self):
+        """Keep the leases on this worker's running jobs from lapsing"""
+        while True:
+            await asyncio.sleep(JOB_LEASE / 3)
+            try:
+                await asyncio.to_thread(self._extend)
+            except Exception as e:
+                logger.warning(f"Job lease renewal failed: {e}")
+    
+    async def _worker(self):
+        while True:
+            self._wake.clear()
+            job = await asyncio.to_thread(self._claim)
+            if job is None:
+                # asyncio.timeout, unlike wait_for on 3.11, never turns a shutdown cancel into a timeout
+                try:
+                    async with asyncio.timeout(5):
+                        await self._wake.wait()
+                except TimeoutError:
+                    pass
+                continue
+            kind = job['kind']
+            waited = job['started'] - job['created']
+            self.wait_seconds.observe(waited, kind)
+            start = time.perf_counter()
+            delivered, nbytes, ok = 0, 0, False
+            try:
+                with tracer.trace(f"job_{kind}", None, job['uid'], f"job {job['id']}"):
+                    delivered, nbytes = await self.handlers[kind](self.bot, job)
+                ok = True
+            except Exception as e:
+                logger.error(f"Job {job['id']} ({kind}) attempt {job['attempts']} failed: {e}")
+            ran = time.perf_counter() - start
+            self.run_seconds.observe(ran, kind)
+            self.recent.append((kind, waited, ran))
+            outcome = await asyncio.to_thread(self._finish, job, delivered, nbytes, ok)
+            self.outcomes.inc(kind, outcome)
+            self._wake.set()  # a freed slot may unblock a user held back by their concurrency limit
+            async with self._finished:
+                self._finished.notify_all()
+    
+    def _earlier_pending(self, job):
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM jobs WHERE batch = ? AND id < ? AND state IN ('queued', 'running') LIMIT 1",
+                                      (job['batch'], job['id'])).fetchone() is not None
+    
+    async def turn(self, job):
+        """Wait until earlier jobs of the same batch are finished, so groups arrive in order"""
+        while await asyncio.to_thread(self._earlier_pending, job):
+            async with self._finished:
+                try:
+                    async with asyncio.timeout(2):
+                        await self._finished.wait()
+                except TimeoutError:
+                    pass
+    
+    def batch_progress(self, job):
+        """(tracks delivered by the batch's other jobs, how many of them are still pending)"""
+        with self._lock:
+            row = self._conn.execute("SELECT COALESCE(SUM(delivered), 0), "
+                                     "SUM(CASE WHEN state IN ('queued', 'running') THEN 1 ELSE 0 END) "
+                                     "FROM jobs WHERE batch = ? AND id != ?", (job['batch'], job['id'])).fetchone()
+        return row[0] or 0, row[1] or 0
+    
+    async def join(self, timeout=None):
+        """Wait until nothing is queued or running (benchmarks, shutdown)"""
+        deadline = time.monotonic() + timeout if timeout else None
+        while await asyncio.to_thread(self.depth):
+            if deadline and time.monotonic() > deadline:
+                return False
+            await asyncio.sleep(0.1)
+        return True
+
+jobs = JobQueue()
+
+async def run_download_job(bot, job):
+    """One d_ tap: download, upload with cover art, then remove the progress message"""
+    p = job['payload']
+    song, chat_id, msg_id, uid = p['song'], p['chat_id'], p['msg_id'], job['uid']
+    
+    async def status(text, cosmetic=False):
+        if cosmetic and shedder.active:
+            shedder.skipped.inc('progress_edit')
+            return
+        try:
+            await bot.edit_message_text(text, chat_id=chat_id, message_id=msg_id, parse_mode=ParseMode.MARKDOWN_V2)
+        except Exception as e:
+            logger.warning(f"Status edit failed: {e}")
+    
+    if job['delivered']:
+        # An earlier attempt got the audio out and failed afterwards; only the cleanup is left
+        try:
+            await bot.delete_message(chat_id, msg_id)
+        except Exception:
+            pass
+        return 1, 0
+    
+    thumb_task = None
+    try:
+        if not shedder.active:
+            await bot.send_chat_action(chat_id, "upload_audio")
+        dl_url = await song_media_url(song)
+        if not dl_url:
+            await status("❌ *Download URL not found\\!*")
+            return 0, 0
+        
+        # Cover is fetched alongside the audio, not after it
+        img = song.get('image') or song.get('image_url', '')
+        thumb_task = asyncio.create_task(thumbs.get(img))
+        await status(DL_FETCH, cosmetic=True)
+        
+        with tracer.span('download'):
+            audio = await asyncio.to_thread(audio_cache.open, song.get('songid') or song.get('id'), p['quality'], dl_url)
+        if not audio:
+            await status("❌ *Download failed\\!* Try again")
+            return 0, 0
+        nbytes = os.fstat(audio.fileno()).st_size
+        
+        title = song.get('title') or song.get('song', 'Unknown')
+        singers = song.get('singers', 'Unknown')
+        _, filename, dur = audio_meta(song)
+        with tracer.span('thumbnail_wait'):
+            thumb_data = await thumb_task
+        thumb = BytesIO(thumb_data) if thumb_data else None
+        
+        await status(DL_UPLOAD, cosmetic=True)
+        caption = f"🎵 *{esc(title)}*\n👤 {esc(singers)}\n\n_Downloaded via @Grooviabot_"
+        # The open file is streamed to Telegram as-is rather than read into memory
+        try:
+            with audio, metrics.upload_seconds.time(outcome=True), tracer.span('upload'):
+                await bot.send_audio(
+                    chat_id=chat_id,
+                    audio=InputFile(audio, filename=filename, read_file_handle=False),
+                    thumbnail=thumb,
+                    title=title,
+                    performer=singers,
+                    duration=dur,
+                    filename=filename,
+                    caption=caption,
+                    parse_mode=ParseMode.MARKDOWN_V2
+                )
+        except TimedOut:
+            # Telegram may well have taken the file; a retry could send it twice
+            logger.warning(f"Upload of {filename} timed out; not retrying")
+            await asyncio.to_thread(jobs.mark_delivered, job)
+            await status("⚠️ *Upload timed out\\!*\n\nIf the song didn't arrive, tap Download again")
+            return 0, nbytes
+        await asyncio.to_thread(jobs.mark_delivered, job)
+        
+        await state_io(db.record_download, uid)
+        try:
+            await bot.delete_message(chat_id, msg_id)
+        except Exception:
+            pass
+        return 1, nbytes
+    except Exception as e:
+        logger.error(f"Download error: {e}")
+        if job['attempts'] >= JOB_MAX_ATTEMPTS:
+            await status("❌ *Error occurred\\!*\n\nPlease try again")
+        raise
+    finally:
+        # Early returns and errors leave the cover fetch unawaited
+        if thumb_task and not thumb_task.done():
+            thumb_task.cancel()
+
+async def run_batch_job(bot, job):
+    """One media group of a Download All; groups of a batch download in parallel but send in order"""
+    p = job['payload']
+    chat_id, total = p['chat_id'], p['total']
+    items = await fetch_group(p['songs'], p['quality'], asyncio.Semaphore(BATCH_DOWNLOAD_PARALLEL))
+    try:
+        await jobs.turn(job)
+        sent = await send_group(bot, chat_id, items)
+        nbytes = sum(os.fstat(f.fileno()).st_size for _, f in items) * sent // max(1, len(items))
+    finally:
+        for _, f in items:
+            f.close()
+    for _ in range(sent):
+        await state_io(db.record_download, job['uid'])
+    others, pending = await asyncio.to_thread(jobs.batch_progress, job)
+    done = others + sent
+    if pending and shedder.active:
+        shedder.skipped.inc('progress_edit')
+        return sent, nbytes
+    if pending:
+        text = f"📥 *Batch Download*\n\n⏳ Downloaded {done}/{total}\\.\\.\\."
+    else:
+        text = f"✅ *Download Complete\\!*\n\n📊 {done}/{total} songs downloaded"
+    try:
+        await bot.edit_message_text(text, chat_id=chat_id, message_id=p['msg_id'], parse_mode=ParseMode.MARKDOWN_V2)
+    except Exception as e:
+        logger.warning(f"Batch progress edit failed: {e}")
+    return sent, nbytes
+
+jobs.register('single', run_download_job)
+jobs.register('batch', run_batch_job)
+
+# ==================== LOAD SHEDDING ====================
+class LoadShedder:
+    """Switches the bot into a lean mode while it is under pressure.
+    
+    Every SHED_INTERVAL seconds it looks at recent event-loop lag, the
+    download queue and how often Telegram answered 429. Any one signal over
+    its limit turns shedding on; it turns off again once all of them have
+    stayed under half their limits for SHED_COOLDOWN seconds, so the mode
+    doesn't flap. Handlers check `active` and skip purely cosmetic calls.
+    """
+    
+    def __init__(self):
+        self.active = False
+        self.since = 0.0
+        self.calm_since = None
+        self.reason = ''
+        self.throttles: deque = deque()  # monotonic times of Telegram 429 responses
+        self._task = None
+        metrics.gauge('groovia_load_shedding', 'Whether cosmetic work is being shed', lambda: int(self.active))
+        self.transitions = metrics.counter('groovia_load_shedding_transitions_total', 'Load shedding switched on/off', ['state'])
+        self.skipped = metrics.counter('groovia_shed_skipped_total', 'Cosmetic calls skipped while shedding', ['what'])
+    
+    def throttled(self):
+        """Called for every 429 Telegram sends us"""
+        self.throttles.append(time.monotonic())
+    
+    def signals(self, queued):
+        """signal -> load as a fraction of its limit (>= 1 means over)"""
+        now = time.monotonic()
+        while self.throttles and now - self.throttles[0] > 60:
+            self.throttles.popleft()
+        recent = watchdog.recent()[-int(10 / LOOP_LAG_INTERVAL):]
+        return {
+            'lag': percentile(recent, 95) * 1000 / SHED_LAG_MS,
+            'queue': queued / SHED_QUEUE_DEPTH,
+            '429': len(self.throttles) / SHED_429_PER_MIN,
+        }
+    
+    def update(self, queued):
+        load = self.signals(queued)
+        worst = max(load, key=load.get)
+        now = time.monotonic()
+        if not self.active and load[worst] >= 1:
+            self.active, self.since, self.calm_since, self.reason = True, time.time(), None, worst
+            self.transitions.inc('on')
+            logger.warning(f"🪶 Load shedding on ({worst} at {load[worst] * 100:.0f}% of limit)")
+        elif self.active:
+            if load[worst] >= 0.5:
+                self.calm_since = None
+            elif self.calm_since is None:
+                self.calm_since = now
+            elif now - self.calm_since >= SHED_COOLDOWN:
+                self.active = False
+                self.transitions.inc('off')
+                logger.info(f"🪶 Load shedding off after {time.time() - self.since:.0f}s")
+    
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(SHED_INTERVAL)
+            try:
+                depth = await asyncio.to_thread(jobs.depth)
+                self.update(sum(n for (_, st), n in depth.items() if st == 'queued'))
+            except Exception as e:
+                logger.error(f"Load shedder error: {e}")
+    
+    def start(self):
+        if self._task is None:
+            self._task = background(self._loop())
+
+shedder = LoadShedder()
+
+class CountingRequest(HTTPXRequest):
+    """Bot API transport that reports flood-control (429) responses to the load shedder"""
+    
+    async def do_request(self, *args, **kwargs):
+        code, payload = await super().do_request(*args, **kwargs)
+        if code == 429:
+            shedder.throttled()
+        return code, payload
+
+class TapGuard:
+    """Recognises a double tap on a button whose first tap is running or has just finished.
+    
+    A tap counts as a repeat when it comes from the same source message as
+    the first one, so opening the same song again from a fresh results
+    list always works. Updates are handled one at a time, so the second
+    tap usually arrives after the first finished; the window covers that.
+    """
+    
+    def __init__(self, window=TAP_WINDOW):
+        self.window = window
+        self._taps: Dict[tuple, list] = {}  # key -> [source message id, finished at or None while running]
+    
+    def claim(self, key, source):
+        """False when this tap repeats one still running or finished within the window"""
+        now = time.monotonic()
+        if len(self._taps) > 1000:
+            self._taps = {k: t for k, t in self._taps.items() if t[1] is None or now - t[1] < self.window}
+        prev = self._taps.get(key)
+        if prev and prev[0] == source and (prev[1] is None or now - prev[1] < self.window):
+            return False
+        self._taps[key] = [source, None]
+        return True
+    
+    def release(self, key):
+        if key in self._taps:
+            self._taps[key][1] = time.monotonic()
+
+taps = TapGuard()
 
 # === CALLBACKS ===
+def cb_route(d):
+    """Low-cardinality route name for a callback ('s', 'p', 'm_trend', ...)"""
+    d = cb_decode(d)[0]
+    if d.startswith('m_'):
+        return d
+    return d.split('_', 1)[0]
+
 async def on_callback(u: Update, c):
+    live.request(u.effective_user.id if u.effective_user else None)
+    start = time.perf_counter()
+    try:
+        with tracer.trace('callback', u):
+            await handle_callback(u, c)
+    finally:
+        metrics.callback_seconds.observe(time.perf_counter() - start, cb_route(u.callback_query.data or ''))
+
+async def handle_callback(u: Update, c):
     q = u.callback_query
     await q.answer()
     uid = u.effective_user.id
-    d = q.data
+    d, rkey = cb_decode(q.data)
     
     if d == "close":
         try: await q.message.delete()
@@ -986,24 +4094,26 @@ async def on_callback(u: Update, c):
         )
     
     elif d == "m_trend":
-        await q.edit_message_text("🔥 *Loading Trending\\.\\.\\.*", parse_mode=ParseMode.MARKDOWN_V2)
-        songs = api.search("top songs 2024")
+        if 'trending' not in shelves.snapshots:
+            await q.edit_message_text("🔥 *Loading Trending\\.\\.\\.*", parse_mode=ParseMode.MARKDOWN_V2)
+        songs = await shelves.songs('trending')
         if songs:
-            db.user_searches[uid] = {'q': 'Trending', 'songs': songs}
+            key = await open_session(uid, {'q': 'Trending', 'songs': songs, 'shelf': 'trending'})
             await q.edit_message_text(f"🔥 *Trending Now*\n📊 {len(songs)} hot tracks", 
-                parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.songs(songs, 0, len(songs)))
+                parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.songs(songs, 0, len(songs), key=key))
+            prefetcher.schedule(songs, 0)
         else:
             await q.edit_message_text("❌ *Failed to load\\!*", parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.main())
     
     elif d == "m_fav":
-        favs = db.user_favorites[uid]
+        favs = await db.user_favorites.load(uid)
         if not favs:
             await q.edit_message_text("💔 *No favorites yet\\!*\n\nSearch songs and tap 💖", parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.main())
         else:
             await q.edit_message_text(f"💖 *Your Favorites*\n📊 {len(favs)} songs", parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.favs(favs))
     
     elif d == "m_hist":
-        hist = db.user_history[uid]
+        hist = await db.user_history.load(uid)
         if not hist:
             await q.edit_message_text("📜 *No history yet\\!*", parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.main())
         else:
@@ -1016,17 +4126,17 @@ async def on_callback(u: Update, c):
         await q.edit_message_text("🎤 *Popular Artists*\n\nSelect an artist:", parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.artists())
     
     elif d == "m_stats":
-        st = db.user_stats[uid]
-        favs = len(db.user_favorites[uid])
+        st = await db.user_stats.load(uid)
+        favs = len(await db.user_favorites.load(uid))
         await q.edit_message_text(
-            f"📊 *Your Stats*\n\n🔍 Searches: {st['searches']}\n⬇️ Downloads: {st['downloads']}\n💖 Favorites: {favs}\n📜 History: {len(db.user_history[uid])}",
+            f"📊 *Your Stats*\n\n🔍 Searches: {st['searches']}\n⬇️ Downloads: {st['downloads']}\n💖 Favorites: {favs}\n📜 History: {len(await db.user_history.load(uid))}",
             parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.main())
     
     elif d == "m_settings":
-        await q.edit_message_text("⚙️ *Settings*", parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.settings(uid))
+        await q.edit_message_text("⚙️ *Settings*", parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.settings(await db.user_settings.aget(uid, {})))
     
     elif d == "m_playlist":
-        await q.edit_message_text("📋 *Your Playlists*", parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.playlists(uid))
+        await q.edit_message_text("📋 *Your Playlists*", parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.playlists(await db.user_playlists.load(uid)))
     
     elif d == "m_help":
         await q.edit_message_text(
@@ -1040,49 +4150,41 @@ async def on_callback(u: Update, c):
     # Mood searches
     elif d.startswith("mood_"):
         mood = d[5:]
-        mood_queries = {
-            'happy': 'happy songs', 
-            'sad': 'sad songs',
-            'workout': 'workout songs', 
-            'sleep': 'sleep music',
-            'party': 'party songs', 
-            'romance': 'romantic songs',
-            'chill': 'chill songs', 
-            'energy': 'energetic songs'
-        }
-        query = mood_queries.get(mood, 'top songs')
-        await q.edit_message_text(f"🎭 *Loading {mood.title()} vibes\\.\\.\\.*", parse_mode=ParseMode.MARKDOWN_V2)
-        songs = api.search(query)
+        e = shelves.entry(d)
+        name = e.get('label', mood.title()) if e else mood.title()
+        if d not in shelves.snapshots:
+            await q.edit_message_text(f"🎭 *Loading {esc(name)}\\.\\.\\.*", parse_mode=ParseMode.MARKDOWN_V2)
+        if e:
+            songs = await shelves.songs(d)
+        else:
+            songs = await asyncio.to_thread(api.search, 'top songs')
         if songs:
-            db.user_searches[uid] = {'q': f'{mood.title()} Mood', 'songs': songs}
-            await q.edit_message_text(f"🎭 *{esc(mood.title())} Vibes*\n📊 {len(songs)} songs", 
-                parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.songs(songs, 0, len(songs)))
+            key = await open_session(uid, {'q': name, 'songs': songs, 'shelf': d})
+            await q.edit_message_text(f"🎭 *{esc(name)}*\n📊 {len(songs)} songs", 
+                parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.songs(songs, 0, len(songs), key=key))
+            prefetcher.schedule(songs, 0)
         else:
             await q.edit_message_text("❌ *Failed\\!*", parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.main())
     
     # Artist searches
     elif d.startswith("art_"):
         artist = d[4:]
-        artist_names = {
-            'arijit': 'Arijit Singh', 
-            'shreya': 'Shreya Ghoshal', 
-            'atif': 'Atif Aslam',
-            'neha': 'Neha Kakkar', 
-            'apdhillon': 'AP Dhillon', 
-            'jubin': 'Jubin Nautiyal',
-            'kk': 'KK', 
-            'sonu': 'Sonu Nigam'
-        }
         if artist == 'search':
             await q.edit_message_text("🎤 *Artist Search*\n\nSend artist name:", parse_mode=ParseMode.MARKDOWN_V2)
             return
-        name = artist_names.get(artist, artist)
-        await q.edit_message_text(f"🎤 *Loading {esc(name)}\\.\\.\\.*", parse_mode=ParseMode.MARKDOWN_V2)
-        songs = api.search(name)
+        e = shelves.entry(d)
+        name = e.get('label', artist) if e else artist
+        if d not in shelves.snapshots:
+            await q.edit_message_text(f"🎤 *Loading {esc(name)}\\.\\.\\.*", parse_mode=ParseMode.MARKDOWN_V2)
+        if e:
+            songs = await shelves.songs(d)
+        else:
+            songs = await asyncio.to_thread(api.search, name)
         if songs:
-            db.user_searches[uid] = {'q': name, 'songs': songs}
+            key = await open_session(uid, {'q': name, 'songs': songs, 'shelf': d})
             await q.edit_message_text(f"🎤 *{esc(name)}*\n📊 {len(songs)} songs", 
-                parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.songs(songs, 0, len(songs)))
+                parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.songs(songs, 0, len(songs), key=key))
+            prefetcher.schedule(songs, 0)
         else:
             await q.edit_message_text("❌ *No songs found\\!*", parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.main())
     
@@ -1092,246 +4194,149 @@ async def on_callback(u: Update, c):
     
     elif d.startswith("q_"):
         quality = d[2:] + 'kbps'
-        db.user_settings[uid]['quality'] = quality
+        await state_io(db.set_setting, uid, 'quality', quality)
         await q.answer(f"✅ Quality set to {quality}", show_alert=True)
-        await q.edit_message_text("⚙️ *Settings*", parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.settings(uid))
+        await q.edit_message_text("⚙️ *Settings*", parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.settings(await db.user_settings.aget(uid, {})))
     
     # Song select
     elif d.startswith("s_"):
         idx = int(d[2:])
-        if uid not in db.user_searches: return
-        songs = db.user_searches[uid]['songs']
+        sess = await load_session(uid, rkey)
+        if not sess: return
+        songs = sess['songs']
         if idx >= len(songs): return
         song = songs[idx]
         pg = (idx // SONGS_PER_PAGE) * SONGS_PER_PAGE
-        
-        purl = song.get('perma_url', '')
-        if purl:
-            det = api.song(purl)
-            if det: song.update(det); db.user_searches[uid]['songs'][idx] = song
-        
-        db.add_to_history(uid, song)
-        await send_song_detail(q.message, c, uid, song, idx, pg)
+        if not taps.claim((uid, idx), q.message.message_id):
+            metrics.duplicate_taps.inc('s')
+            return
+        try:
+            purl = song.get('perma_url', '')
+            if purl:
+                det = await prefetcher.get(purl)
+                if det: song = {**song, **det}
+            
+            await state_io(db.add_to_history, uid, song)
+            await send_song_detail(q.message, c, uid, song, idx, pg, sess.get('key'))
+        finally:
+            taps.release((uid, idx))
     
     # Collection song
     elif d.startswith("c_"):
         idx = int(d[2:])
-        if uid not in db.user_searches: return
-        songs = db.user_searches[uid]['songs']
+        sess = await load_session(uid, rkey)
+        if not sess: return
+        songs = sess['songs']
         if idx >= len(songs): return
         song = songs[idx]
-        db.add_to_history(uid, song)
-        await send_song_detail(q.message, c, uid, song, idx, 0)
+        await state_io(db.add_to_history, uid, song)
+        await send_song_detail(q.message, c, uid, song, idx, 0, sess.get('key'))
     
     # Collection pagination
     elif d.startswith("cp_"):
         start = int(d[3:])
-        if uid not in db.user_searches: return
-        songs = db.user_searches[uid]['songs']
-        col_type = db.user_searches[uid].get('type', 'album')
-        await q.edit_message_reply_markup(reply_markup=kb.collection(songs, start, col_type))
+        sess = await load_session(uid, rkey)
+        if not sess: return
+        songs = sess['songs']
+        col_type = sess.get('type', 'album')
+        await q.edit_message_reply_markup(reply_markup=kb.collection(songs, start, col_type, sess.get('key')))
+        prefetcher.schedule(songs, start)
     
     # Pagination
     elif d.startswith("p_"):
         start = int(d[2:])
-        if uid not in db.user_searches: return
-        songs = db.user_searches[uid]['songs']
-        await q.edit_message_reply_markup(reply_markup=kb.songs(songs, start, len(songs)))
+        sess = await load_session(uid, rkey)
+        if not sess: return
+        songs = sess['songs']
+        await q.edit_message_reply_markup(reply_markup=kb.songs(songs, start, len(songs), key=sess.get('key')))
+        prefetcher.schedule(songs, start)
     
     # Shuffle
     elif d == "shuffle":
-        if uid not in db.user_searches: return
-        songs = db.user_searches[uid]['songs'].copy()
+        sess = await load_session(uid, rkey)
+        if not sess: return
+        songs = sess['songs'].copy()
         random.shuffle(songs)
-        db.user_searches[uid]['songs'] = songs
-        await q.edit_message_reply_markup(reply_markup=kb.songs(songs, 0, len(songs)))
+        # A shuffled order is its own result set so older buttons keep their order
+        shuffled = {k: v for k, v in sess.items() if k != 'key'}
+        shuffled['songs'] = songs
+        key = await open_session(uid, shuffled)
+        await q.edit_message_reply_markup(reply_markup=kb.songs(songs, 0, len(songs), key=key))
+        prefetcher.schedule(songs, 0)
         await q.answer("🔀 Shuffled!", show_alert=False)
     
     # Back
     elif d.startswith("b_"):
         pg = int(d[2:])
-        if uid not in db.user_searches:
+        sess = await load_session(uid, rkey)
+        if not sess:
             await q.message.reply_text("⚠️ Session expired\\!", parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.main())
             return
-        songs = db.user_searches[uid]['songs']
-        qry = db.user_searches[uid].get('q', 'Results')
+        songs = sess['songs']
+        qry = sess.get('q', 'Results')
         try: await q.message.delete()
         except: pass
         await c.bot.send_message(q.message.chat.id, f"🎵 *{esc(str(qry)[:30])}*\n📊 {len(songs)} songs",
-            parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.songs(songs, pg, len(songs)))
+            parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.songs(songs, pg, len(songs), key=sess.get('key')))
+        prefetcher.schedule(songs, pg)
     
     # Download
     elif d.startswith("d_"):
         idx = int(d[2:])
-        if uid not in db.user_searches: return
-        songs = db.user_searches[uid]['songs']
+        sess = await load_session(uid, rkey)
+        if not sess: return
+        songs = sess['songs']
         if idx >= len(songs): return
         song = songs[idx]
+        quality = (await db.user_settings.aget(uid, {})).get('quality', '160kbps')
+        # Same song, same chat, same bitrate: a repeat tap rides on the job already in flight
+        key = f"{q.message.chat.id}:{song.get('songid') or song.get('id') or song.get('perma_url', '')}:{quality}"
+        if await asyncio.to_thread(jobs.pending, key):
+            metrics.duplicate_taps.inc('d')
+            await q.answer("⏳ Already downloading, it'll arrive shortly")
+            return
+        if await asyncio.to_thread(jobs.quota_left, uid) == 0:
+            await q.answer("⛔ Hourly download limit reached, try again later", show_alert=True)
+            return
         
         await q.answer("⬇️ Starting download...")
-        
-        loading_text = """
-╔══════════════════════════╗
-    ⏳ *Downloading*
-╚══════════════════════════╝
-
-🎵 Fetching your music\\.\\.\\.
-
-⣾⣿⣿⣿⣿⣿⣿⣿⣿⣷
-█░░░░░░░░░░░░░░░░░░░░░░█
-█░░▓▓▓▓▓▓▓░░░░░░░░░░░░░█  
-█░░░░░░░░░░░░░░░░░░░░░░█
-⣿⣿⣿⣿⣿⣿⣿⣿⣿⣿⣿⣿
-
-_Please wait\\.\\.\\._
-"""
-        msg = await q.message.reply_text(loading_text, parse_mode=ParseMode.MARKDOWN_V2)
-        
-        try:
-            await c.bot.send_chat_action(q.message.chat.id, "upload_audio")
-            
-            dl_url = song.get('media_url') or song.get('url', '')
-            if not dl_url:
-                purl = song.get('perma_url', '')
-                if purl:
-                    det = api.song(purl)
-                    if det: 
-                        dl_url = det.get('media_url') or det.get('url', '')
-                        song.update(det)
-            
-            if not dl_url:
-                await msg.edit_text("❌ *Download URL not found\\!*", parse_mode=ParseMode.MARKDOWN_V2)
-                return
-            
-            quality = db.user_settings[uid].get('quality', '160kbps')
-            dl_url = get_quality_url(song, quality) or dl_url
-            
-            await msg.edit_text("""
-╔══════════════════════════╗
-    ⏳ *Downloading*
-╚══════════════════════════╝
-
-🎵 Fetching your music\\.\\.\\.
-
-⣾⣿⣿⣿⣿⣿⣿⣿⣿⣷
-█░░░░░░░░░░░░░░░░░░░░░░█
-█░░▓▓▓▓▓▓▓▓▓▓▓▓▓░░░░░░░█  
-█░░░░░░░░░░░░░░░░░░░░░░█
-⣿⣿⣿⣿⣿⣿⣿⣿⣿⣿⣿⣿
-
-_Almost there\\.\\.\\._
-""", parse_mode=ParseMode.MARKDOWN_V2)
-            
-            data = api.download(dl_url)
-            if not data:
-                await msg.edit_text("❌ *Download failed\\!* Try again", parse_mode=ParseMode.MARKDOWN_V2)
-                return
-            
-            title = song.get('title') or song.get('song', 'Unknown')
-            singers = song.get('singers', 'Unknown')
-            dur = int(song.get('duration', 0))
-            img = song.get('image') or song.get('image_url', '')
-            
-            thumb = None
-            if img:
-                try:
-                    tr = SESSION.get(img, timeout=15)
-                    if tr.status_code == 200: thumb = BytesIO(tr.content)
-                except: pass
-            
-            audio = BytesIO(data)
-            safe_title = re.sub(r'[<>:"/\\|?*]', '', title)[:50]
-            audio.name = f"{safe_title}.mp3"
-            
-            await msg.edit_text("""
-╔══════════════════════════╗
-    📤 *Uploading*
-╚══════════════════════════╝
-
-🎵 Sending to you\\.\\.\\.
-
-⣾⣿⣿⣿⣿⣿⣿⣿⣿⣷
-█░░░░░░░░░░░░░░░░░░░░░░█
-█░░▓▓▓▓▓▓▓▓▓▓▓▓▓▓▓▓▓▓░░█  
-█░░░░░░░░░░░░░░░░░░░░░░█
-⣿⣿⣿⣿⣿⣿⣿⣿⣿⣿⣿⣿
-
-_Uploading\\.\\.\\._
-""", parse_mode=ParseMode.MARKDOWN_V2)
-            
-            caption = f"🎵 *{esc(title)}*\n👤 {esc(singers)}\n\n_Downloaded via @Grooviabot_"
-            
-            await c.bot.send_audio(
-                chat_id=q.message.chat.id, 
-                audio=audio, 
-                thumbnail=thumb,
-                title=title, 
-                performer=singers, 
-                duration=dur, 
-                filename=f"{safe_title}.mp3",
-                caption=caption, 
-                parse_mode=ParseMode.MARKDOWN_V2
-            )
-            
-            db.user_stats[uid]['downloads'] += 1
-            db.global_downloads += 1
-            await msg.delete()
-            
-        except Exception as e:
-            logger.error(f"Download error: {e}")
-            await msg.edit_text("❌ *Error occurred\\!*\n\nPlease try again", parse_mode=ParseMode.MARKDOWN_V2)
+        msg = await q.message.reply_text(DL_WAIT, parse_mode=ParseMode.MARKDOWN_V2)
+        ids = await jobs.submit(c.bot, 'single', uid, [{'song': song, 'quality': quality, 'chat_id': q.message.chat.id,
+                                                        'msg_id': msg.message_id}], PRIORITY_SINGLE, key=key)
+        if not ids:  # lost the race to a concurrent tap
+            metrics.duplicate_taps.inc('d')
+            try: await msg.delete()
+            except: pass
     
     # Download all
     elif d == "dall":
-        if uid not in db.user_searches: return
-        songs = db.user_searches[uid]['songs']
+        sess = await load_session(uid, rkey)
+        if not sess: return
+        songs = sess['songs']
         max_dl = len(songs)
+        if await asyncio.to_thread(jobs.quota_left, uid) == 0:
+            await q.answer("⛔ Hourly download limit reached, try again later", show_alert=True)
+            return
 
         await q.answer(f"⬇️ Downloading {max_dl} songs...")
         
         msg = await q.message.reply_text(f"📥 *Batch Download*\n\n⏳ Downloading 0/{max_dl}\\.\\.\\.", parse_mode=ParseMode.MARKDOWN_V2)
         
-        done = 0
-        for i, song in enumerate(songs[:max_dl]):
-            try:
-                dl_url = song.get('media_url') or song.get('url', '')
-                if not dl_url:
-                    purl = song.get('perma_url', '')
-                    if purl:
-                        det = api.song(purl)
-                        if det: dl_url = det.get('media_url') or det.get('url', '')
-                
-                if dl_url:
-                    quality = db.user_settings[uid].get('quality', '160kbps')
-                    dl_url = get_quality_url(song, quality) or dl_url
-                    data = api.download(dl_url)
-                    
-                    if data:
-                        title = song.get('title') or song.get('song', 'Song')
-                        safe_title = re.sub(r'[<>:"/\\|?*]', '', title)[:50]
-                        audio = BytesIO(data)
-                        audio.name = f"{safe_title}.mp3"
-                        
-                        await c.bot.send_audio(chat_id=q.message.chat.id, audio=audio, title=title, filename=f"{safe_title}.mp3")
-                        done += 1
-                        db.user_stats[uid]['downloads'] += 1
-                        db.global_downloads += 1
-                        
-                        await msg.edit_text(f"📥 *Batch Download*\n\n⏳ Downloaded {done}/{max_dl}\\.\\.\\.", parse_mode=ParseMode.MARKDOWN_V2)
-                
-                await asyncio.sleep(1.5)
-            except Exception as e:
-                logger.error(f"Batch download error: {e}")
-        
-        await msg.edit_text(f"✅ *Download Complete\\!*\n\n📊 {done}/{max_dl} songs downloaded", parse_mode=ParseMode.MARKDOWN_V2)
+        quality = (await db.user_settings.aget(uid, {})).get('quality', '160kbps')
+        chat_id = q.message.chat.id
+        payloads = [{'songs': songs[i:i + MEDIA_GROUP_SIZE], 'quality': quality, 'chat_id': chat_id,
+                     'msg_id': msg.message_id, 'total': max_dl} for i in range(0, max_dl, MEDIA_GROUP_SIZE)]
+        if payloads:
+            await jobs.submit(c.bot, 'batch', uid, payloads, PRIORITY_BATCH, f"{chat_id}:{msg.message_id}")
     
     # Save all to favorites
     elif d == "savall":
-        if uid not in db.user_searches: return
-        songs = db.user_searches[uid]['songs']
+        sess = await load_session(uid, rkey)
+        if not sess: return
+        songs = sess['songs']
         added = 0
         for song in songs:
-            if db.add_to_favorites(uid, song): 
+            if await state_io(db.add_to_favorites, uid, song): 
                 added += 1
         if added > 0:
             await q.answer(f"💖 Added {added} songs to favorites!", show_alert=True)
@@ -1341,8 +4346,9 @@ _Uploading\\.\\.\\._
     # Lyrics
     elif d.startswith("l_"):
         idx = int(d[2:])
-        if uid not in db.user_searches: return
-        songs = db.user_searches[uid]['songs']
+        sess = await load_session(uid, rkey)
+        if not sess: return
+        songs = sess['songs']
         if idx >= len(songs): return
         song = songs[idx]
         
@@ -1352,7 +4358,7 @@ _Uploading\\.\\.\\._
             return
         
         await q.answer("📝 Fetching lyrics...")
-        det = api.song(purl, lyrics=True)
+        det = await asyncio.to_thread(api.song, purl, True)
         lyrics = det.get('lyrics', '') if det else ''
         
         if not lyrics:
@@ -1367,8 +4373,9 @@ _Uploading\\.\\.\\._
     # Share
     elif d.startswith("sh_"):
         idx = int(d[3:])
-        if uid not in db.user_searches: return
-        songs = db.user_searches[uid]['songs']
+        sess = await load_session(uid, rkey)
+        if not sess: return
+        songs = sess['songs']
         if idx >= len(songs): return
         song = songs[idx]
         
@@ -1382,125 +4389,141 @@ _Uploading\\.\\.\\._
     # Fav/Unfav
     elif d.startswith("f_"):
         idx = int(d[2:])
-        if uid not in db.user_searches: return
-        songs = db.user_searches[uid]['songs']
+        sess = await load_session(uid, rkey)
+        if not sess: return
+        songs = sess['songs']
         if idx >= len(songs): return
-        if db.add_to_favorites(uid, songs[idx]):
+        if await state_io(db.add_to_favorites, uid, songs[idx]):
             await q.answer("💖 Added to favorites!", show_alert=True)
             pg = (idx // SONGS_PER_PAGE) * SONGS_PER_PAGE
-            try: await q.edit_message_reply_markup(reply_markup=kb.detail(idx, True, pg))
+            try: await q.edit_message_reply_markup(reply_markup=kb.detail(idx, True, pg, sess.get('key')))
             except: pass
         else:
             await q.answer("Already in favorites!", show_alert=True)
     
     elif d.startswith("uf_"):
         idx = int(d[3:])
-        if uid not in db.user_searches: return
-        songs = db.user_searches[uid]['songs']
+        sess = await load_session(uid, rkey)
+        if not sess: return
+        songs = sess['songs']
         if idx >= len(songs): return
         sid = songs[idx].get('songid') or songs[idx].get('id', '')
-        if db.remove_from_favorites(uid, sid):
+        if await state_io(db.remove_from_favorites, uid, sid):
             await q.answer("💔 Removed from favorites!", show_alert=True)
             pg = (idx // SONGS_PER_PAGE) * SONGS_PER_PAGE
-            try: await q.edit_message_reply_markup(reply_markup=kb.detail(idx, False, pg))
+            try: await q.edit_message_reply_markup(reply_markup=kb.detail(idx, False, pg, sess.get('key')))
             except: pass
     
     # Fav play
     elif d.startswith("fp_"):
         idx = int(d[3:])
-        favs = db.user_favorites[uid]
+        favs = await db.user_favorites.load(uid)
         if idx >= len(favs): return
         song = favs[idx]
-        db.user_searches[uid] = {'q': 'Favorites', 'songs': favs}
-        await send_song_detail(q.message, c, uid, song, idx, 0)
+        key = await open_session(uid, {'q': 'Favorites', 'songs': favs})
+        await send_song_detail(q.message, c, uid, song, idx, 0, key)
     
     # History play
     elif d.startswith("hp_"):
         idx = int(d[3:])
-        hist = db.user_history[uid]
+        hist = await db.user_history.load(uid)
         if idx >= len(hist): return
         song = hist[idx]
-        db.user_searches[uid] = {'q': 'History', 'songs': hist}
-        await send_song_detail(q.message, c, uid, song, idx, 0)
+        key = await open_session(uid, {'q': 'History', 'songs': hist})
+        await send_song_detail(q.message, c, uid, song, idx, 0, key)
     
     # Clear favorites
     elif d == "cfav":
-        db.user_favorites[uid] = []
+        await db.user_favorites.adelete(uid)
         await q.answer("🗑️ Favorites cleared!", show_alert=True)
         await q.edit_message_text("💔 *Favorites cleared\\!*", parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.main())
     
     # Clear history
     elif d == "chist":
-        db.user_history[uid] = []
+        await db.user_history.adelete(uid)
         await q.answer("🗑️ History cleared!", show_alert=True)
         await q.edit_message_text("📜 *History cleared\\!*", parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.main())
     
     # Create new playlist
     elif d == "newpl":
         await q.edit_message_text("📁 *Create Playlist*\n\nSend playlist name:", parse_mode=ParseMode.MARKDOWN_V2)
-        db.user_stats[uid]['awaiting_playlist'] = True
+        await state_io(db.set_stat, uid, 'awaiting_playlist', True)
     
     # Add to playlist
     elif d.startswith("addpl_"):
         idx = int(d[6:])
-        if uid not in db.user_searches: return
-        songs = db.user_searches[uid]['songs']
+        sess = await load_session(uid, rkey)
+        if not sess: return
+        songs = sess['songs']
         if idx >= len(songs): return
         
-        pls = db.user_playlists[uid]
+        pls = await db.user_playlists.load(uid)
         if not pls:
             await q.answer("📁 Create a playlist first!", show_alert=True)
             return
         
         kb_pl = []
-        for name in list(pls.keys())[:8]:
-            kb_pl.append([InlineKeyboardButton(f"📁 {name}", callback_data=f"plsel_{idx}_{name}")])
-        kb_pl.append([InlineKeyboardButton("🔙 Back", callback_data=f"s_{idx}")])
+        # Playlists are referred to by position: names can be too long to fit next to the result key
+        for n, name in enumerate(list(pls.keys())[:8]):
+            kb_pl.append([InlineKeyboardButton(f"📁 {name}", callback_data=cb_encode(f"pla_{idx}_{n}", sess.get('key')))])
+        kb_pl.append([InlineKeyboardButton("🔙 Back", callback_data=cb_encode(f"s_{idx}", sess.get('key')))])
         
         await q.edit_message_text("📁 *Select Playlist*\n\nChoose where to add:", 
             parse_mode=ParseMode.MARKDOWN_V2, reply_markup=InlineKeyboardMarkup(kb_pl))
     
-    # Playlist selection
-    elif d.startswith("plsel_"):
-        parts = d[6:].split('_', 1)
-        idx = int(parts[0])
-        pl_name = parts[1] if len(parts) > 1 else ""
+    # Playlist selection (pla_<song>_<position>; plsel_<song>_<name> from older menus)
+    elif d.startswith("pla_") or d.startswith("plsel_"):
+        parts = d.split('_', 2)
+        idx = int(parts[1])
+        pl_name = parts[2] if len(parts) > 2 else ""
+        if d.startswith("pla_"):
+            names = list(await db.user_playlists.load(uid))
+            pos = int(pl_name) if pl_name.isdigit() else len(names)
+            pl_name = names[pos] if pos < len(names) else ""
         
-        if uid not in db.user_searches: return
-        songs = db.user_searches[uid]['songs']
+        sess = await load_session(uid, rkey)
+        if not sess: return
+        songs = sess['songs']
         if idx >= len(songs): return
         
-        if db.add_to_playlist(uid, pl_name, songs[idx]):
+        if await state_io(db.add_to_playlist, uid, pl_name, songs[idx]):
             await q.answer(f"✅ Added to {pl_name}!", show_alert=True)
         else:
             await q.answer("Already in playlist!", show_alert=True)
         
         pg = (idx // SONGS_PER_PAGE) * SONGS_PER_PAGE
         sid = songs[idx].get('songid') or songs[idx].get('id', '')
-        fav = any((s.get('songid') or s.get('id', '')) == sid for s in db.user_favorites[uid])
-        await q.edit_message_reply_markup(reply_markup=kb.detail(idx, fav, pg))
+        fav = any((s.get('songid') or s.get('id', '')) == sid for s in await db.user_favorites.aget(uid, []))
+        await q.edit_message_reply_markup(reply_markup=kb.detail(idx, fav, pg, sess.get('key')))
     
     # View playlist
     elif d.startswith("pl_"):
         pl_name = d[3:]
-        if pl_name not in db.user_playlists[uid]:
+        if pl_name not in await db.user_playlists.load(uid):
             await q.answer("Playlist not found!", show_alert=True)
             return
         
-        songs = db.user_playlists[uid][pl_name]
+        songs = (await db.user_playlists.load(uid))[pl_name]
         if not songs:
             await q.edit_message_text(f"📁 *{esc(pl_name)}*\n\n📋 Empty playlist", 
-                parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.playlists(uid))
+                parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.playlists(await db.user_playlists.load(uid)))
             return
         
-        db.user_searches[uid] = {'q': f'Playlist: {pl_name}', 'songs': songs, 'type': 'playlist'}
+        key = await open_session(uid, {'q': f'Playlist: {pl_name}', 'songs': songs, 'type': 'playlist'})
         await q.edit_message_text(f"📁 *{esc(pl_name)}*\n📊 {len(songs)} songs",
-            parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.collection(songs, 0, 'playlist'))
+            parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb.collection(songs, 0, 'playlist', key))
 
 async def on_error(u: Update, c):
     logger.error(f"Error: {c.error}")
 
 async def post_init(app):
+    watchdog.start()
+    live.start()
+    ledger.start()
+    db.start()
+    jobs.start(app.bot)  # picks up jobs left over from before a restart
+    shedder.start()
+    shelves.start()
     await app.bot.set_my_commands([
         BotCommand("start", "🚀 Start the bot"),
         BotCommand("menu", "🎵 Main menu"),
@@ -1511,7 +4534,9 @@ async def post_init(app):
         BotCommand("help", "❓ Help guide"),
     ])
     
-    if os.environ.get('RENDER_EXTERNAL_URL'):
+    if WEBHOOK_URL:
+        logger.info("ℹ️ Webhook managed by run_webhook")
+    elif os.environ.get('RENDER_EXTERNAL_URL'):
         webhook_url = f"{os.environ.get('RENDER_EXTERNAL_URL', '')}/{BOT_TOKEN}"
         try:
             await app.bot.set_webhook(url=webhook_url, drop_pending_updates=True)
@@ -1530,12 +4555,13 @@ def main():
         print("❌ BOT_TOKEN missing!")
         return
 
-    try:
-        logger.info("🔄 Force deleting webhook to ensure polling works...")
-        requests.get(f"https://api.telegram.org/bot{BOT_TOKEN}/deleteWebhook?drop_pending_updates=True")
-        logger.info("✅ Webhook deleted successfully")
-    except Exception as e:
-        logger.error(f"⚠️ Failed to delete webhook: {e}")
+    if not WEBHOOK_URL:
+        try:
+            logger.info("🔄 Force deleting webhook to ensure polling works...")
+            requests.get(f"https://api.telegram.org/bot{BOT_TOKEN}/deleteWebhook?drop_pending_updates=True")
+            logger.info("✅ Webhook deleted successfully")
+        except Exception as e:
+            logger.error(f"⚠️ Failed to delete webhook: {e}")
 
     PORT = int(os.environ.get("PORT", 8000))
     RENDER_URL = os.environ.get('RENDER_EXTERNAL_URL', '')
@@ -1543,7 +4569,7 @@ def main():
     logger.info(f"🚀 Starting bot on port {PORT}")
     logger.info("🎼 NEW: Lyrics search enabled!")
 
-    app = Application.builder().token(BOT_TOKEN).post_init(post_init).build()
+    app = Application.builder().token(BOT_TOKEN).request(CountingRequest(connection_pool_size=256)).post_init(post_init).build()
 
     app.add_handler(CommandHandler("start", cmd_start))
     app.add_handler(CommandHandler("help", cmd_help))
@@ -1552,6 +4578,8 @@ def main():
     app.add_handler(CommandHandler("history", cmd_hist))
     app.add_handler(CommandHandler("stats", cmd_stats))
     app.add_handler(CommandHandler("settings", cmd_settings))
+    app.add_handler(CommandHandler("profile", cmd_profile))
+    app.add_handler(CommandHandler("sysstats", cmd_sysstats))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_text))
     app.add_handler(CallbackQueryHandler(on_callback))
     app.add_error_handler(on_error)
@@ -1561,6 +4589,15 @@ def main():
     flask_thread.start()
     logger.info("✅ Flask keep-alive server started")
 
+    if WEBHOOK_URL:
+        # Any number of workers can sit behind the same URL; only one registers it
+        register = state.claim('webhook', 60)
+        logger.info(f"ℹ️ Running in WEBHOOK mode on port {WEBHOOK_PORT} (registering: {register})")
+        app.run_webhook(listen="0.0.0.0", port=WEBHOOK_PORT, url_path=BOT_TOKEN,
+                        webhook_url=f"{WEBHOOK_URL}/{BOT_TOKEN}" if register else None,
+                        allowed_updates=Update.ALL_TYPES)
+        return
+
     if RENDER_URL:
         logger.info(f"🔗 Render URL detected: {RENDER_URL}")
         logger.info("ℹ️ Running in POLLING mode with Flask keep-alive")
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+📈 Groovia Load Generator
+Replays a weighted mix of user actions at a target rate against the real
+on_text / on_callback handlers, with all I/O served by the fakes in bench.py.
+
+Reports throughput, per-scenario latency, event-loop lag and memory growth,
+and exits non-zero when a --max-* gate is exceeded so it can run before deploy.
+
+Usage:
+    python loadgen.py --rate 20 --duration 60 --users 200 \\
+        --mix search=35,lyrics=10,open=20,page=10,download=12,dall=3,fav=10
+"""
+
+import sys, time, asyncio, random, argparse, tempfile, gc, json
+from types import SimpleNamespace
+
+from bench import FakeBackend, FakeBot, Recorder, load_bot, text_update, callback_update, buttons, percentile, job_report
+
+DEFAULT_MIX = "search=35,lyrics=10,open=20,page=10,download=12,dall=3,fav=10"
+
+LYRICS_LINES = [
+    "kal raste mein gham mil gaya tha dil ne kaha",
+    "tere bina main kaise jiyun ye dil hai ki manta nahi",
+    "i want to know what love is baby never let me go",
+    "when the night is over we will always feel the time",
+]
+
+def parse_mix(spec):
+    mix = {}
+    for part in spec.split(','):
+        if not part.strip():
+            continue
+        name, _, weight = part.partition('=')
+        mix[name.strip()] = float(weight or 1)
+    unknown = set(mix) - set(SCENARIOS)
+    if unknown:
+        raise SystemExit(f"Unknown scenarios: {', '.join(sorted(unknown))} (known: {', '.join(SCENARIOS)})")
+    return mix
+
+def rss_mb():
+    """Resident set size of this process in MB"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+# ==================== SCENARIOS ====================
+class User:
+    def __init__(self, uid):
+        self.uid = uid
+        self.results = None  # last message with a results keyboard
+        self.detail = None   # last song detail message
+        self.album = None    # last album keyboard
+        self.n = 0
+
+class Runner:
+    def __init__(self, final, bot, rec):
+        self.final = final
+        self.bot = bot
+        self.rec = rec
+        self.ctx = SimpleNamespace(bot=bot, args=[], error=None)
+
+    async def text(self, name, user, text):
+        await self.rec.run(name, self.final.on_text(text_update(self.bot, user.uid, text), self.ctx))
+        return self.bot.last.get(user.uid)
+
+    async def press(self, name, user, data, msg):
+        await self.rec.run(name, self.final.on_callback(callback_update(self.bot, user.uid, data, msg), self.ctx))
+        return self.bot.last.get(user.uid)
+
+    async def ensure_results(self, user):
+        if not buttons(user.results, 's_'):
+            await self.search(user)
+        return user.results
+
+    async def ensure_detail(self, user):
+        if not buttons(user.detail, 'd_'):
+            await self.open(user)
+        return user.detail
+
+    async def search(self, user):
+        user.n += 1
+        user.results = await self.text('search', user, f"song {user.uid} {user.n % 7}")
+
+    async def lyrics(self, user):
+        user.results = await self.text('lyrics', user, random.choice(LYRICS_LINES))
+
+    async def open(self, user):
+        res = await self.ensure_results(user)
+        songs = buttons(res, 's_')
+        if songs:
+            user.detail = await self.press('open', user, random.choice(songs), res)
+
+    async def page(self, user):
+        res = await self.ensure_results(user)
+        pages = buttons(res, 'p_')
+        if pages:
+            user.results = await self.press('page', user, random.choice(pages), res)
+
+    async def download(self, user):
+        det = await self.ensure_detail(user)
+        dl = buttons(det, 'd_')
+        if dl:
+            await self.press('download', user, dl[0], det)
+
+    async def dall(self, user):
+        album = await self.text('album', user, f"https://www.jiosaavn.com/album/x/{user.uid % 5}")
+        user.album = album
+        btn = buttons(album, 'dall')
+        if btn:
+            await self.press('dall', user, btn[0], album)
+
+    async def fav(self, user):
+        det = await self.ensure_detail(user)
+        toggle = buttons(det, 'f_') or buttons(det, 'uf_')
+        if toggle:
+            await self.press('fav', user, toggle[0], det)
+
+SCENARIOS = {
+    'search': Runner.search, 'lyrics': Runner.lyrics, 'open': Runner.open, 'page': Runner.page,
+    'download': Runner.download, 'dall': Runner.dall, 'fav': Runner.fav,
+}
+
+# ==================== MONITORS ====================
+async def lag_sampler(samples, interval=0.05):
+    """Collect how late the loop wakes us up; that is time some handler blocked it"""
+    loop = asyncio.get_running_loop()
+    while True:
+        t = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, loop.time() - t - interval))
+
+async def run_load(args):
+    mix = parse_mix(args.mix)
+    names, weights = list(mix), list(mix.values())
+
+    backend = FakeBackend(args.api_latency / 1000, args.cdn_latency / 1000, args.media_kb)
+    base = backend.start()
+    final = load_bot(tempfile.mkdtemp(prefix='groovia-load-'), base)
+    bot = FakeBot(args.tg_rtt / 1000)
+    rec = Recorder()
+    runner = Runner(final, bot, rec)
+    users = [User(5000 + i) for i in range(args.users)]
+
+    final.watchdog.start()
+    final.shedder.start()  # as in post_init, so sustained overload trips the lean mode
+    gc.collect()
+    mem_start = rss_mb()
+    lag = []
+    lag_task = asyncio.create_task(lag_sampler(lag))
+    mem_samples = [(0.0, mem_start)]
+
+    inflight = set()
+    fired = dropped = 0
+    start = time.perf_counter()
+    next_at = start
+    while time.perf_counter() - start < args.duration:
+        # Open-loop Poisson arrivals: load doesn't back off when the bot slows down
+        next_at += random.expovariate(args.rate)
+        delay = next_at - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if len(inflight) >= args.max_inflight:
+            dropped += 1
+            continue
+        scenario = random.choices(names, weights)[0]
+        task = asyncio.create_task(SCENARIOS[scenario](runner, random.choice(users)))
+        inflight.add(task)
+        task.add_done_callback(inflight.discard)
+        fired += 1
+        if fired % 50 == 0:
+            mem_samples.append((time.perf_counter() - start, rss_mb()))
+
+    drain_start = time.perf_counter()
+    if inflight:
+        await asyncio.wait(inflight, timeout=args.drain)
+    jobs_drained = await final.jobs.join(max(1, args.drain - (time.perf_counter() - drain_start)))
+    elapsed = time.perf_counter() - start
+    lag_task.cancel()
+    gc.collect()
+    mem_end = rss_mb()
+    await asyncio.to_thread(backend.stop)  # shutdown() blocks until the server loop notices
+
+    print(rec.report(elapsed, "Load test"))
+    print(f"\n🎯 Target rate: {args.rate:.1f} scenarios/sec, fired {fired}, dropped {dropped} "
+          f"(max in-flight {args.max_inflight}), unfinished {len(inflight)}")
+    print(job_report(final) + ("" if jobs_drained else f"\n  ⚠️ still queued: {final.jobs.depth()}"))
+    lag_p = {p: percentile(lag, p) * 1000 for p in (50, 95, 99)}
+    print(f"⏱ Event-loop lag: p50 {lag_p[50]:.1f}ms  p95 {lag_p[95]:.1f}ms  p99 {lag_p[99]:.1f}ms  "
+          f"max {max(lag or [0]) * 1000:.1f}ms")
+    print(f"🧠 RSS: {mem_start:.1f}MB -> {mem_end:.1f}MB ({mem_end - mem_start:+.1f}MB)")
+    shed = final.shedder
+    print(f"🪶 Load shedding: {'on' if shed.active else 'off'} at end, switched on {int(shed.transitions.value('on'))}x, "
+          f"skipped {dict((k[0], int(v)) for k, v in shed.skipped._values.items())}")
+    print(f"🗂 Sessions: {len(final.db.user_searches)} ({final.db.user_searches.total_bytes / 1024:.0f}KB)")
+
+    everything = [v for vals in rec.samples.values() for v in vals]
+    report = {
+        'elapsed': elapsed, 'updates': rec.updates, 'updates_per_sec': rec.updates / elapsed,
+        'fired': fired, 'dropped': dropped, 'unfinished': len(inflight), 'jobs_drained': jobs_drained,
+        'p95_ms': percentile(everything, 95) * 1000, 'errors': rec.errors,
+        'lag_ms': lag_p, 'rss_start_mb': mem_start, 'rss_end_mb': mem_end, 'rss_samples': mem_samples,
+        'steps': {k: {'n': len(v), 'p50_ms': percentile(v, 50) * 1000, 'p95_ms': percentile(v, 95) * 1000,
+                      'p99_ms': percentile(v, 99) * 1000} for k, v in rec.samples.items()},
+    }
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    failures = []
+    if args.max_p95_ms and report['p95_ms'] > args.max_p95_ms:
+        failures.append(f"p95 {report['p95_ms']:.0f}ms > {args.max_p95_ms:.0f}ms")
+    if args.max_lag_ms and lag_p[99] > args.max_lag_ms:
+        failures.append(f"loop lag p99 {lag_p[99]:.0f}ms > {args.max_lag_ms:.0f}ms")
+    if args.max_mem_growth_mb and mem_end - mem_start > args.max_mem_growth_mb:
+        failures.append(f"RSS grew {mem_end - mem_start:.1f}MB > {args.max_mem_growth_mb:.1f}MB")
+    if args.max_errors is not None and sum(rec.errors.values()) > args.max_errors:
+        failures.append(f"{sum(rec.errors.values())} errors > {args.max_errors}")
+    for f in failures:
+        print(f"❌ {f}")
+    return 1 if failures else 0
+
+def main():
+    ap = argparse.ArgumentParser(description="Scenario-driven load generator for the Groovia bot handlers")
+    ap.add_argument('--mix', default=DEFAULT_MIX, help=f"weighted scenarios (default: {DEFAULT_MIX})")
+    ap.add_argument('--rate', type=float, default=10, help="target scenarios per second")
+    ap.add_argument('--duration', type=float, default=30, help="seconds to generate load")
+    ap.add_argument('--drain', type=float, default=60, help="seconds to wait for in-flight work at the end")
+    ap.add_argument('--users', type=int, default=100, help="distinct simulated users")
+    ap.add_argument('--max-inflight', type=int, default=500, help="drop arrivals beyond this many running scenarios")
+    ap.add_argument('--api-latency', type=float, default=50, help="fake API latency (ms)")
+    ap.add_argument('--cdn-latency', type=float, default=100, help="fake CDN time to first byte (ms)")
+    ap.add_argument('--media-kb', type=int, default=512, help="size of each fake audio file (KB)")
+    ap.add_argument('--tg-rtt', type=float, default=30, help="fake Telegram API round trip (ms)")
+    ap.add_argument('--json', help="also write the report to this file")
+    ap.add_argument('--max-p95-ms', type=float, help="fail if overall p95 latency exceeds this")
+    ap.add_argument('--max-lag-ms', type=float, help="fail if p99 event-loop lag exceeds this")
+    ap.add_argument('--max-mem-growth-mb', type=float, help="fail if RSS grows more than this")
+    ap.add_argument('--max-errors', type=int, help="fail if more handler errors than this")
+    args = ap.parse_args()
+    sys.exit(asyncio.run(run_load(args)))
+
+if __name__ == '__main__':
+    main()
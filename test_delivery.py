@@ -0,0 +1,37 @@
+"""
+Delivery checks: what reaches the (fake) Telegram chat when uploads go wrong.
+
+    python -m pytest -q test_delivery.py
+"""
+
+import asyncio, io, tempfile
+
+from telegram.error import TimedOut
+
+from bench import FakeBot, load_bot
+
+final = load_bot(tempfile.mkdtemp(prefix='groovia-test-'), 'http://127.0.0.1:9')
+
+class LateBot(FakeBot):
+    """Takes every media group, then answers too late"""
+
+    async def send_media_group(self, chat_id, media, **kw):
+        await super().send_media_group(chat_id, media, **kw)
+        raise TimedOut()
+
+def items(n):
+    return [({'id': str(i), 'title': f'Song {i}', 'duration': '200'}, io.BytesIO(b'x' * 1024)) for i in range(n)]
+
+def test_timed_out_group_is_not_resent_track_by_track():
+    bot = LateBot(rtt=0)
+    sent = asyncio.run(final.send_group(bot, 1, items(3)))
+    assert sent == 3
+    assert bot.calls == {'send_media_group': 1}
+
+def test_failed_group_falls_back_to_single_tracks():
+    class BrokenBot(FakeBot):
+        async def send_media_group(self, chat_id, media, **kw):
+            raise RuntimeError('bad request')
+    bot = BrokenBot(rtt=0)
+    assert asyncio.run(final.send_group(bot, 1, items(3))) == 3
+    assert bot.calls == {'send_audio': 3}
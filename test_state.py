@@ -0,0 +1,89 @@
+"""
+Shared-state checks: RedisState and the code built on it, run against fakeredis.
+
+    python -m pytest -q test_state.py
+"""
+
+import asyncio, tempfile, threading
+
+import pytest
+
+fakeredis = pytest.importorskip('fakeredis')
+
+from bench import load_bot
+
+final = load_bot(tempfile.mkdtemp(prefix='groovia-test-'), 'http://127.0.0.1:9')
+
+@pytest.fixture
+def server():
+    return fakeredis.FakeServer()
+
+def worker(server):
+    """A RedisState as one bot process would see it"""
+    return final.RedisState(client=fakeredis.FakeRedis(server=server), prefix='t:')
+
+def test_values_round_trip_as_json(server):
+    st = worker(server)
+    st.set('a', {'songs': [1, 2]})
+    assert st.get('a') == {'songs': [1, 2]}
+    assert st.get('missing', 'x') == 'x'
+    st.delete('a')
+    assert st.get('a') is None
+
+def test_keys_counters_and_claims_are_shared(server):
+    a, b = worker(server), worker(server)
+    a.set('fav:1', [])
+    a.set('fav:2', [])
+    assert sorted(b.keys('fav:')) == ['fav:1', 'fav:2']
+    a.incr('downloads')
+    b.incr('downloads', 2)
+    assert a.counter('downloads') == 3
+    assert a.claim('compact', 60)
+    assert not b.claim('compact', 60)
+
+def test_lock_excludes_other_workers(server):
+    a, b = worker(server), worker(server)
+    a.set('n', 0)
+    def bump(st):
+        for _ in range(20):
+            with st.lock('n'):
+                st.set('n', st.get('n') + 1)
+    threads = [threading.Thread(target=bump, args=(st,)) for st in (a, b)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    assert a.get('n') == 40
+
+def test_user_table_returns_copies(server):
+    table = final.UserTable(worker(server), 'fav', list)
+    favs = table[7]
+    favs.append({'id': 'x'})
+    assert table.get(7) is None  # nothing stored until written back
+    table[7] = favs
+    assert table[7] == [{'id': 'x'}]
+    assert table.uids() == [7]
+    del table[7]
+    assert 7 not in table
+
+def test_state_io_runs_redis_calls_off_the_loop(server, monkeypatch):
+    monkeypatch.setattr(final, 'state', worker(server))
+    threads = []
+    async def run():
+        return await final.state_io(lambda: threads.append(threading.current_thread().name) or 1)
+    assert asyncio.run(run()) == 1
+    assert threads[0].startswith('state')
+
+def test_unkeyed_buttons_find_the_session_on_another_worker(server, monkeypatch):
+    st = worker(server)
+    monkeypatch.setattr(final, 'state', st)
+    monkeypatch.setattr(final, 'results', final.ResultCache(shared=st))
+    monkeypatch.setattr(final.db, 'user_searches', final.SessionStore())
+    sess = {'q': 'arijit', 'songs': [{'id': 'a'}, {'id': 'b'}]}
+    asyncio.run(final.open_session(11, sess))
+
+    # Another process: same Redis, nothing in its own memory
+    other = worker(server)
+    monkeypatch.setattr(final, 'state', other)
+    monkeypatch.setattr(final, 'results', final.ResultCache(shared=other))
+    monkeypatch.setattr(final.db, 'user_searches', final.SessionStore())
+    got = asyncio.run(final.load_session(11))
+    assert got is not None and [s['id'] for s in got['songs']] == ['a', 'b']